@@ -0,0 +1,160 @@
+from array import array
+from collections.abc import Mapping
+from decimal import ROUND_HALF_UP, Decimal
+from typing import Dict, Iterable, List, Optional, Tuple
+
+def to_cents(amount) -> int:
+    # Half a cent rounds up, and from the decimal the user typed rather than
+    # the float nearest it: round(10.005 * 100) would give 1000. Amounts
+    # nowhere near a half cent, such as every stored one, skip the Decimal
+    cents = round(amount * 100)
+    if abs(amount * 100 - cents) < 0.25:
+        return cents
+    return int((Decimal(str(amount)) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def split_shares(amount_cents: int, count: int, rotation: int = 0) -> List[int]:
+    # Equal shares with the leftover cents going to consecutive members starting
+    # at rotation, so the same expense always splits the same way and the
+    # extra cents move around the group from one expense to the next
+    base, remainder = divmod(amount_cents, count)
+    return [base + ((index - rotation) % count < remainder) for index in range(count)]
+
+def weighted_shares(amount_cents: int, weights: List[int], rotation: int = 0) -> List[int]:
+    # Shares in proportion to positive integer weights. Everyone gets the
+    # floor of their exact share and the leftover cents go to the largest
+    # fractions, ties broken from rotation as in split_shares; equal weights
+    # give exactly what split_shares gives
+    total = sum(weights)
+    count = len(weights)
+    shares = []
+    fractions = []
+    for weight in weights:
+        share, fraction = divmod(amount_cents * weight, total)
+        shares.append(share)
+        fractions.append(fraction)
+    
+    leftover = amount_cents - sum(shares)
+    order = sorted(range(count), key=lambda index: (-fractions[index], (index - rotation) % count))
+    for index in order[:leftover]:
+        shares[index] += 1
+    return shares
+
+class Roster:
+    # Append-only list of everyone in a guild's balances and split lists,
+    # shared by its GuildBalances and its expenses' split masks. Positions
+    # never move, so a mask built earlier still decodes the same way after
+    # members are added
+    __slots__ = ("members", "positions", "masks")
+    
+    def __init__(self):
+        self.members: List[int] = []
+        self.positions: Dict[int, int] = {}
+        # Split lists as stored, mapped to their mask
+        self.masks: Dict[tuple, int] = {}
+    
+    def position(self, user_id: int) -> int:
+        position = self.positions.get(user_id)
+        if position is None:
+            position = len(self.members)
+            self.positions[user_id] = position
+            self.members.append(user_id)
+        return position
+    
+    def mask(self, user_ids: Iterable[int]) -> int:
+        mask = 0
+        for user_id in user_ids:
+            mask |= 1 << self.position(user_id)
+        return mask
+    
+    def stored_mask(self, user_ids: List) -> int:
+        # Loading repeats the same few split lists thousands of times, so
+        # each distinct one is converted once
+        key = tuple(user_ids)
+        mask = self.masks.get(key)
+        if mask is None:
+            mask = self.masks[key] = self.mask(int(user_id) for user_id in user_ids)
+        return mask
+    
+    def members_of(self, mask: int) -> List[int]:
+        members = []
+        while mask:
+            low = mask & -mask
+            members.append(self.members[low.bit_length() - 1])
+            mask ^= low
+        return members
+
+class GuildBalances(Mapping):
+    # Reads behave like the old Dict[int, float] of dollars; the balances
+    # themselves are integer cents in one array indexed by roster position
+    __slots__ = ("roster", "cents")
+    
+    def __init__(self, roster: Optional[Roster] = None):
+        self.roster = roster if roster is not None else Roster()
+        self.cents = array('q', bytes(8 * len(self.roster.members)))
+    
+    @classmethod
+    def from_dollars(cls, balances: Dict, roster: Optional[Roster] = None) -> "GuildBalances":
+        guild_balances = cls(roster)
+        for user_id, balance in balances.items():
+            guild_balances.cents[guild_balances.position(int(user_id))] = to_cents(balance)
+        return guild_balances
+    
+    def position(self, user_id: int) -> int:
+        position = self.roster.position(user_id)
+        self.grow()
+        return position
+    
+    def grow(self):
+        # Members can join the roster through a split mask, so the array
+        # catches up to it lazily; their balance is 0 until then
+        missing = len(self.roster.members) - len(self.cents)
+        if missing > 0:
+            self.cents.frombytes(bytes(8 * missing))
+    
+    def __getitem__(self, user_id: int) -> float:
+        position = self.roster.positions[user_id]
+        return self.cents[position] / 100 if position < len(self.cents) else 0.0
+    
+    def __iter__(self):
+        return iter(self.roster.members)
+    
+    def __len__(self) -> int:
+        return len(self.roster.members)
+    
+    def __contains__(self, user_id) -> bool:
+        return user_id in self.roster.positions
+    
+    def get_cents(self, user_id: int) -> int:
+        position = self.roster.positions.get(user_id)
+        return self.cents[position] if position is not None and position < len(self.cents) else 0
+    
+    def set_cents(self, user_id: int, value: int):
+        self.cents[self.position(user_id)] = value
+    
+    def add_cents(self, user_id: int, delta: int):
+        self.cents[self.position(user_id)] += delta
+    
+    def apply_split(self, payer_id: int, amount_cents: int, shares: Iterable[Tuple[int, int]], sign: int = 1):
+        self.apply_splits([(payer_id, amount_cents, shares)], sign)
+    
+    def apply_splits(self, splits: Iterable[Tuple[int, int, Iterable[Tuple[int, int]]]], sign: int = 1):
+        # Each split is (payer, amount, [(member, share)]) in cents, as from
+        # Expense.shares. Every split is summed into one delta per roster
+        # position first, so a batch touches the array once per member
+        # rather than once per row
+        deltas: Dict[int, int] = {}
+        roster = self.roster
+        for payer_id, amount_cents, shares in splits:
+            payer_position = roster.position(payer_id)
+            deltas[payer_position] = deltas.get(payer_position, 0) + amount_cents
+            for user_id, share in shares:
+                position = roster.position(user_id)
+                deltas[position] = deltas.get(position, 0) - share
+        
+        self.grow()
+        cents = self.cents
+        for position, delta in deltas.items():
+            cents[position] += sign * delta
+    
+    def __repr__(self) -> str:
+        return f"GuildBalances({dict(self)!r})"
@@ -0,0 +1,313 @@
+import argparse
+import importlib
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+ENGINES = ["json", "journal", "sqlite", "guild_files"]
+COMPARED_KEYS = {"p50_ms", "p90_ms", "mean_bytes", "loaded_state_bytes", "load_peak_bytes"}
+WORDS = [
+    "pizza", "groceries", "uber", "rent", "coffee", "dinner", "movie", "gas", "hotel", "flight",
+    "tickets", "drinks", "lunch", "parking", "snacks", "utilities", "internet", "brunch", "taxi", "museum"
+]
+
+def bytes_written() -> Optional[int]:
+    # Bytes this process has handed to write(), from /proc on Linux
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def percentiles(samples: List[float]) -> Dict:
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    
+    def pick(fraction: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 4)
+    
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 4),
+        "p50_ms": pick(0.50),
+        "p90_ms": pick(0.90),
+        "p99_ms": pick(0.99),
+        "max_ms": round(ordered[-1] * 1000, 4)
+    }
+
+def timed(samples: List[float], function, *args, **kwargs):
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    samples.append(time.perf_counter() - started)
+    return result
+
+class RecordBatch:
+    # Stands in for the write-behind persister while seeding, so the whole
+    # synthetic dataset goes to the engine in one prepare/write
+    def __init__(self):
+        self.records = []
+    
+    @property
+    def dirty(self) -> set:
+        return {record['guild_id'] for record in self.records}
+    
+    def submit(self, record: Dict):
+        self.records.append(record)
+
+class TimedStorage:
+    # Wraps an engine to time prepare (on the event loop) and write (the
+    # file or database I/O) separately, and count the bytes each save writes
+    def __init__(self, storage):
+        self.storage = storage
+        self.prepare_samples = []
+        self.write_samples = []
+        self.write_bytes = []
+    
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+    
+    def prepare(self, bot, records: List[Dict]):
+        return timed(self.prepare_samples, self.storage.prepare, bot, records)
+    
+    def write(self, payload):
+        before = bytes_written()
+        timed(self.write_samples, self.storage.write, payload)
+        after = bytes_written()
+        if before is not None and after is not None:
+            self.write_bytes.append(after - before)
+
+def seed_guilds(bot_module, mode: str, args, rng: random.Random) -> Dict[str, List[str]]:
+    bot = bot_module.SplitwiseBot(storage=bot_module.create_storage(mode))
+    bot.persister = RecordBatch()
+    now = int(time.time())
+    guilds = {}
+    
+    for index in range(args.guilds):
+        guild_id = str(10 ** 17 + index)
+        members = [str(rng.randrange(10 ** 17, 10 ** 18)) for _ in range(args.members)]
+        member_ids = [int(member_id) for member_id in members]
+        bot.initialize_group(guild_id, members)
+        bot.add_expenses(guild_id, [
+            {
+                "payer_id": rng.choice(member_ids),
+                "amount_cents": rng.randint(100, 50000),
+                "description": f"{rng.choice(WORDS)} {rng.choice(WORDS)}",
+                "split_with": member_ids if rng.random() < 0.7 else rng.sample(member_ids, rng.randint(1, len(member_ids))),
+                "timestamp": now - rng.randrange(365 * 86400)
+            }
+            for _ in range(args.expenses)
+        ])
+        guilds[guild_id] = members
+    
+    bot.storage.write(bot.storage.prepare(bot, bot.persister.records))
+    return guilds
+
+def bench_cold_start(bot_module, mode: str, guild_ids: List[str], repeats: int) -> Dict:
+    load = []
+    load_guild = []
+    for _ in range(repeats):
+        bot = timed(load, bot_module.SplitwiseBot, storage=bot_module.create_storage(mode))
+        for guild_id in guild_ids:
+            timed(load_guild, bot.ensure_guild, guild_id)
+        del bot
+    
+    tracemalloc.start()
+    bot = bot_module.SplitwiseBot(storage=bot_module.create_storage(mode))
+    for guild_id in guild_ids:
+        bot.ensure_guild(guild_id)
+    loaded, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    return {
+        "load": percentiles(load),
+        "load_guild": percentiles(load_guild),
+        "memory": {"loaded_state_bytes": loaded, "load_peak_bytes": peak}
+    }
+
+def bench_operations(bot_module, mode: str, guilds: Dict[str, List[str]], args, rng: random.Random) -> Dict:
+    bot = bot_module.SplitwiseBot(storage=bot_module.create_storage(mode))
+    storage = TimedStorage(bot.storage)
+    bot.storage = storage
+    guild_ids = list(guilds)
+    samples = {name: [] for name in (
+        "add_expense", "remove_expense", "settle_debt", "check_balances", "history_first_page", "history_page", "stats"
+    )}
+    
+    for _ in range(args.ops):
+        guild_id = rng.choice(guild_ids)
+        members = guilds[guild_id]
+        timed(samples["add_expense"], bot.add_expense, guild_id, rng.choice(members), rng.randint(100, 50000) / 100, rng.choice(WORDS), members)
+    
+    for _ in range(args.ops):
+        guild_id = rng.choice(guild_ids)
+        expense_id = rng.choice(list(bot.expenses[guild_id]))
+        timed(samples["remove_expense"], bot.remove_expense, guild_id, f"#{expense_id}")
+    
+    for _ in range(args.ops):
+        guild_id = rng.choice(guild_ids)
+        balances = bot.get_balances(guild_id)
+        debtor = min(balances, key=balances.get)
+        creditor = max(balances, key=balances.get)
+        if balances[debtor] < 0 < balances[creditor]:
+            timed(samples["settle_debt"], bot.settle_debt, guild_id, debtor, creditor, 0.01)
+    
+    for _ in range(args.ops):
+        guild_id = rng.choice(guild_ids)
+        timed(samples["check_balances"], lambda: bot_module.settlement_plan_text(bot_module.plan_settlements(bot.get_balances(guild_id))))
+        timed(samples["stats"], bot.get_rollups, guild_id)
+    
+    for _ in range(max(1, args.ops // args.pages)):
+        guild_id = rng.choice(guild_ids)
+        page, cursor = timed(samples["history_first_page"], bot.query_expenses, guild_id, limit=bot_module.HISTORY_PAGE_SIZE)
+        for _ in range(args.pages):
+            if cursor is None:
+                break
+            page, cursor = timed(samples["history_page"], bot.query_expenses, guild_id, before=cursor, limit=bot_module.HISTORY_PAGE_SIZE)
+    
+    results = {name: percentiles(values) for name, values in samples.items()}
+    results["save_prepare"] = percentiles(storage.prepare_samples)
+    results["save_write"] = percentiles(storage.write_samples)
+    if storage.write_bytes:
+        write_bytes = sorted(storage.write_bytes)
+        results["save_bytes"] = {
+            "count": len(write_bytes),
+            "mean_bytes": sum(write_bytes) // len(write_bytes),
+            "p50_bytes": write_bytes[len(write_bytes) // 2],
+            "max_bytes": write_bytes[-1]
+        }
+    return results
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results: Dict, baseline: Dict, threshold: float, min_delta_ms: float) -> List[str]:
+    # Flags a median or p90 latency, bytes per save or memory figure that grew
+    # by more than the threshold factor over the baseline. Latencies must also
+    # grow by min_delta_ms, so microsecond-scale jitter isn't reported
+    regressions = []
+    for mode, engine in results["engines"].items():
+        for name, stats in engine.items():
+            base = baseline.get("engines", {}).get(mode, {}).get(name, {})
+            for key, value in stats.items():
+                if key not in COMPARED_KEYS:
+                    continue
+                previous = base.get(key)
+                if key.endswith("_ms") and value - (previous or 0) < min_delta_ms:
+                    continue
+                if previous and value > previous * threshold:
+                    regressions.append(f"{mode} {name} {key}: {previous} -> {value} ({value / previous:.2f}x)")
+    return regressions
+
+def print_report(results: Dict):
+    for mode, engine in results["engines"].items():
+        print(f"\n{mode}")
+        for name, stats in engine.items():
+            if "p50_ms" in stats:
+                print(f"  {name:<20} p50 {stats['p50_ms']:>10.3f} ms  p90 {stats['p90_ms']:>10.3f} ms  p99 {stats['p99_ms']:>10.3f} ms  n={stats['count']}")
+            elif stats.get("count") != 0:
+                print(f"  {name:<20} " + "  ".join(f"{key} {value}" for key, value in stats.items()))
+    print(f"\npeak RSS {results['peak_rss_kb']} KB")
+
+def run(args) -> int:
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="splitwise-bench-")
+    cwd = os.getcwd()
+    
+    # Storage paths in main are relative, so every engine works inside its
+    # own scratch directory; nothing touches the real data files
+    os.environ.update({"STORAGE_MODE": "json", "WRITE_BEHIND": "0", "JOURNAL_CHECKPOINT_EVERY": str(args.checkpoint_every)})
+    sys.path.insert(0, ROOT)
+    os.chdir(workdir)
+    try:
+        bot_module = importlib.import_module("main")
+        results = {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {
+                "guilds": args.guilds,
+                "members": args.members,
+                "expenses": args.expenses,
+                "ops": args.ops,
+                "pages": args.pages,
+                "repeats": args.repeats,
+                "seed": args.seed,
+                "checkpoint_every": args.checkpoint_every
+            },
+            "engines": {}
+        }
+        
+        for mode in args.engines.split(","):
+            os.makedirs(os.path.join(workdir, mode))
+            os.chdir(os.path.join(workdir, mode))
+            started = time.perf_counter()
+            guilds = seed_guilds(bot_module, mode, args, rng)
+            engine = {"seed": {"seconds": round(time.perf_counter() - started, 3)}}
+            
+            cold_start = bench_cold_start(bot_module, mode, list(guilds), args.repeats)
+            engine["load"] = cold_start["load"]
+            engine["load_guild"] = cold_start["load_guild"]
+            engine["memory"] = cold_start["memory"]
+            engine.update(bench_operations(bot_module, mode, guilds, args, rng))
+            results["engines"][mode] = engine
+        
+        results["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    
+    print_report(results)
+    
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get("config") != results["config"]:
+            print(f"Warning: {args.compare} was recorded with a different config: {baseline.get('config')}")
+        regressions = compare(results, baseline, args.threshold, args.min_delta_ms)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        print(f"{len(regressions)} regression(s) against {args.compare} (threshold {args.threshold}x)")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark SplitwiseBot operations and storage engines on synthetic guilds, without Discord")
+    parser.add_argument("--guilds", type=int, default=10, help="synthetic guilds to create")
+    parser.add_argument("--members", type=int, default=8, help="members per guild")
+    parser.add_argument("--expenses", type=int, default=2000, help="expenses per guild")
+    parser.add_argument("--ops", type=int, default=200, help="timed calls per operation")
+    parser.add_argument("--pages", type=int, default=10, help="history pages walked per query")
+    parser.add_argument("--repeats", type=int, default=3, help="cold starts per engine")
+    parser.add_argument("--engines", default=",".join(ENGINES), help="comma-separated storage modes")
+    parser.add_argument("--checkpoint-every", type=int, default=500, help="journal checkpoint interval")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results as JSON, e.g. benchmarks/baseline.json")
+    parser.add_argument("--compare", help="baseline JSON to check for regressions; exits 1 if any are found")
+    parser.add_argument("--threshold", type=float, default=1.5, help="slowdown factor counted as a regression")
+    parser.add_argument("--min-delta-ms", type=float, default=0.1, help="smallest latency increase counted as a regression")
+    sys.exit(run(parser.parse_args()))
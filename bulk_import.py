@@ -0,0 +1,110 @@
+import csv
+import io
+import json
+import math
+import re
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from balances import to_cents
+
+MENTION_PATTERN = re.compile(r"<@!?(\d+)>")
+SEPARATOR_PATTERN = re.compile(r"[\s,;|]+")
+
+def parse_user(value) -> Optional[int]:
+    value = str(value).strip()
+    match = MENTION_PATTERN.fullmatch(value)
+    if match:
+        return int(match.group(1))
+    return int(value) if value.isdigit() else None
+
+def read_lines(text: str) -> List[Dict]:
+    # One expense per line: "<amount> <description>", e.g. "12.50 Pizza"
+    rows = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line:
+            amount, _, description = line.partition(" ")
+            rows.append({"amount": amount, "description": description})
+    return rows
+
+def read_csv(text: str) -> List[Dict]:
+    reader = csv.DictReader(io.StringIO(text))
+    return [{(key or "").strip().lower(): value for key, value in row.items()} for row in reader]
+
+def read_json(text: str) -> List[Dict]:
+    data = json.loads(text)
+    if isinstance(data, dict):
+        data = data.get("expenses")
+    if not isinstance(data, list):
+        raise ValueError("expected a list of expenses or an object with an \"expenses\" list")
+    return data
+
+def read_attachment(filename: str, text: str) -> Tuple[List[Dict], int]:
+    # Returns the raw rows and the number of the first one, for error messages
+    if filename.lower().endswith(".json"):
+        return read_json(text), 1
+    return read_csv(text), 2
+
+def validate_row(raw, default_payer_id: int, member_ids: List[int], now: int) -> Dict:
+    if not isinstance(raw, dict):
+        raise ValueError("expected an object")
+    
+    amount_text = str(raw.get("amount") or "").strip().lstrip("$").replace(",", "")
+    try:
+        amount = float(amount_text)
+    except ValueError:
+        raise ValueError(f"amount {amount_text!r} is not a number")
+    if not math.isfinite(amount) or to_cents(amount) <= 0:
+        raise ValueError("amount must be greater than 0")
+    
+    description = str(raw.get("description") or "").strip()
+    if not description:
+        raise ValueError("description is missing")
+    
+    payer_id = default_payer_id
+    payer = raw.get("payer") or raw.get("payer_id")
+    if payer:
+        payer_id = parse_user(payer)
+        if payer_id not in member_ids:
+            raise ValueError(f"payer {payer} is not in the group")
+    
+    split_with = member_ids
+    split = raw.get("split_with")
+    if split:
+        split_with = []
+        for user in split if isinstance(split, list) else SEPARATOR_PATTERN.split(str(split).strip()):
+            user_id = parse_user(user)
+            if user_id not in member_ids:
+                raise ValueError(f"{user} in split_with is not in the group")
+            if user_id not in split_with:
+                split_with.append(user_id)
+    
+    timestamp = now
+    date = raw.get("date") or raw.get("timestamp")
+    if date:
+        try:
+            timestamp = int(datetime.fromisoformat(str(date).strip()).timestamp())
+        except ValueError:
+            raise ValueError(f"date {date!r} is not YYYY-MM-DD or an ISO timestamp")
+    
+    return {
+        "payer_id": payer_id,
+        "amount_cents": to_cents(amount),
+        "description": description,
+        "split_with": split_with,
+        "timestamp": timestamp
+    }
+
+def validate_rows(raw_rows: List, default_payer_id: int, member_ids: List[int], first_row: int = 1) -> Tuple[List[Dict], List[str]]:
+    # Every row is checked before anything is applied, so an import either
+    # goes in whole or not at all
+    now = int(datetime.now().timestamp())
+    rows = []
+    errors = []
+    for number, raw in enumerate(raw_rows, first_row):
+        try:
+            rows.append(validate_row(raw, default_payer_id, member_ids, now))
+        except ValueError as e:
+            errors.append(f"Row {number}: {e}")
+    return rows, errors
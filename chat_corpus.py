@@ -0,0 +1,88 @@
+import math
+import os
+import random
+import re
+from collections import Counter
+from typing import Dict, List, Tuple
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+def estimate_tokens(text: str) -> int:
+    # Roughly four characters per token for English chat text
+    return len(text) // 4 + 1
+
+class ChatCorpus:
+    def __init__(self, path: str, k1: float = 1.5, b: float = 0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.stamp = None
+        self.lines: List[str] = []
+        self.lengths: List[int] = []
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        self.avg_length = 0.0
+    
+    def refresh(self):
+        stat = os.stat(self.path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp == self.stamp:
+            return
+        
+        with open(self.path, 'r', encoding='utf-8') as f:
+            lines = [line.strip().lstrip('-').strip() for line in f]
+        self.lines = [line for line in lines if line]
+        self.lengths = []
+        self.postings = {}
+        
+        for index, line in enumerate(self.lines):
+            counts = Counter(tokenize(line))
+            self.lengths.append(sum(counts.values()))
+            for token, count in counts.items():
+                self.postings.setdefault(token, []).append((index, count))
+        
+        self.avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        self.stamp = stamp
+    
+    def score(self, query: str) -> Dict[int, float]:
+        scores = {}
+        total = len(self.lines)
+        
+        for token in set(tokenize(query)):
+            postings = self.postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            for index, count in postings:
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[index] / self.avg_length)
+                scores[index] = scores.get(index, 0.0) + idf * count * (self.k1 + 1) / (count + norm)
+        
+        return scores
+    
+    def search(self, query: str, top_k: int, token_budget: int) -> List[str]:
+        self.refresh()
+        if not self.lines:
+            return []
+        
+        scores = self.score(query)
+        ranked = sorted(scores, key=lambda index: scores[index], reverse=True)[:top_k]
+        
+        # Pad with random lines so short or unmatched messages still get a
+        # sample of the texting style to imitate
+        if len(ranked) < top_k:
+            chosen = set(ranked)
+            rest = [index for index in range(len(self.lines)) if index not in chosen]
+            ranked += random.sample(rest, min(top_k - len(ranked), len(rest)))
+        
+        selected = []
+        used = 0
+        for index in ranked:
+            cost = estimate_tokens(self.lines[index])
+            if used + cost > token_budget:
+                continue
+            selected.append(index)
+            used += cost
+        
+        return [self.lines[index] for index in sorted(selected)]
@@ -0,0 +1,105 @@
+import json
+import os
+from typing import Dict, List, NotRequired, Optional, TypedDict
+
+# JSON_CODEC picks how the storage files are read and written: "auto" uses
+# msgspec or orjson when installed and the standard library otherwise.
+# All of them read and write the same files
+JSON_CODEC = os.getenv("JSON_CODEC", "auto")
+if JSON_CODEC not in ("auto", "msgspec", "orjson", "json"):
+    raise ValueError(f"JSON_CODEC must be auto, msgspec, orjson or json, not {JSON_CODEC!r}")
+
+msgspec = None
+orjson = None
+if JSON_CODEC in ("auto", "msgspec"):
+    try:
+        import msgspec
+    except ImportError:
+        if JSON_CODEC == "msgspec":
+            raise
+if JSON_CODEC in ("auto", "orjson") and msgspec is None:
+    try:
+        import orjson
+    except ImportError:
+        if JSON_CODEC == "orjson":
+            raise
+
+CODEC = "msgspec" if msgspec else "orjson" if orjson else "json"
+
+# Shapes of the stored files. msgspec decodes straight into them, turning
+# the string IDs into ints as it parses; the other codecs leave that to the
+# load_* converters, which accept either
+class ExpenseRow(TypedDict):
+    id: int
+    payer_id: int
+    amount: float
+    description: str
+    split_with: List[int]
+    timestamp: str
+    shares: NotRequired[Dict[int, float]]
+
+class RecurringRow(TypedDict):
+    id: int
+    payer_id: int
+    amount_cents: int
+    description: str
+    split_with: List[int]
+    interval: str
+    start: str
+    runs: int
+    channel_id: Optional[int]
+
+EXPENSES = Dict[str, List[ExpenseRow]]
+BALANCES = Dict[str, Dict[int, float]]
+GROUP_MEMBERS = Dict[str, List[int]]
+RECURRING = Dict[str, List[RecurringRow]]
+NEXT_EXPENSE_IDS = Dict[str, int]
+NEXT_RECURRING_IDS = Dict[str, int]
+
+GUILD_INDEX = List[str]
+
+class GuildData(TypedDict):
+    group_members: List[int]
+    balances: Dict[int, float]
+    expenses: List[ExpenseRow]
+    recurring: NotRequired[List[RecurringRow]]
+    next_expense_id: NotRequired[int]
+    next_recurring_id: NotRequired[int]
+
+class Snapshot(TypedDict):
+    seq: int
+    offset: NotRequired[int]
+    expenses: EXPENSES
+    balances: BALANCES
+    group_members: GROUP_MEMBERS
+    recurring: NotRequired[RECURRING]
+    next_expense_ids: NotRequired[NEXT_EXPENSE_IDS]
+    next_recurring_ids: NotRequired[NEXT_RECURRING_IDS]
+
+decoders = {}
+
+def loads(data: bytes, schema=None):
+    if msgspec:
+        if schema is None:
+            return msgspec.json.decode(data)
+        decoder = decoders.get(schema)
+        if decoder is None:
+            decoder = decoders[schema] = msgspec.json.Decoder(schema, strict=False)
+        return decoder.decode(data)
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps(data, indent: bool = False) -> bytes:
+    if msgspec:
+        encoded = msgspec.json.encode(data)
+        return msgspec.json.format(encoded, indent=2) if indent else encoded
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else 0)
+    if indent:
+        return json.dumps(data, indent=2).encode('utf-8')
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+def read_json(path: str, schema=None):
+    with open(path, 'rb') as f:
+        return loads(f.read(), schema)
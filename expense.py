@@ -0,0 +1,88 @@
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from balances import Roster, split_shares, to_cents
+
+def parse_timestamp(value: str) -> int:
+    return int(datetime.fromisoformat(value).timestamp())
+
+def format_timestamp(timestamp: int) -> str:
+    return datetime.fromtimestamp(timestamp).isoformat()
+
+class Expense:
+    # share_cents is set only for uneven splits, as {member: cents}; an
+    # equal split is worked out from the mask whenever it is needed
+    __slots__ = ("id", "payer_id", "amount_cents", "description", "split_mask", "roster", "timestamp", "share_cents")
+    
+    def __init__(
+        self, id: int, payer_id: int, amount_cents: int, description: str, split_mask: int, roster: Roster, timestamp: int,
+        share_cents: Optional[Dict[int, int]] = None
+    ):
+        self.id = id
+        self.payer_id = payer_id
+        self.amount_cents = amount_cents
+        self.description = description
+        self.split_mask = split_mask
+        self.roster = roster
+        self.timestamp = timestamp
+        self.share_cents = share_cents
+    
+    @classmethod
+    def from_dict(cls, data: Dict, roster: Roster) -> "Expense":
+        # Reads the stored JSON shape; per_person is derived, so it is dropped
+        shares = data.get('shares')
+        return cls(
+            data['id'],
+            int(data['payer_id']),
+            to_cents(data['amount']),
+            data['description'],
+            roster.stored_mask(data['split_with']),
+            roster,
+            parse_timestamp(data['timestamp']),
+            {int(user_id): to_cents(share) for user_id, share in shares.items()} if shares else None
+        )
+    
+    def to_dict(self) -> Dict:
+        data = {
+            "id": self.id,
+            "payer_id": str(self.payer_id),
+            "amount": self.amount,
+            "description": self.description,
+            "split_with": [str(user_id) for user_id in self.split_with],
+            "timestamp": format_timestamp(self.timestamp)
+        }
+        # An uneven split has no single per-person amount; its shares say
+        # what each member owes instead
+        if self.share_cents:
+            data["shares"] = {str(user_id): share / 100 for user_id, share in self.share_cents.items()}
+        else:
+            data["per_person"] = self.per_person
+        return data
+    
+    @property
+    def amount(self) -> float:
+        return self.amount_cents / 100
+    
+    @property
+    def split_with(self) -> List[int]:
+        return self.roster.members_of(self.split_mask)
+    
+    @property
+    def split_count(self) -> int:
+        return bin(self.split_mask).count("1")
+    
+    @property
+    def shares(self) -> List[Tuple[int, int]]:
+        # (member, cents owed) in user ID order. Equal splits rotate the
+        # leftover cents by expense ID, so the same expense always splits
+        # the same way whatever order split_with was listed in
+        if self.share_cents:
+            return sorted(self.share_cents.items())
+        split_with = sorted(self.split_with)
+        if not split_with:
+            return []
+        return list(zip(split_with, split_shares(self.amount_cents, len(split_with), self.id)))
+    
+    @property
+    def per_person(self) -> float:
+        return self.amount / self.split_count if self.split_mask else 0
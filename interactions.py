@@ -0,0 +1,81 @@
+import asyncio
+import time
+import weakref
+from contextlib import asynccontextmanager
+
+import discord
+
+from metrics import observe_ack, observe_command
+from tracing import span
+
+class GuildLocks:
+    # One lock per guild, so a guild's changes apply and reply in order
+    # while other guilds carry on. Locks are held weakly and go away once
+    # no command holds or waits on them
+    def __init__(self):
+        self.locks = weakref.WeakValueDictionary()
+    
+    def get(self, guild_id: str) -> asyncio.Lock:
+        lock = self.locks.get(guild_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self.locks[guild_id] = lock
+        return lock
+
+def interaction_age(interaction: discord.Interaction) -> float:
+    return (discord.utils.utcnow() - interaction.created_at).total_seconds()
+
+async def defer(interaction: discord.Interaction, ephemeral: bool = False):
+    # Acknowledges now and shows "thinking..."; the answer goes out later
+    # through reply()
+    if interaction.response.is_done():
+        return
+    with span("network", "defer"):
+        await interaction.response.defer(ephemeral=ephemeral, thinking=True)
+    interaction.extras["deferred_public"] = not ephemeral
+    observe_ack(interaction)
+
+async def reply(interaction: discord.Interaction, content: str = None, *, ephemeral: bool = False, **kwargs):
+    # Answers whether or not the interaction was deferred first
+    with span("network", "reply"):
+        if not interaction.response.is_done():
+            await interaction.response.send_message(content, ephemeral=ephemeral, **kwargs)
+            observe_ack(interaction)
+            return
+        
+        # The first followup takes the place of a public "thinking..." message,
+        # so drop it rather than posting a private answer in public
+        if interaction.extras.pop("deferred_public", False) and ephemeral:
+            await interaction.delete_original_response()
+        await interaction.followup.send(content, ephemeral=ephemeral, **kwargs)
+
+async def edit_message(interaction: discord.Interaction, **kwargs):
+    # Answers a component interaction by editing the message it came from
+    with span("network", "edit"):
+        await interaction.response.edit_message(**kwargs)
+    observe_ack(interaction)
+
+async def send_modal(interaction: discord.Interaction, modal: discord.ui.Modal):
+    with span("network", "modal"):
+        await interaction.response.send_modal(modal)
+    observe_ack(interaction)
+
+@asynccontextmanager
+async def observed(interaction: discord.Interaction):
+    # Times a button or modal callback and counts its failures the way the
+    # command tree does for slash commands; they are labelled by custom_id
+    interaction.extras["started"] = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        observe_command(interaction, failed=True)
+        raise
+    observe_command(interaction)
+
+async def report_failure(interaction: discord.Interaction):
+    # Tells the user a command broke instead of leaving them on "thinking..."
+    # or Discord's "did not respond"
+    try:
+        await reply(interaction, "❌ Something went wrong handling that, please try again", ephemeral=True)
+    except discord.HTTPException as e:
+        print(f"Error reporting a failed interaction: {e}")
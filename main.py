@@ -1,3 +1,7 @@
+import time
+# Taken before anything else is imported, so the startup report covers imports
+PROCESS_STARTED = time.perf_counter()
+
 import discord
 from discord import app_commands
 from discord.ext import commands
@@ -5,201 +9,886 @@ import logging
 from dotenv import load_dotenv
 import os
 from typing import Dict, List, Tuple, Optional
-from datetime import datetime
-import json
-from flask import Flask
-import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+import csv
+import bisect
+import gc
+import signal
+import sys
 import random
-import openai
-import aiohttp
+import asyncio
+import codec
+from balances import GuildBalances, Roster, to_cents
+from bulk_import import read_attachment, read_lines, validate_rows
+from chat_corpus import ChatCorpus
+from expense import Expense
+from interactions import GuildLocks, defer, edit_message, interaction_age, observed, reply, report_failure, send_modal
+from metrics import (
+    CHAT_REPLIES, GATEWAY_LATENCY, LOADED_EXPENSES, LOADED_GUILDS, OPENAI_LATENCY, OPENAI_TOKENS,
+    MeteredStorage, StartupTimer, observe_command
+)
+from recurring import INTERVALS as RECURRING_INTERVALS, RecurringExpense, RecurringScheduler, occurrence
+from rollups import GuildRollups
+from response_cache import ResponseCache, normalize_message
+from settlement import plan_settlements
+from sharding import parse_shard_ids, shard_for, shard_path
+from splits import SPLIT_TYPES, choose_split_type, parse_split, share_cents
+from tracing import Tracer, span
+from snapshot_cache import SnapshotCache
+from storage import (
+    JsonStorage, JournalStorage, SQLiteStorage, GuildFileStorage, MemoryStorage, ShardedStorage,
+    WriteBehindPersister, write_json_atomic
+)
+
+startup = StartupTimer(PROCESS_STARTED)
+startup.phase("imports")
 
 load_dotenv()
 token = os.getenv("DISCORD_TOKEN")
-openai.api_key = os.getenv("OPENAI_API_KEY")
 
 handler = logging.FileHandler(filename="discord.log", encoding="utf-8", mode="w")
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 
-bot = commands.Bot(command_prefix="/", intents=intents)
+# Unset runs one gateway connection. "auto" shards within one process using
+# the count Discord recommends. A number fixes the count, so the shards can
+# be spread over several processes that each run the SHARD_IDS they are
+# given (e.g. "0-3"; all of them by default) and keep every shard's guilds
+# in storage of its own
+SHARD_COUNT = os.getenv("SHARD_COUNT", "")
+if SHARD_COUNT not in ("", "auto") and not (SHARD_COUNT.isdigit() and int(SHARD_COUNT) > 0):
+    raise ValueError(f"SHARD_COUNT must be \"auto\" or a positive number, not {SHARD_COUNT!r}")
+FIXED_SHARD_COUNT = int(SHARD_COUNT) if SHARD_COUNT.isdigit() else None
+SHARD_IDS = parse_shard_ids(os.getenv("SHARD_IDS", ""), FIXED_SHARD_COUNT) if FIXED_SHARD_COUNT else None
+
+def serves_guild(guild_id) -> bool:
+    return SHARD_IDS is None or shard_for(guild_id, FIXED_SHARD_COUNT) in SHARD_IDS
+
+# TRACING=1 traces slash commands and mentions from startup, and /trace turns
+# it on or off while running. Traces slower than TRACE_SLOW_MS, and loop
+# stalls longer than TRACE_BLOCK_MS, are appended to TRACE_FILE. A trace
+# still open after TRACE_TIMEOUT_MS is closed and written as timed out
+tracer = Tracer(
+    os.getenv("TRACE_FILE", "traces.jsonl"),
+    enabled=os.getenv("TRACING", "0") == "1",
+    sample_rate=float(os.getenv("TRACE_SAMPLE_RATE", "1.0")),
+    profile_rate=float(os.getenv("TRACE_PROFILE_RATE", "0.0")),
+    slow_seconds=float(os.getenv("TRACE_SLOW_MS", "500")) / 1000,
+    block_seconds=float(os.getenv("TRACE_BLOCK_MS", "250")) / 1000,
+    timeout_seconds=float(os.getenv("TRACE_TIMEOUT_MS", "60000")) / 1000
+)
+
+class InstrumentedCommandTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        interaction.extras["started"] = time.perf_counter()
+        # Runs in the command's own task, so the trace covers its callback
+        interaction.extras["trace"] = tracer.start(f"/{interaction.command.qualified_name}" if interaction.command else "interaction")
+        return True
+    
+    async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
+        observe_command(interaction, failed=True)
+        await super().on_error(interaction, error)
+        await report_failure(interaction)
+        trace = interaction.extras.pop("trace", None)
+        if trace is not None:
+            trace.failed = True
+        tracer.finish(trace)
+
+class DiscordSplitBot(commands.AutoShardedBot if SHARD_COUNT else commands.Bot):
+    web_runner = None
+    
+    async def setup_hook(self):
+        startup.phase("login")
+        self.web_runner = await start_web_server()
+        
+        if WRITE_BEHIND:
+            splitwise.persister = WriteBehindPersister(
+                splitwise, splitwise.storage, FLUSH_INTERVAL, FLUSH_MAX_BATCH, on_flushed=splitwise.evict_cold_guilds
+            )
+            splitwise.persister.start()
+        
+        # Anything that fell due while the bot was down is posted on the
+        # scheduler's first pass
+        for guild_id, schedules in splitwise.recurring.items():
+            for recurring_id in schedules:
+                recurring_scheduler.schedule(guild_id, recurring_id)
+        recurring_scheduler.start()
+        
+        # TRACING=1 enables the tracer before there is a loop to watch
+        if tracer.enabled:
+            tracer.watchdog.start()
+        
+        # Render and most hosts stop the bot with SIGTERM; close cleanly so
+        # pending writes are flushed
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.close()))
+        except NotImplementedError:
+            pass
+        startup.phase("setup")
+    
+    async def close(self):
+        tracer.watchdog.stop()
+        await recurring_scheduler.close()
+        if self.web_runner is not None:
+            await self.web_runner.cleanup()
+            self.web_runner = None
+        if splitwise.persister is not None:
+            await splitwise.persister.close()
+            splitwise.persister = None
+        await super().close()
+
+shard_options = {"shard_count": FIXED_SHARD_COUNT, "shard_ids": SHARD_IDS} if FIXED_SHARD_COUNT else {}
+bot = DiscordSplitBot(command_prefix="/", intents=intents, tree_cls=InstrumentedCommandTree, **shard_options)
 
 EXPENSES_FILE = "expenses.json"
 BALANCES_FILE = "balances.json"
 GROUP_MEMBERS_FILE = "group_members.json"
+RECURRING_FILE = "recurring.json"
+NEXT_EXPENSE_IDS_FILE = "next_expense_ids.json"
+NEXT_RECURRING_IDS_FILE = "next_recurring_ids.json"
+
+# "json" rewrites the three files above on every change, "journal" appends one
+# event per change to the JOURNAL_FILE ledger and checkpoints to SNAPSHOT_FILE,
+# "sqlite" keeps everything in SQLITE_FILE and "guild_files" keeps one file per
+# guild in GUILD_DATA_DIR; the last two load guilds on demand
+STORAGE_MODE = os.getenv("STORAGE_MODE", "json")
+JOURNAL_FILE = "splitwise.journal"
+SNAPSHOT_FILE = "splitwise.snapshot.json"
+JOURNAL_CHECKPOINT_EVERY = int(os.getenv("JOURNAL_CHECKPOINT_EVERY", "500"))
+SQLITE_FILE = os.getenv("SQLITE_FILE", "splitwise.db")
+GUILD_DATA_DIR = os.getenv("GUILD_DATA_DIR", "guilds")
+
+# While the bot is running, changes are queued and written in batches by a
+# background task every FLUSH_INTERVAL seconds or once FLUSH_MAX_BATCH are queued
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "1") == "1"
+FLUSH_INTERVAL = float(os.getenv("FLUSH_INTERVAL", "1.0"))
+FLUSH_MAX_BATCH = int(os.getenv("FLUSH_MAX_BATCH", "100"))
+
+# Caps for on-demand engines; the least recently used guilds are dropped from
+# memory (they are already persisted) once either limit is exceeded
+MAX_LOADED_GUILDS = int(os.getenv("MAX_LOADED_GUILDS", "1000"))
+MAX_LOADED_EXPENSES = int(os.getenv("MAX_LOADED_EXPENSES", "500000"))
+
+def create_storage(mode: str):
+    if FIXED_SHARD_COUNT is None:
+        return MeteredStorage(create_engine(mode), mode)
+    
+    # The whole-state engines can't be split, so a fixed shard count needs
+    # one that stores guilds separately
+    if mode not in ("sqlite", "guild_files"):
+        raise ValueError(f"SHARD_COUNT={FIXED_SHARD_COUNT} needs STORAGE_MODE=sqlite or guild_files")
+    partitions = {shard: create_engine(mode, shard) for shard in SHARD_IDS}
+    return MeteredStorage(ShardedStorage(partitions, FIXED_SHARD_COUNT), mode)
+
+def create_engine(mode: str, shard: Optional[int] = None):
+    if mode == "journal":
+        return JournalStorage(JOURNAL_FILE, SNAPSHOT_FILE, JOURNAL_CHECKPOINT_EVERY)
+    if mode in ("sqlite", "guild_files") and shard is not None:
+        owns = lambda guild_id: shard_for(guild_id, FIXED_SHARD_COUNT) == shard
+        if mode == "sqlite":
+            return SQLiteStorage(shard_path(SQLITE_FILE, shard), owns)
+        return GuildFileStorage(shard_path(GUILD_DATA_DIR, shard), owns)
+    if mode == "sqlite":
+        return SQLiteStorage(SQLITE_FILE)
+    if mode == "guild_files":
+        return GuildFileStorage(GUILD_DATA_DIR)
+    return JsonStorage(EXPENSES_FILE, BALANCES_FILE, GROUP_MEMBERS_FILE, RECURRING_FILE, NEXT_EXPENSE_IDS_FILE, NEXT_RECURRING_IDS_FILE)
+
+def moving_average(average: float, sample: float, weight: float = 0.2) -> float:
+    if not average:
+        return sample
+    return average + weight * (sample - average)
 
 class SplitwiseBot:
-    def __init__(self):
-        self.expenses = self.load_expenses()
-        self.balances = self.load_balances()
-        self.group_members = self.load_group_members()
+    def __init__(self, storage=None):
+        self.storage = storage or create_storage(STORAGE_MODE)
+        self.persister = None
+        self.expenses = {}
+        self.balances = {}
+        self.group_members = {}
+        # Every guild's schedules stay in memory, even for guilds that are
+        # not loaded, so the scheduler can see them all
+        self.recurring = {}
+        self.rosters = {}
+        self.loaded_guilds = OrderedDict()
+        self.description_index = {}
+        self.timestamp_index = {}
+        self.rollups = {}
+        self.next_expense_ids = {}
+        self.next_recurring_ids = {}
+        self.guild_versions = {}
+        self.version_clock = 0
+        # Recent cost of loading a guild and of a synchronous save, used to
+        # guess whether a command will miss Discord's reply deadline
+        self.load_seconds = 0.0
+        self.save_seconds = 0.0
+        self.storage.load(self)
     
     def load_expenses(self) -> Dict:
         try:
-            with open(EXPENSES_FILE, 'r') as f:
-                data = json.load(f)
-                converted_data = {}
-                for guild_id, expenses in data.items():
-                    converted_expenses = []
-                    for expense in expenses:
-                        converted_expense = expense.copy()
-                        converted_expense['payer_id'] = int(expense['payer_id'])
-                        converted_expense['split_with'] = [int(user_id) for user_id in expense['split_with']]
-                        converted_expenses.append(converted_expense)
-                    converted_data[guild_id] = converted_expenses
-                return converted_data
+            return self.convert_expenses(codec.read_json(EXPENSES_FILE, codec.EXPENSES))
         except FileNotFoundError:
             return {}
     
-    def save_expenses(self):
+    def convert_expenses(self, data: Dict) -> Dict:
+        converted_data = {}
+        for guild_id, expenses in data.items():
+            roster = self.roster(guild_id)
+            converted_data[guild_id] = {expense['id']: Expense.from_dict(expense, roster) for expense in expenses}
+        return converted_data
+    
+    def serialize_expenses(self) -> Dict:
         serializable_expenses = {}
         for guild_id, expenses in self.expenses.items():
-            serializable_expenses[guild_id] = []
-            for expense in expenses:
-                serializable_expense = expense.copy()
-                serializable_expense['payer_id'] = str(expense['payer_id'])
-                serializable_expense['split_with'] = [str(user_id) for user_id in expense['split_with']]
-                serializable_expenses[guild_id].append(serializable_expense)
-        
-        with open(EXPENSES_FILE, 'w') as f:
-            json.dump(serializable_expenses, f, indent=2)
+            serializable_expenses[guild_id] = [expense.to_dict() for expense in expenses.values()]
+        return serializable_expenses
+    
+    def save_expenses(self):
+        write_json_atomic(EXPENSES_FILE, self.serialize_expenses(), indent=True)
     
     def load_balances(self) -> Dict:
         try:
-            with open(BALANCES_FILE, 'r') as f:
-                data = json.load(f)
-                converted_data = {}
-                for guild_id, balances in data.items():
-                    converted_data[guild_id] = {int(user_id): balance for user_id, balance in balances.items()}
-                return converted_data
+            return self.convert_balances(codec.read_json(BALANCES_FILE, codec.BALANCES))
         except FileNotFoundError:
             return {}
     
-    def save_balances(self):
+    def convert_balances(self, data: Dict) -> Dict:
+        converted_data = {}
+        for guild_id, balances in data.items():
+            converted_data[guild_id] = GuildBalances.from_dollars(balances, self.roster(guild_id))
+        return converted_data
+    
+    def serialize_balances(self) -> Dict:
         serializable_balances = {}
         for guild_id, balances in self.balances.items():
             serializable_balances[guild_id] = {str(user_id): balance for user_id, balance in balances.items()}
-        
-        with open(BALANCES_FILE, 'w') as f:
-            json.dump(serializable_balances, f, indent=2)
+        return serializable_balances
+    
+    def save_balances(self):
+        write_json_atomic(BALANCES_FILE, self.serialize_balances(), indent=True)
     
     def load_group_members(self) -> Dict:
         try:
-            with open(GROUP_MEMBERS_FILE, 'r') as f:
-                data = json.load(f)
-                converted_data = {}
-                for guild_id, members in data.items():
-                    converted_data[guild_id] = [int(member_id) for member_id in members]
-                return converted_data
+            return self.convert_group_members(codec.read_json(GROUP_MEMBERS_FILE, codec.GROUP_MEMBERS))
         except FileNotFoundError:
             return {}
     
-    def save_group_members(self):
+    def convert_group_members(self, data: Dict) -> Dict:
+        converted_data = {}
+        for guild_id, members in data.items():
+            converted_data[guild_id] = list(map(int, members))
+        return converted_data
+    
+    def serialize_group_members(self) -> Dict:
         serializable_members = {}
         for guild_id, members in self.group_members.items():
             serializable_members[guild_id] = [str(member_id) for member_id in members]
+        return serializable_members
+    
+    def save_group_members(self):
+        write_json_atomic(GROUP_MEMBERS_FILE, self.serialize_group_members(), indent=True)
+    
+    def load_recurring(self) -> Dict:
+        try:
+            return self.convert_recurring(codec.read_json(RECURRING_FILE, codec.RECURRING))
+        except FileNotFoundError:
+            return {}
+    
+    def convert_recurring(self, data: Dict) -> Dict:
+        converted_data = {}
+        for guild_id, schedules in data.items():
+            converted_data[guild_id] = {schedule['id']: RecurringExpense.from_dict(schedule) for schedule in schedules}
+        return converted_data
+    
+    def serialize_recurring(self) -> Dict:
+        serializable_recurring = {}
+        for guild_id, schedules in self.recurring.items():
+            serializable_recurring[guild_id] = [schedule.to_dict() for schedule in schedules.values()]
+        return serializable_recurring
+    
+    def load_next_expense_ids(self) -> Dict[str, int]:
+        try:
+            return dict(codec.read_json(NEXT_EXPENSE_IDS_FILE, codec.NEXT_EXPENSE_IDS))
+        except FileNotFoundError:
+            return {}
+    
+    def serialize_next_expense_ids(self) -> Dict[str, int]:
+        return dict(self.next_expense_ids)
+    
+    def load_next_recurring_ids(self) -> Dict[str, int]:
+        try:
+            return dict(codec.read_json(NEXT_RECURRING_IDS_FILE, codec.NEXT_RECURRING_IDS))
+        except FileNotFoundError:
+            return {}
+    
+    def serialize_next_recurring_ids(self) -> Dict[str, int]:
+        return dict(self.next_recurring_ids)
+    
+    def snapshot(self) -> Dict:
+        return {
+            "expenses": self.serialize_expenses(),
+            "balances": self.serialize_balances(),
+            "group_members": self.serialize_group_members(),
+            "recurring": self.serialize_recurring(),
+            "next_expense_ids": self.serialize_next_expense_ids(),
+            "next_recurring_ids": self.serialize_next_recurring_ids()
+        }
+    
+    def apply_record(self, record: Dict):
+        op = record['op']
+        guild_id = record['guild_id']
+        if op == "init_group":
+            self._apply_init_group(guild_id, [int(member_id) for member_id in record['member_ids']])
+        elif op == "reset_group":
+            self._apply_reset_group(guild_id)
+        elif op == "add_expense":
+            self._apply_add_expense(guild_id, Expense.from_dict(record['expense'], self.roster(guild_id)))
+        elif op == "add_expenses":
+            roster = self.roster(guild_id)
+            recurring_runs = {int(recurring_id): runs for recurring_id, runs in record.get('recurring_runs', {}).items()}
+            self._apply_add_expenses(guild_id, [Expense.from_dict(expense, roster) for expense in record['expenses']], recurring_runs)
+        elif op == "settle_debt":
+            self._apply_settle_debt(guild_id, int(record['from_user_id']), int(record['to_user_id']), record['amount'])
+        elif op == "remove_expense":
+            self._apply_remove_expense(guild_id, record['expense_id'])
+        elif op == "add_recurring":
+            self._apply_add_recurring(guild_id, RecurringExpense.from_dict(record['recurring']))
+        elif op == "remove_recurring":
+            self._apply_remove_recurring(guild_id, record['recurring_id'])
+        elif op == "import_guild":
+            self._apply_import_guild(guild_id, record)
+        else:
+            raise ValueError(f"Unknown journal op: {op}")
+    
+    def _apply_import_guild(self, guild_id: str, record: Dict):
+        self._apply_reset_group(guild_id)
+        if record['group_members']:
+            self.group_members[guild_id] = [int(member_id) for member_id in record['group_members']]
+        if record['balances']:
+            self.balances[guild_id] = GuildBalances.from_dollars(record['balances'], self.roster(guild_id))
+        if record['expenses']:
+            roster = self.roster(guild_id)
+            self.expenses[guild_id] = {expense['id']: Expense.from_dict(expense, roster) for expense in record['expenses']}
+        if record.get('recurring'):
+            self.recurring[guild_id] = {schedule['id']: RecurringExpense.from_dict(schedule) for schedule in record['recurring']}
+        if record.get('next_expense_id'):
+            self.next_expense_ids[guild_id] = record['next_expense_id']
+        if record.get('next_recurring_id'):
+            self.next_recurring_ids[guild_id] = record['next_recurring_id']
+    
+    def replay_ledger(self, until_seq: int) -> "SplitwiseBot":
+        # Rebuilds state from the ledger alone, streaming one event at a time
+        replayed = SplitwiseBot(storage=MemoryStorage())
+        for record, _ in self.storage.iter_events(until_seq=until_seq):
+            replayed.apply_record(record)
+        return replayed
+    
+    def ledger_drift(self, replayed: "SplitwiseBot", balances: Dict, expense_ids: Dict) -> Dict[str, List[str]]:
+        drift = {}
+        for guild_id in set(balances) | set(replayed.balances) | set(expense_ids) | set(replayed.expenses):
+            problems = []
+            expected = replayed.balances.get(guild_id, {})
+            actual = balances.get(guild_id, {})
+            for user_id in set(expected) | set(actual):
+                if to_cents(expected.get(user_id, 0)) != to_cents(actual.get(user_id, 0)):
+                    problems.append(
+                        f"<@{str(user_id)}> balance is ${actual.get(user_id, 0):.2f}, ledger says ${expected.get(user_id, 0):.2f}"
+                    )
+            
+            expected_ids = set(replayed.expenses.get(guild_id, {}))
+            actual_ids = expense_ids.get(guild_id, set())
+            if expected_ids - actual_ids:
+                problems.append(f"Missing expenses: {', '.join(f'#{i}' for i in sorted(expected_ids - actual_ids))}")
+            if actual_ids - expected_ids:
+                problems.append(f"Expenses not in ledger: {', '.join(f'#{i}' for i in sorted(actual_ids - expected_ids))}")
+            
+            if problems:
+                drift[guild_id] = problems
+        return drift
+    
+    async def verify_ledger(self) -> Dict[str, List[str]]:
+        if self.persister is not None:
+            for _ in range(3):
+                if not (self.persister.pending or self.persister.unwritten):
+                    break
+                await self.persister.flush()
+            else:
+                raise RuntimeError("Pending changes could not be written, try again later")
+        
+        # Captured with no await in between, so the live state matches the ledger up to until_seq
+        until_seq = self.storage.seq
+        balances = {guild_id: dict(guild_balances) for guild_id, guild_balances in self.balances.items()}
+        expense_ids = {guild_id: set(expenses) for guild_id, expenses in self.expenses.items()}
+        
+        replayed = await asyncio.get_running_loop().run_in_executor(None, self.replay_ledger, until_seq)
+        return self.ledger_drift(replayed, balances, expense_ids)
+    
+    def commit(self, record: Dict):
+        # Every mutation passes through here, so the version moves whenever a
+        # guild's state does. Versions come from one clock and survive
+        # eviction, so a reloaded guild never reuses an old version
+        self.version_clock += 1
+        self.guild_versions[record['guild_id']] = self.version_clock
+        
+        if self.persister is not None:
+            self.persister.submit(record)
+        else:
+            started = time.perf_counter()
+            with span("storage", f"save {record['op']}"):
+                self.storage.write(self.storage.prepare(self, [record]))
+            self.save_seconds = moving_average(self.save_seconds, time.perf_counter() - started)
+    
+    def guild_version(self, guild_id: str) -> int:
+        return self.guild_versions.get(str(guild_id), 0)
+    
+    def predicted_seconds(self, guild_id: str, writes: bool) -> float:
+        # Storage work the next command in this guild is likely to wait on:
+        # loading the guild if it isn't in memory, and a save unless writes
+        # are deferred to the persister
+        seconds = 0.0
+        if self.storage.lazy and str(guild_id) not in self.loaded_guilds:
+            seconds += self.load_seconds
+        if writes and self.persister is None:
+            seconds += self.save_seconds
+        return seconds
+    
+    def ensure_guild(self, guild_id: str):
+        if not self.storage.lazy:
+            return
+        if guild_id in self.loaded_guilds:
+            self.loaded_guilds.move_to_end(guild_id)
+            return
+        
+        started = time.perf_counter()
+        with span("storage", "load guild"):
+            self.storage.load_guild(self, guild_id)
+        self.load_seconds = moving_average(self.load_seconds, time.perf_counter() - started)
+        self.loaded_guilds[guild_id] = True
+        self.evict_cold_guilds()
+    
+    def evict_cold_guilds(self):
+        loaded_expenses = sum(len(self.expenses.get(guild_id, {})) for guild_id in self.loaded_guilds)
+        if len(self.loaded_guilds) <= MAX_LOADED_GUILDS and loaded_expenses <= MAX_LOADED_EXPENSES:
+            return
         
-        with open(GROUP_MEMBERS_FILE, 'w') as f:
-            json.dump(serializable_members, f, indent=2)
+        # Guilds with unwritten changes stay until they are flushed (the
+        # persister calls this again after each flush), and the most recent
+        # guild is the one being served
+        dirty = self.persister.dirty if self.persister is not None else set()
+        for guild_id in list(self.loaded_guilds)[:-1]:
+            if len(self.loaded_guilds) <= MAX_LOADED_GUILDS and loaded_expenses <= MAX_LOADED_EXPENSES:
+                break
+            if guild_id in dirty:
+                continue
+            del self.loaded_guilds[guild_id]
+            loaded_expenses -= len(self.expenses.get(guild_id, {}))
+            self.unload_guild(guild_id)
+    
+    def unload_guild(self, guild_id: str):
+        self.expenses.pop(guild_id, None)
+        self.balances.pop(guild_id, None)
+        self.group_members.pop(guild_id, None)
+        self.rosters.pop(guild_id, None)
+        self.description_index.pop(guild_id, None)
+        self.timestamp_index.pop(guild_id, None)
+        self.rollups.pop(guild_id, None)
+        self.next_expense_ids.pop(guild_id, None)
+        self.next_recurring_ids.pop(guild_id, None)
     
     def initialize_group(self, guild_id: str, member_ids: List[str]) -> Tuple[bool, str]:
         guild_id = str(guild_id)
+        self.ensure_guild(guild_id)
         
         member_ids_int = [int(member_id) for member_id in member_ids]
         
         if guild_id in self.group_members:
             return False, "Group already initialized. Use /reset to reinitialize."
         
+        self._apply_init_group(guild_id, member_ids_int)
+        self.commit({"op": "init_group", "guild_id": guild_id, "member_ids": [str(member_id) for member_id in member_ids_int]})
+        
+        return True, f"Group initialized with {len(member_ids_int)} members"
+    
+    def _apply_init_group(self, guild_id: str, member_ids_int: List[int]):
         self.group_members[guild_id] = member_ids_int
         
         if guild_id not in self.balances:
-            self.balances[guild_id] = {}
+            self.balances[guild_id] = GuildBalances(self.roster(guild_id))
         
         for member_id in member_ids_int:
-            self.balances[guild_id][member_id] = 0
+            self.balances[guild_id].set_cents(member_id, 0)
         
         if guild_id not in self.expenses:
-            self.expenses[guild_id] = []
-        
-        self.save_group_members()
-        self.save_balances()
-        
-        return True, f"Group initialized with {len(member_ids_int)} members"
+            self.expenses[guild_id] = {}
     
     def reset_group(self, guild_id: str) -> Tuple[bool, str]:
         guild_id = str(guild_id)
+        self.ensure_guild(guild_id)
         
         if guild_id not in self.group_members:
             return False, "Group not initialized. Use /init to initialize."
         
+        self._apply_reset_group(guild_id)
+        self.commit({"op": "reset_group", "guild_id": guild_id})
+        
+        return True, "Group reset successfully. Use /init to reinitialize."
+    
+    def _apply_reset_group(self, guild_id: str):
         if guild_id in self.group_members:
             del self.group_members[guild_id]
         if guild_id in self.balances:
             del self.balances[guild_id]
         if guild_id in self.expenses:
             del self.expenses[guild_id]
-        
-        self.save_group_members()
-        self.save_balances()
-        self.save_expenses()
-        
-        return True, "Group reset successfully. Use /init to reinitialize."
+        self.recurring.pop(guild_id, None)
+        self.rosters.pop(guild_id, None)
+        self.description_index.pop(guild_id, None)
+        self.timestamp_index.pop(guild_id, None)
+        self.rollups.pop(guild_id, None)
+        self.next_expense_ids.pop(guild_id, None)
+        self.next_recurring_ids.pop(guild_id, None)
     
     def get_group_members(self, guild_id: str) -> List[int]:
         guild_id = str(guild_id)
+        self.ensure_guild(guild_id)
         return self.group_members.get(guild_id, [])
     
+    def has_group(self, guild_id: str) -> bool:
+        # Like is_group_initialized, but asks storage rather than loading an
+        # unloaded guild
+        guild_id = str(guild_id)
+        if not self.storage.lazy or guild_id in self.loaded_guilds:
+            return bool(self.group_members.get(guild_id))
+        return self.storage.has_group(guild_id)
+    
     def is_group_initialized(self, guild_id: str) -> bool:
         guild_id = str(guild_id)
+        self.ensure_guild(guild_id)
         return guild_id in self.group_members and len(self.group_members[guild_id]) > 0
     
-    def add_expense(self, guild_id: str, payer_id: str, amount: float, description: str, split_with: List[str]):
+    def add_expense(
+        self, guild_id: str, payer_id: str, amount: float, description: str, split_with: List[str],
+        split_type: str = "equal", split_values: Optional[List] = None
+    ):
+        # split_values holds one number per split_with member for the
+        # "weights", "exact" and "percent" split types; see splits.share_cents
         guild_id = str(guild_id)
+        self.ensure_guild(guild_id)
         payer_id = int(payer_id)
+        split_with = [int(user_id) for user_id in split_with]
+        
+        roster = self.roster(guild_id)
+        expense_id = self.next_expense_id(guild_id)
+        amount_cents = to_cents(amount)
+        
+        expense = Expense(
+            expense_id,
+            payer_id,
+            amount_cents,
+            description,
+            roster.mask(split_with),
+            roster,
+            int(datetime.now().timestamp()),
+            share_cents(amount_cents, split_type, split_with, split_values, rotation=expense_id)
+        )
+        
+        self._apply_add_expense(guild_id, expense)
+        self.commit({"op": "add_expense", "guild_id": guild_id, "expense": expense.to_dict()})
+        return expense
+    
+    def _apply_add_expense(self, guild_id: str, expense: Expense):
+        if guild_id not in self.expenses:
+            self.expenses[guild_id] = {}
+        if guild_id not in self.balances:
+            self.balances[guild_id] = GuildBalances(self.roster(guild_id))
+        
+        self.expenses[guild_id][expense.id] = expense
+        self.next_expense_ids[guild_id] = max(self.next_expense_id(guild_id), expense.id + 1)
+        if guild_id in self.description_index:
+            self.description_index[guild_id].setdefault(expense.description.lower(), []).append(expense.id)
+        if guild_id in self.timestamp_index:
+            bisect.insort(self.timestamp_index[guild_id], (expense.timestamp, expense.id))
+        if guild_id in self.rollups:
+            self.rollups[guild_id].add(expense)
+        
+        self.balances[guild_id].apply_split(expense.payer_id, expense.amount_cents, expense.shares)
+    
+    def add_expenses(self, guild_id: str, rows: List[Dict], recurring_runs: Optional[Dict[int, int]] = None) -> List[Expense]:
+        # rows come from bulk_import.validate_rows; the whole batch is one
+        # record, so it is persisted in a single write. recurring_runs moves
+        # schedules on in that same record, so a restart can neither repeat
+        # nor skip what they posted
+        guild_id = str(guild_id)
+        self.ensure_guild(guild_id)
+        roster = self.roster(guild_id)
+        first_id = self.next_expense_id(guild_id)
+        
+        expenses = [
+            Expense(
+                first_id + offset,
+                row['payer_id'],
+                row['amount_cents'],
+                row['description'],
+                roster.mask(row['split_with']),
+                roster,
+                row['timestamp'],
+                row.get('share_cents')
+            )
+            for offset, row in enumerate(rows)
+        ]
         
+        self._apply_add_expenses(guild_id, expenses, recurring_runs)
+        record = {"op": "add_expenses", "guild_id": guild_id, "expenses": [expense.to_dict() for expense in expenses]}
+        if recurring_runs:
+            record['recurring_runs'] = {str(recurring_id): runs for recurring_id, runs in recurring_runs.items()}
+        self.commit(record)
+        return expenses
+    
+    def _apply_add_expenses(self, guild_id: str, expenses: List[Expense], recurring_runs: Optional[Dict[int, int]] = None):
+        for recurring_id, runs in (recurring_runs or {}).items():
+            self.recurring[guild_id][recurring_id].runs = runs
+        if not expenses:
+            return
         if guild_id not in self.expenses:
-            self.expenses[guild_id] = []
+            self.expenses[guild_id] = {}
         if guild_id not in self.balances:
-            self.balances[guild_id] = {}
-        
-        split_with_ints = [int(user_id) for user_id in split_with]
-        
-        expense = {
-            "id": len(self.expenses[guild_id]) + 1,
-            "payer_id": payer_id,
-            "amount": amount,
-            "description": description,
-            "split_with": split_with_ints,
-            "timestamp": datetime.now().isoformat(),
-            "per_person": amount / len(split_with_ints) if split_with_ints else 0
-        }
+            self.balances[guild_id] = GuildBalances(self.roster(guild_id))
         
-        self.expenses[guild_id].append(expense)
+        guild_expenses = self.expenses[guild_id]
+        for expense in expenses:
+            guild_expenses[expense.id] = expense
+        self.next_expense_ids[guild_id] = max(self.next_expense_id(guild_id), expenses[-1].id + 1)
         
-        if payer_id not in self.balances[guild_id]:
-            self.balances[guild_id][payer_id] = 0
-        self.balances[guild_id][payer_id] += amount
+        # Cheaper to rebuild the lookup indexes on next use than to insert
+        # thousands of rows into them one at a time
+        self.description_index.pop(guild_id, None)
+        self.timestamp_index.pop(guild_id, None)
+        if guild_id in self.rollups:
+            for expense in expenses:
+                self.rollups[guild_id].add(expense)
         
-        for person_id in split_with_ints:
-            if person_id not in self.balances[guild_id]:
-                self.balances[guild_id][person_id] = 0
-            self.balances[guild_id][person_id] -= expense["per_person"]
+        self.balances[guild_id].apply_splits(
+            (expense.payer_id, expense.amount_cents, expense.shares) for expense in expenses
+        )
+    
+    def add_recurring(
+        self, guild_id: str, payer_id: int, amount: float, description: str, split_with: List[int],
+        interval: str, start: int, channel_id: Optional[int] = None
+    ) -> RecurringExpense:
+        guild_id = str(guild_id)
+        self.ensure_guild(guild_id)
+        recurring = RecurringExpense(
+            self.next_recurring_id(guild_id),
+            int(payer_id),
+            to_cents(amount),
+            description,
+            [int(user_id) for user_id in split_with],
+            interval,
+            start,
+            channel_id=channel_id
+        )
         
-        self.save_expenses()
-        self.save_balances()
-        return expense
+        self._apply_add_recurring(guild_id, recurring)
+        self.commit({"op": "add_recurring", "guild_id": guild_id, "recurring": recurring.to_dict()})
+        return recurring
+    
+    def _apply_add_recurring(self, guild_id: str, recurring: RecurringExpense):
+        self.recurring.setdefault(guild_id, {})[recurring.id] = recurring
+        self.next_recurring_ids[guild_id] = max(self.next_recurring_id(guild_id), recurring.id + 1)
+    
+    def remove_recurring(self, guild_id: str, recurring_id: int) -> Optional[RecurringExpense]:
+        guild_id = str(guild_id)
+        self.ensure_guild(guild_id)
+        recurring = self.recurring.get(guild_id, {}).get(recurring_id)
+        if recurring is None:
+            return None
+        
+        self._apply_remove_recurring(guild_id, recurring_id)
+        self.commit({"op": "remove_recurring", "guild_id": guild_id, "recurring_id": recurring_id})
+        return recurring
+    
+    def _apply_remove_recurring(self, guild_id: str, recurring_id: int):
+        # Pins the counter first, as _apply_remove_expense does
+        self.next_recurring_id(guild_id)
+        schedules = self.recurring[guild_id]
+        del schedules[recurring_id]
+        if not schedules:
+            del self.recurring[guild_id]
+    
+    def get_recurring(self, guild_id: str) -> List[RecurringExpense]:
+        return list(self.recurring.get(str(guild_id), {}).values())
+    
+    def recurring_due(self, guild_id: str, recurring_id: int) -> Optional[int]:
+        recurring = self.recurring.get(guild_id, {}).get(recurring_id)
+        return recurring.next_due if recurring else None
+    
+    def post_recurring(self, guild_id: str, recurring_ids: List[int], now: int, max_rows: int) -> List[Tuple[RecurringExpense, List[Expense]]]:
+        # Adds every occurrence due by now, including runs missed while the
+        # bot was down, each dated when it fell due. Anything over max_rows
+        # is left due for the scheduler's next pass
+        guild_id = str(guild_id)
+        self.ensure_guild(guild_id)
+        schedules = self.recurring.get(guild_id, {})
+        rows = []
+        posted = []
+        recurring_runs = {}
+        for recurring_id in recurring_ids:
+            recurring = schedules.get(recurring_id)
+            if recurring is None:
+                continue
+            runs = recurring.runs
+            while len(rows) < max_rows and occurrence(recurring.start, recurring.interval, runs) <= now:
+                rows.append({
+                    "payer_id": recurring.payer_id,
+                    "amount_cents": recurring.amount_cents,
+                    "description": recurring.description,
+                    "split_with": recurring.split_with,
+                    "timestamp": occurrence(recurring.start, recurring.interval, runs)
+                })
+                runs += 1
+            if runs != recurring.runs:
+                posted.append((recurring, runs - recurring.runs))
+                recurring_runs[recurring_id] = runs
+        
+        if not rows:
+            return []
+        expenses = self.add_expenses(guild_id, rows, recurring_runs)
+        
+        batches = []
+        for recurring, count in posted:
+            batches.append((recurring, expenses[:count]))
+            expenses = expenses[count:]
+        return batches
     
     def get_balances(self, guild_id: str) -> Dict:
         guild_id = str(guild_id)
+        self.ensure_guild(guild_id)
         balances = self.balances.get(guild_id, {})
         return balances
     
     def get_expenses(self, guild_id: str) -> List:
         guild_id = str(guild_id)
-        return self.expenses.get(guild_id, [])
+        self.ensure_guild(guild_id)
+        return list(self.expenses.get(guild_id, {}).values())
+    
+    def get_expense(self, guild_id: str, expense_id: int) -> Optional[Expense]:
+        guild_id = str(guild_id)
+        self.ensure_guild(guild_id)
+        return self.expenses.get(guild_id, {}).get(expense_id)
+    
+    def next_expense_id(self, guild_id: str) -> int:
+        # IDs are handed out once and never renumbered, and the counter is
+        # stored with the guild, so removing the newest expense doesn't free
+        # its ID. Only data saved before the counter was falls back to the
+        # highest stored ID
+        if guild_id not in self.next_expense_ids:
+            self.next_expense_ids[guild_id] = max(self.expenses.get(guild_id, {}), default=0) + 1
+        return self.next_expense_ids[guild_id]
+    
+    def next_recurring_id(self, guild_id: str) -> int:
+        # Schedule IDs are kept the same way, so /recurring remove never
+        # frees an ID for the next schedule
+        if guild_id not in self.next_recurring_ids:
+            self.next_recurring_ids[guild_id] = max(self.recurring.get(guild_id, {}), default=0) + 1
+        return self.next_recurring_ids[guild_id]
+    
+    def roster(self, guild_id: str) -> Roster:
+        # One roster per guild, shared by its balances and all of its
+        # expenses' split masks
+        if guild_id not in self.rosters:
+            self.rosters[guild_id] = Roster()
+        return self.rosters[guild_id]
+    
+    def get_description_index(self, guild_id: str) -> Dict[str, List[int]]:
+        if guild_id not in self.description_index:
+            index = {}
+            for expense_id, expense in self.expenses.get(guild_id, {}).items():
+                index.setdefault(expense.description.lower(), []).append(expense_id)
+            self.description_index[guild_id] = index
+        return self.description_index[guild_id]
+    
+    def get_timestamp_index(self, guild_id: str) -> List[Tuple[int, int]]:
+        if guild_id not in self.timestamp_index:
+            self.timestamp_index[guild_id] = sorted(
+                (expense.timestamp, expense_id) for expense_id, expense in self.expenses.get(guild_id, {}).items()
+            )
+        return self.timestamp_index[guild_id]
+    
+    def get_rollups(self, guild_id: str) -> GuildRollups:
+        # Built from the history once per load, then kept up to date by the
+        # _apply_* methods
+        guild_id = str(guild_id)
+        self.ensure_guild(guild_id)
+        if guild_id not in self.rollups:
+            self.rollups[guild_id] = GuildRollups.from_expenses(self.expenses.get(guild_id, {}).values())
+        return self.rollups[guild_id]
+    
+    def query_expenses(
+        self,
+        guild_id: str,
+        before: Optional[Tuple[int, int]] = None,
+        limit: int = 10,
+        payer_id: Optional[int] = None,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        min_amount: Optional[float] = None,
+        max_amount: Optional[float] = None
+    ) -> Tuple[List[Expense], Optional[Tuple[int, int]]]:
+        # Walks the timestamp index newest-first from the cursor, so a page only
+        # touches the entries it returns plus any that the filters skip.
+        # start is inclusive and end exclusive, both epoch seconds.
+        guild_id = str(guild_id)
+        self.ensure_guild(guild_id)
+        expenses = self.expenses.get(guild_id, {})
+        index = self.get_timestamp_index(guild_id)
+        
+        upper = len(index)
+        if end is not None:
+            upper = bisect.bisect_left(index, (end,))
+        if before is not None:
+            upper = min(upper, bisect.bisect_left(index, before))
+        lower = bisect.bisect_left(index, (start,)) if start is not None else 0
+        
+        page = []
+        position = upper - 1
+        while position >= lower:
+            expense = expenses[index[position][1]]
+            position -= 1
+            if payer_id is not None and expense.payer_id != payer_id:
+                continue
+            if min_amount is not None and expense.amount < min_amount:
+                continue
+            if max_amount is not None and expense.amount > max_amount:
+                continue
+            if len(page) == limit:
+                return page, (page[-1].timestamp, page[-1].id)
+            page.append(expense)
+        
+        return page, None
+    
+    def find_expense(self, guild_id: str, expense_ref: str) -> Tuple[Optional[Expense], int]:
+        expense_ref = expense_ref.strip()
+        expenses = self.expenses.get(guild_id, {})
+        
+        id_text = expense_ref[1:] if expense_ref.startswith('#') else expense_ref
+        if id_text.isdigit() and int(id_text) in expenses:
+            return expenses[int(id_text)], 0
+        if expense_ref.startswith('#'):
+            return None, 0
+        
+        # Duplicate descriptions resolve to the oldest match; the caller is
+        # told how many others share it so they can pick one by ID
+        matches = self.get_description_index(guild_id).get(expense_ref.lower(), [])
+        if not matches:
+            return None, 0
+        return expenses[matches[0]], len(matches) - 1
     
     def settle_debt(self, guild_id: str, from_user_id: str, to_user_id: str, amount: float):
         guild_id = str(guild_id)
+        self.ensure_guild(guild_id)
         from_user_id = int(from_user_id)
         to_user_id = int(to_user_id)
         
@@ -209,84 +898,170 @@ class SplitwiseBot:
         if from_user_id not in self.balances[guild_id] or to_user_id not in self.balances[guild_id]:
             return False, "One or both users not found in balances"
         
-        from_balance = self.balances[guild_id][from_user_id]
-        to_balance = self.balances[guild_id][to_user_id]
+        from_balance = self.balances[guild_id].get_cents(from_user_id)
+        to_balance = self.balances[guild_id].get_cents(to_user_id)
         
         if from_balance >= 0:
-            return False, f"<@{str(from_user_id)}> doesn't owe any money (balance: ${from_balance:.2f})"
+            return False, f"<@{str(from_user_id)}> doesn't owe any money (balance: ${from_balance / 100:.2f})"
         
         if to_balance <= 0:
-            return False, f"<@{str(to_user_id)}> isn't owed any money (balance: ${to_balance:.2f})"
+            return False, f"<@{str(to_user_id)}> isn't owed any money (balance: ${to_balance / 100:.2f})"
         
-        max_settlement = min(abs(from_balance), to_balance)
+        max_settlement = min(-from_balance, to_balance)
         
-        if amount > max_settlement:
-            return False, f"Amount too high. Maximum settlement possible: ${max_settlement:.2f}"
+        if to_cents(amount) <= 0:
+            return False, "Amount must be at least $0.01"
         
-        self.balances[guild_id][from_user_id] += amount
-        self.balances[guild_id][to_user_id] -= amount
+        if to_cents(amount) > max_settlement:
+            return False, f"Amount too high. Maximum settlement possible: ${max_settlement / 100:.2f}"
         
-        self.save_balances()
+        self._apply_settle_debt(guild_id, from_user_id, to_user_id, amount)
+        self.commit({"op": "settle_debt", "guild_id": guild_id, "from_user_id": str(from_user_id), "to_user_id": str(to_user_id), "amount": amount})
         return True, f"Settled ${amount:.2f} from <@{str(from_user_id)}> to <@{str(to_user_id)}>"
     
-    def remove_expense(self, guild_id: str, description: str) -> Tuple[bool, str]:
+    def _apply_settle_debt(self, guild_id: str, from_user_id: int, to_user_id: int, amount: float):
+        amount_cents = to_cents(amount)
+        self.balances[guild_id].add_cents(from_user_id, amount_cents)
+        self.balances[guild_id].add_cents(to_user_id, -amount_cents)
+    
+    def remove_expense(self, guild_id: str, expense_ref: str) -> Tuple[bool, str]:
         guild_id = str(guild_id)
+        self.ensure_guild(guild_id)
         
         if guild_id not in self.expenses:
             return False, "No expenses found for this server"
         
-        expense_to_remove = None
-        expense_index = -1
-        
-        for i, expense in enumerate(self.expenses[guild_id]):
-            if expense['description'].lower() == description.lower():
-                expense_to_remove = expense
-                expense_index = i
-                break
+        expense_to_remove, others = self.find_expense(guild_id, expense_ref)
         
         if not expense_to_remove:
-            return False, f"No expense found with description: {description}"
-        
-        payer_id = int(expense_to_remove['payer_id'])
-        split_with = [int(user_id) for user_id in expense_to_remove['split_with']]
-        amount = expense_to_remove['amount']
-        per_person = expense_to_remove['per_person']
+            return False, f"No expense found with ID or description: {expense_ref}"
         
-        if payer_id in self.balances[guild_id]:
-            self.balances[guild_id][payer_id] -= amount
+        self._apply_remove_expense(guild_id, expense_to_remove.id)
+        self.commit({"op": "remove_expense", "guild_id": guild_id, "expense_id": expense_to_remove.id})
         
-        for person_id in split_with:
-            if person_id in self.balances[guild_id]:
-                self.balances[guild_id][person_id] += per_person
+        message = f"Removed expense #{expense_to_remove.id}: {expense_to_remove.description} (${expense_to_remove.amount:.2f})"
+        if others:
+            message += f"\n{others} more expense(s) share this description; use /clear with an ID to pick one"
+        return True, message
+    
+    def _apply_remove_expense(self, guild_id: str, expense_id: int):
+        # Pins the counter first, in case this is the highest ID
+        self.next_expense_id(guild_id)
+        expense_to_remove = self.expenses[guild_id].pop(expense_id)
         
-        self.expenses[guild_id].pop(expense_index)
+        # The same shares as when the expense was added, so every remainder
+        # cent comes back off the member it was charged to
+        self.balances[guild_id].apply_split(
+            expense_to_remove.payer_id, expense_to_remove.amount_cents, expense_to_remove.shares, sign=-1
+        )
         
-        for i, expense in enumerate(self.expenses[guild_id]):
-            expense['id'] = i + 1
+        if guild_id in self.description_index:
+            key = expense_to_remove.description.lower()
+            ids = self.description_index[guild_id][key]
+            ids.remove(expense_id)
+            if not ids:
+                del self.description_index[guild_id][key]
         
-        self.save_expenses()
-        self.save_balances()
+        if guild_id in self.timestamp_index:
+            index = self.timestamp_index[guild_id]
+            position = bisect.bisect_left(index, (expense_to_remove.timestamp, expense_id))
+            del index[position]
         
-        return True, f"Removed expense: {expense_to_remove['description']} (${amount:.2f})"
+        if guild_id in self.rollups:
+            self.rollups[guild_id].remove(expense_to_remove)
+
+def load_state() -> SplitwiseBot:
+    # Loading allocates an object or more per stored expense and frees
+    # almost nothing, so collection passes in the middle of it are wasted.
+    # Collection is process-wide, so it is only paused here, before the
+    # event loop and its worker threads exist
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return SplitwiseBot()
+    finally:
+        if was_enabled:
+            gc.enable()
+
+splitwise = load_state()
+startup.phase("load state")
+
+GATEWAY_LATENCY.set_function(lambda: bot.latency)
+LOADED_GUILDS.set_function(lambda: len(set(splitwise.group_members) | set(splitwise.expenses)))
+LOADED_EXPENSES.set_function(lambda: sum(len(expenses) for expenses in list(splitwise.expenses.values())))
+
+WEB_PORT = int(os.getenv("PORT", "10000"))
+# The read-only /guilds endpoints need "Authorization: Bearer <API_TOKEN>"
+# and are not served at all while it is unset
+API_TOKEN = os.getenv("API_TOKEN")
+API_MAX_PAGE_SIZE = 100
+SNAPSHOT_CACHE_SIZE = int(os.getenv("SNAPSHOT_CACHE_SIZE", "512"))
+http_api = None
+
+async def start_web_server():
+    global http_api
+    from web_api import WebAPI
+    http_api = WebAPI(
+        splitwise, response_cache, serves_guild, API_TOKEN,
+        HISTORY_PAGE_SIZE, API_MAX_PAGE_SIZE, SNAPSHOT_CACHE_SIZE
+    )
+    return await http_api.start(WEB_PORT)
 
-splitwise = SplitwiseBot()
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "10"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "4"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "10"))
 
-app = Flask(__name__)
+CHAT_LOG_FILE = os.getenv("CHAT_LOG_FILE", "chats.txt")
+CHAT_CONTEXT_TOP_K = int(os.getenv("CHAT_CONTEXT_TOP_K", "20"))
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.getenv("CHAT_CONTEXT_TOKEN_BUDGET", "300"))
 
-@app.route('/')
-def health_check():
-    return "Bot is running!", 200
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "256"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "300"))
 
-def run_flask():
-    app.run(host='0.0.0.0', port=10000)
+chat_corpus = ChatCorpus(CHAT_LOG_FILE)
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+openai_client = None
+openai_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
 
-flask_thread = threading.Thread(target=run_flask)
-flask_thread.daemon = True
-flask_thread.start()
+def get_openai_client():
+    global openai_client
+    if openai_client is None:
+        # The SDK takes over half a second to import, so it waits for the
+        # first mention instead of holding up startup
+        import httpx
+        import openai
+        openai_client = openai.AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            timeout=OPENAI_TIMEOUT,
+            max_retries=1,
+            http_client=openai.DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=OPENAI_MAX_CONNECTIONS,
+                    max_keepalive_connections=OPENAI_MAX_CONNECTIONS
+                )
+            )
+        )
+    return openai_client
+
+@bot.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    observe_command(interaction)
+    tracer.finish(interaction.extras.pop("trace", None))
 
 @bot.event
 async def on_ready():
     print(f"{bot.user} has connected to Discord!")
+    # on_ready fires again after a session is lost and resumed; only the
+    # first one ends startup
+    if not startup.finished:
+        startup.phase("connect")
+        startup.finish()
+    if SHARD_IDS is not None:
+        print(f"Running shard(s) {', '.join(map(str, SHARD_IDS))} of {FIXED_SHARD_COUNT}")
+        # Commands are global, so one process syncing them is enough
+        if 0 not in SHARD_IDS:
+            return
     try:
         synced = await bot.tree.sync()
         print(f"Synced {len(synced)} command(s)")
@@ -294,38 +1069,65 @@ async def on_ready():
         print(e)
 
 async def generate_chat_response(user_name: str, user_message: str) -> str:
+    # Failures are not cached, so every waiter on a failed request falls back
+    # and the next mention retries
     try:
-        with open('chats.txt', 'r', encoding='utf-8') as f:
-            chat_content = f.read()
-        
-        prompt = f"""Based on this chat log, generate a funny 1-sentence response that someone with this texting style and slang would say. The response should be directed at {user_name} and should match the casual, slang-heavy tone of the chat.
+        response = await response_cache.get_or_create(
+            (normalize_message(user_message), user_name),
+            lambda: request_chat_response(user_name, user_message)
+        )
+        CHAT_REPLIES.labels("model").inc()
+        return response
+    except asyncio.TimeoutError:
+        print(f"Error generating response: timed out after {OPENAI_TIMEOUT}s")
+    except Exception as e:
+        print(f"Error generating response: {e}")
+    CHAT_REPLIES.labels("fallback").inc()
+    return random.choice(fallback_responses(user_name))
+
+async def request_chat_response(user_name: str, user_message: str) -> str:
+    chat_content = "\n".join(chat_corpus.search(user_message, CHAT_CONTEXT_TOP_K, CHAT_CONTEXT_TOKEN_BUDGET))
+    
+    prompt = f"""Based on this chat log, generate a funny 1-sentence response that someone with this texting style and slang would say. The response should be directed at {user_name} and should match the casual, slang-heavy tone of the chat.
 
 User's message: "{user_message}"
 
 Chat content: {chat_content}
 
 Generate a funny response to what {user_name} said:"""
-        
-        client = openai.OpenAI()
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You are a gen-z slang bot that generates responses in the style of the chat log. Keep responses as a 18 year old tuff teenager would say,casual, use slang, don't surround your response in quotes, don't use any emojis, say goofy shit, be freaky, dont use proper grammar, be sus, say slang like bro or use the ninja emoji often to refer to people, don't be too serious."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=50,
-            temperature=0.8
-        )
-        
-        return response.choices[0].message.content.strip()
-    except Exception as e:
-        print(f"Error generating response: {e}")
-        fallback_responses = [
-            f"Hi {user_name}, I love khicidi!",
-            f"Sorry can't talk right now {user_name}, I have to go to Pennsylvania.",
-            f"Alc? Did {user_name} say Alc???"
-        ]
-        return random.choice(fallback_responses)
+    
+    response = await asyncio.wait_for(
+        create_completion([
+            {"role": "system", "content": "You are a gen-z slang bot that generates responses in the style of the chat log. Keep responses as a 18 year old tuff teenager would say,casual, use slang, don't surround your response in quotes, don't use any emojis, say goofy shit, be freaky, dont use proper grammar, be sus, say slang like bro or use the ninja emoji often to refer to people, don't be too serious."},
+            {"role": "user", "content": prompt}
+        ]),
+        timeout=OPENAI_TIMEOUT
+    )
+    
+    return response.choices[0].message.content.strip()
+
+async def create_completion(messages: List[Dict]):
+    # The semaphore wait counts against the caller's timeout, so a burst of
+    # mentions queues briefly and then falls back instead of piling up
+    async with openai_semaphore:
+        with OPENAI_LATENCY.time(), span("network", "openai"):
+            response = await get_openai_client().chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=messages,
+                max_tokens=50,
+                temperature=0.8
+            )
+    if response.usage is not None:
+        OPENAI_TOKENS.labels("prompt").inc(response.usage.prompt_tokens)
+        OPENAI_TOKENS.labels("completion").inc(response.usage.completion_tokens)
+    return response
+
+def fallback_responses(user_name: str) -> List[str]:
+    return [
+        f"Hi {user_name}, I love khicidi!",
+        f"Sorry can't talk right now {user_name}, I have to go to Pennsylvania.",
+        f"Alc? Did {user_name} say Alc???"
+    ]
 
 @bot.event
 async def on_message(message):
@@ -333,11 +1135,54 @@ async def on_message(message):
         return
     
     if bot.user.mentioned_in(message):
-        response = await generate_chat_response(message.author.display_name, message.content)
-        await message.channel.send(response)
+        trace = tracer.start("on_message")
+        try:
+            response = await generate_chat_response(message.author.display_name, message.content)
+            with span("network", "send"):
+                await message.channel.send(response)
+        finally:
+            tracer.finish(trace)
     
     await bot.process_commands(message)
 
+# Commands expected to reply later than this after the interaction was created
+# defer first; Discord drops interactions not acknowledged within 3 seconds
+DEFER_AFTER = float(os.getenv("DEFER_AFTER", "1.5"))
+guild_locks = GuildLocks()
+
+async def defer_if_slow(interaction: discord.Interaction, expected_seconds: float = 0.0, writes: bool = False):
+    seconds = interaction_age(interaction) + expected_seconds + splitwise.predicted_seconds(interaction.guild_id, writes)
+    if seconds > DEFER_AFTER:
+        await defer(interaction)
+
+# Rendered /check and /history replies, reused until the guild next changes
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "512"))
+embed_cache = SnapshotCache(EMBED_CACHE_SIZE)
+
+def cached_render(guild_id: int, key: Tuple, build):
+    # Cached embeds are shared between replies, so they are sent as built
+    # and never modified afterwards
+    version = splitwise.guild_version(guild_id)
+    key = (str(guild_id),) + key
+    rendered = embed_cache.get(key, version)
+    if rendered is None:
+        with span("render", key[1]):
+            rendered = build()
+        embed_cache.put(key, version, rendered)
+    return rendered
+
+@asynccontextmanager
+async def guild_write(interaction: discord.Interaction, expected_seconds: float = 0.0):
+    # Runs a command that changes a guild under that guild's lock. How long
+    # another command holds it is unknown, so waiting for it always defers
+    lock = guild_locks.get(str(interaction.guild_id))
+    if lock.locked():
+        await defer(interaction)
+    else:
+        await defer_if_slow(interaction, expected_seconds, writes=True)
+    async with lock:
+        yield
+
 @bot.tree.command(name="init", description="Initialize the group with all members")
 @app_commands.describe(
     members="Mention all members in the group"
@@ -356,96 +1201,212 @@ async def initialize_group(interaction: discord.Interaction, members: str):
         member_ids.append(command_user_id)
     
     if len(member_ids) < 2:
-        await interaction.response.send_message("❌ Please mention at least one other person to create a group", ephemeral=True)
+        await reply(interaction, "❌ Please mention at least one other person to create a group", ephemeral=True)
         return
     
-    success, message = splitwise.initialize_group(
-        guild_id=interaction.guild_id,
-        member_ids=member_ids
-    )
-    
-    if success:
-        members_text = ", ".join([f"<@{str(member_id)}>" for member_id in member_ids])
-        embed = discord.Embed(
-            title="✅ Group Initialized",
-            description=message,
-            color=discord.Color.green()
+    async with guild_write(interaction):
+        success, message = splitwise.initialize_group(
+            guild_id=interaction.guild_id,
+            member_ids=member_ids
         )
-        embed.add_field(name="Members", value=members_text, inline=False)
-        embed.set_footer(text="You can now use /add to add expenses that will be split among all members")
-        await interaction.response.send_message(embed=embed)
-    else:
-        await interaction.response.send_message(f"❌ {message}", ephemeral=True)
+        
+        if success:
+            members_text = ", ".join([f"<@{str(member_id)}>" for member_id in member_ids])
+            embed = discord.Embed(
+                title="✅ Group Initialized",
+                description=message,
+                color=discord.Color.green()
+            )
+            embed.add_field(name="Members", value=members_text, inline=False)
+            embed.set_footer(text="You can now use /add to add expenses that will be split among all members")
+            await reply(interaction, embed=embed)
+        else:
+            await reply(interaction, f"❌ {message}", ephemeral=True)
 
 @bot.tree.command(name="reset", description="Reset the group (clear all data)")
 async def reset_group(interaction: discord.Interaction):
-    success, message = splitwise.reset_group(interaction.guild_id)
-    
-    if success:
-        embed = discord.Embed(
-            title="🔄 Group Reset",
-            description=message,
-            color=discord.Color.orange()
-        )
-        await interaction.response.send_message(embed=embed)
-    else:
-        await interaction.response.send_message(f"❌ {message}", ephemeral=True)
+    async with guild_write(interaction):
+        success, message = splitwise.reset_group(interaction.guild_id)
+        
+        if success:
+            embed = discord.Embed(
+                title="🔄 Group Reset",
+                description=message,
+                color=discord.Color.orange()
+            )
+            await reply(interaction, embed=embed)
+        else:
+            await reply(interaction, f"❌ {message}", ephemeral=True)
 
 @bot.tree.command(name="add", description="Add an expense")
 @app_commands.describe(
     amount="Amount of the expense",
-    description="Description of the expense"
+    description="Description of the expense",
+    split="Who to split with, e.g. \"@alice 2 @bob 1\"; defaults to the whole group",
+    split_type="How the numbers in split are read; defaults to exact for $, percent for %, otherwise weights"
 )
-async def add_expense(interaction: discord.Interaction, amount: float, description: str):
+@app_commands.choices(split_type=[app_commands.Choice(name=split_type.capitalize(), value=split_type) for split_type in SPLIT_TYPES])
+async def add_expense(
+    interaction: discord.Interaction, amount: float, description: str,
+    split: Optional[str] = None, split_type: Optional[app_commands.Choice[str]] = None
+):
     if amount <= 0:
-        await interaction.response.send_message("❌ Amount must be greater than 0", ephemeral=True)
+        await reply(interaction, "❌ Amount must be greater than 0", ephemeral=True)
         return
     
-    if not splitwise.is_group_initialized(interaction.guild_id):
-        await interaction.response.send_message("❌ Group not initialized. Please use /init first to set up the group members.", ephemeral=True)
+    async with guild_write(interaction):
+        if not splitwise.is_group_initialized(interaction.guild_id):
+            await reply(interaction, "❌ Group not initialized. Please use /init first to set up the group members.", ephemeral=True)
+            return
+        
+        group_members = splitwise.get_group_members(interaction.guild_id)
+        if not group_members:
+            await reply(interaction, "❌ No group members found. Please use /init to set up the group.", ephemeral=True)
+            return
+        
+        # Uneven splits are one expense and one write, with no follow-up
+        # /add or /settle calls to even things out
+        member_ids = list(group_members)
+        split_values = None
+        marked_type = None
+        try:
+            if split:
+                member_ids, split_values, marked_type = parse_split(split, group_members)
+            chosen_type = choose_split_type(split_type.value if split_type else None, marked_type, split_values or [])
+            expense = splitwise.add_expense(
+                guild_id=interaction.guild_id,
+                payer_id=interaction.user.id,
+                amount=amount,
+                description=description,
+                split_with=member_ids,
+                split_type=chosen_type,
+                split_values=split_values
+            )
+        except ValueError as e:
+            await reply(interaction, f"❌ Couldn't split that: {e}", ephemeral=True)
+            return
+        
+        members_text = ", ".join([f"<@{str(member_id)}>" for member_id in expense.split_with])
+        embed = discord.Embed(
+            title="💰 Expense Added",
+            description=f"**{description}**",
+            color=discord.Color.green()
+        )
+        embed.add_field(name="Amount", value=f"${amount:.2f}", inline=True)
+        embed.add_field(name="Paid by", value=f"<@{str(interaction.user.id)}>", inline=True)
+        if expense.share_cents:
+            shares_text = "\n".join(f"<@{str(user_id)}>: ${share / 100:.2f}" for user_id, share in expense.shares)
+            embed.add_field(name="Shares", value=shares_text[:1024], inline=False)
+        else:
+            embed.add_field(name="Split with", value=members_text, inline=False)
+            embed.add_field(name="Per person", value=f"${expense.per_person:.2f}", inline=True)
+        embed.set_footer(text=f"Expense ID: {expense.id}")
+        
+        await reply(interaction, embed=embed)
+
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "10000"))
+BULK_MAX_FILE_BYTES = int(os.getenv("BULK_MAX_FILE_BYTES", str(5 * 1024 * 1024)))
+BULK_MAX_ERRORS_SHOWN = 10
+# A generous per-row cost for validating and applying an import, used to
+# decide whether to defer before starting
+BULK_ROW_SECONDS = 0.0001
+
+def bulk_errors_text(errors: List[str]) -> str:
+    text = "\n".join(errors[:BULK_MAX_ERRORS_SHOWN])
+    if len(errors) > BULK_MAX_ERRORS_SHOWN:
+        text += f"\n...and {len(errors) - BULK_MAX_ERRORS_SHOWN} more"
+    return f"❌ Nothing was added, fix these rows and try again:\n{text}"
+
+def build_bulk_embed(expenses: List[Expense], title: str) -> discord.Embed:
+    total_cents = sum(expense.amount_cents for expense in expenses)
+    embed = discord.Embed(
+        title=title,
+        description=f"Added {len(expenses)} expense(s) totalling ${total_cents / 100:.2f}",
+        color=discord.Color.green()
+    )
+    for expense in expenses[:5]:
+        embed.add_field(name=f"#{expense.id} - {expense.description}", value=f"${expense.amount:.2f}", inline=True)
+    if len(expenses) > 5:
+        embed.set_footer(text=f"Expense IDs: {expenses[0].id}-{expenses[-1].id}")
+    return embed
+
+async def add_bulk_rows(interaction: discord.Interaction, raw_rows: List, first_row: int, title: str):
+    if not raw_rows:
+        await reply(interaction, "❌ No expenses found to add", ephemeral=True)
         return
-    
-    group_members = splitwise.get_group_members(interaction.guild_id)
-    if not group_members:
-        await interaction.response.send_message("❌ No group members found. Please use /init to set up the group.", ephemeral=True)
+    if len(raw_rows) > BULK_MAX_ROWS:
+        await reply(interaction, f"❌ Too many rows ({len(raw_rows)}); the limit is {BULK_MAX_ROWS}", ephemeral=True)
         return
     
-    member_ids = [str(member_id) for member_id in group_members]
-    
-    expense = splitwise.add_expense(
-        guild_id=interaction.guild_id,
-        payer_id=interaction.user.id,
-        amount=amount,
-        description=description,
-        split_with=member_ids
+    async with guild_write(interaction, len(raw_rows) * BULK_ROW_SECONDS):
+        # Checked again under the lock, as the group may have been reset
+        # while the modal was open or the file was downloading
+        group_members = splitwise.get_group_members(interaction.guild_id)
+        if not group_members:
+            await reply(interaction, "❌ Group not initialized. Please use /init first to set up the group members.", ephemeral=True)
+            return
+        
+        rows, errors = validate_rows(raw_rows, interaction.user.id, group_members, first_row)
+        if errors:
+            await reply(interaction, bulk_errors_text(errors), ephemeral=True)
+            return
+        
+        expenses = splitwise.add_expenses(interaction.guild_id, rows)
+        await reply(interaction, embed=build_bulk_embed(expenses, title))
+
+class AddManyModal(discord.ui.Modal, title="Add several expenses"):
+    lines = discord.ui.TextInput(
+        label="One expense per line: amount description",
+        style=discord.TextStyle.paragraph,
+        placeholder="12.50 Pizza\n30 Groceries\n8 Parking",
+        max_length=4000
     )
     
-    members_text = ", ".join([f"<@{str(member_id)}>" for member_id in group_members])
-    embed = discord.Embed(
-        title="💰 Expense Added",
-        description=f"**{description}**",
-        color=discord.Color.green()
-    )
-    embed.add_field(name="Amount", value=f"${amount:.2f}", inline=True)
-    embed.add_field(name="Paid by", value=f"<@{str(interaction.user.id)}>", inline=True)
-    embed.add_field(name="Split with", value=members_text, inline=False)
-    embed.add_field(name="Per person", value=f"${expense['per_person']:.2f}", inline=True)
-    embed.set_footer(text=f"Expense ID: {expense['id']}")
+    async def on_submit(self, interaction: discord.Interaction):
+        async with observed(interaction):
+            await add_bulk_rows(interaction, read_lines(self.lines.value), 1, "💰 Expenses Added")
     
-    await interaction.response.send_message(embed=embed)
+    async def on_error(self, interaction: discord.Interaction, error: Exception):
+        await super().on_error(interaction, error)
+        await report_failure(interaction)
 
-@bot.tree.command(name="check", description="Check balances for all members")
-async def check_balances(interaction: discord.Interaction):
+@bot.tree.command(name="addmany", description="Add several expenses at once, split with the whole group")
+async def add_many(interaction: discord.Interaction):
     if not splitwise.is_group_initialized(interaction.guild_id):
-        await interaction.response.send_message("❌ Group not initialized. Please use /init first to set up the group members.", ephemeral=True)
+        await reply(interaction, "❌ Group not initialized. Please use /init first to set up the group members.", ephemeral=True)
         return
     
-    balances = splitwise.get_balances(interaction.guild_id)
+    await send_modal(interaction, AddManyModal(custom_id="addmany:submit"))
+
+@bot.tree.command(name="import", description="Import expenses from a CSV or JSON file")
+@app_commands.describe(
+    file="CSV with a header row, or JSON list; columns: amount, description, payer, split_with, date"
+)
+async def import_expenses(interaction: discord.Interaction, file: discord.Attachment):
+    if not splitwise.is_group_initialized(interaction.guild_id):
+        await reply(interaction, "❌ Group not initialized. Please use /init first to set up the group members.", ephemeral=True)
+        return
     
-    if not balances:
-        await interaction.response.send_message("📊 No expenses recorded yet!", ephemeral=True)
+    if file.size > BULK_MAX_FILE_BYTES:
+        await reply(interaction, f"❌ File is too large; the limit is {BULK_MAX_FILE_BYTES // 1024} KB", ephemeral=True)
+        return
+    
+    # Downloading the file is a round trip of its own, so answer Discord first
+    await defer(interaction)
+    try:
+        raw_rows, first_row = read_attachment(file.filename, (await file.read()).decode("utf-8-sig"))
+    except (UnicodeDecodeError, ValueError, csv.Error) as e:
+        await reply(interaction, f"❌ Couldn't read {file.filename}: {e}", ephemeral=True)
         return
     
+    await add_bulk_rows(interaction, raw_rows, first_row, f"📥 Imported {file.filename}")
+
+def build_check_reply(guild_id: int) -> Dict:
+    balances = splitwise.get_balances(guild_id)
+    
+    if not balances:
+        return {"content": "📊 No expenses recorded yet!", "ephemeral": True}
+    
     debtors = {}
     creditors = {}
     
@@ -473,35 +1434,52 @@ async def check_balances(interaction: discord.Interaction):
             inline=False
         )
         
-        debt_relationships = []
-        user_ids = list(balances.keys())
-        
-        for i, user1_id in enumerate(user_ids):
-            for user2_id in user_ids[i+1:]:
-                user1_balance = balances[user1_id]
-                user2_balance = balances[user2_id]
-                
-                if user1_balance < 0 and user2_balance > 0:
-                    net_debt = min(abs(user1_balance), user2_balance)
-                    debt_relationships.append(f"<@{str(user1_id)}> owes <@{str(user2_id)}> ${net_debt:.2f}")
-                elif user2_balance < 0 and user1_balance > 0:
-                    net_debt = min(abs(user2_balance), user1_balance)
-                    debt_relationships.append(f"<@{str(user2_id)}> owes <@{str(user1_id)}> ${net_debt:.2f}")
-        
-        if debt_relationships:
-            embed.add_field(
-                name="💸 Net Debts",
-                value="\n".join(debt_relationships),
-                inline=False
-            )
-        else:
-            embed.add_field(
-                name="💸 Net Debts",
-                value="No net debts between individual users",
-                inline=False
-            )
+        with span("compute", "settlements"):
+            transfers = plan_settlements(balances)
+        embed.add_field(
+            name="💸 Net Debts",
+            value=settlement_plan_text(transfers),
+            inline=False
+        )
+    
+    return {"embed": embed}
+
+@bot.tree.command(name="check", description="Check balances for all members")
+async def check_balances(interaction: discord.Interaction):
+    await defer_if_slow(interaction)
+    if not splitwise.is_group_initialized(interaction.guild_id):
+        await reply(interaction, "❌ Group not initialized. Please use /init first to set up the group members.", ephemeral=True)
+        return
+    
+    await reply(interaction, **cached_render(interaction.guild_id, ("check",), lambda: build_check_reply(interaction.guild_id)))
+
+def settlement_plan_text(transfers: List[Tuple[int, int, float]]) -> str:
+    if not transfers:
+        return "No net debts between individual users"
+    return "\n".join([f"<@{str(from_id)}> owes <@{str(to_id)}> ${amount:.2f}" for from_id, to_id, amount in transfers])
+
+@bot.tree.command(name="settleplan", description="Show the fewest payments that settle all debts")
+async def settle_plan(interaction: discord.Interaction):
+    await defer_if_slow(interaction)
+    if not splitwise.is_group_initialized(interaction.guild_id):
+        await reply(interaction, "❌ Group not initialized. Please use /init first to set up the group members.", ephemeral=True)
+        return
+    
+    balances = splitwise.get_balances(interaction.guild_id)
+    transfers = plan_settlements(balances)
+    
+    if not transfers:
+        await reply(interaction, "✅ All balances are settled!", ephemeral=True)
+        return
     
-    await interaction.response.send_message(embed=embed)
+    embed = discord.Embed(
+        title="🧾 Settlement Plan",
+        description=f"{len(transfers)} payment(s) settle every balance",
+        color=discord.Color.blue()
+    )
+    embed.add_field(name="💸 Payments", value=settlement_plan_text(transfers), inline=False)
+    embed.set_footer(text="Use /settle after each payment to record it")
+    await reply(interaction, embed=embed)
 
 @bot.tree.command(name="settle", description="Settle a debt between two users")
 @app_commands.describe(
@@ -510,119 +1488,447 @@ async def check_balances(interaction: discord.Interaction):
 )
 async def settle_debt(interaction: discord.Interaction, to_user: discord.Member, amount: float):
     if not splitwise.is_group_initialized(interaction.guild_id):
-        await interaction.response.send_message("❌ Group not initialized. Please use /init first to set up the group members.", ephemeral=True)
+        await reply(interaction, "❌ Group not initialized. Please use /init first to set up the group members.", ephemeral=True)
         return
     
     if amount <= 0:
-        await interaction.response.send_message("❌ Amount must be greater than 0", ephemeral=True)
+        await reply(interaction, "❌ Amount must be greater than 0", ephemeral=True)
         return
     
     if to_user.id == interaction.user.id:
-        await interaction.response.send_message("❌ You can't settle with yourself", ephemeral=True)
+        await reply(interaction, "❌ You can't settle with yourself", ephemeral=True)
         return
     
-    balances = splitwise.get_balances(interaction.guild_id)
-    from_balance = balances.get(interaction.user.id, 0)
-    to_balance = balances.get(to_user.id, 0)
-    
-    success, message = splitwise.settle_debt(
-        guild_id=interaction.guild_id,
-        from_user_id=interaction.user.id,
-        to_user_id=to_user.id,
-        amount=amount
+    async with guild_write(interaction):
+        balances = splitwise.get_balances(interaction.guild_id)
+        from_balance = balances.get(interaction.user.id, 0)
+        to_balance = balances.get(to_user.id, 0)
+        
+        success, message = splitwise.settle_debt(
+            guild_id=interaction.guild_id,
+            from_user_id=interaction.user.id,
+            to_user_id=to_user.id,
+            amount=amount
+        )
+        
+        if success:
+            updated_balances = splitwise.get_balances(interaction.guild_id)
+            new_from_balance = updated_balances.get(interaction.user.id, 0)
+            new_to_balance = updated_balances.get(to_user.id, 0)
+            
+            embed = discord.Embed(
+                title="✅ Debt Settled",
+                description=message,
+                color=discord.Color.green()
+            )
+            embed.add_field(
+                name="Previous Balances",
+                value=f"<@{str(interaction.user.id)}>: ${from_balance:.2f}\n<@{str(to_user.id)}>: ${to_balance:.2f}",
+                inline=True
+            )
+            embed.add_field(
+                name="New Balances",
+                value=f"<@{str(interaction.user.id)}>: ${new_from_balance:.2f}\n<@{str(to_user.id)}>: ${new_to_balance:.2f}",
+                inline=True
+            )
+            await reply(interaction, embed=embed)
+        else:
+            embed = discord.Embed(
+                title="❌ Settlement Failed",
+                description=message,
+                color=discord.Color.red()
+            )
+            embed.add_field(
+                name="Current Balances",
+                value=f"<@{str(interaction.user.id)}>: ${from_balance:.2f}\n<@{str(to_user.id)}>: ${to_balance:.2f}",
+                inline=False
+            )
+            await reply(interaction, embed=embed, ephemeral=True)
+
+HISTORY_PAGE_SIZE = 10
+
+def build_history_embed(expenses: List[Expense], page: int, filters_text: str) -> discord.Embed:
+    embed = discord.Embed(
+        title="📋 Expense History",
+        description=f"Page {page + 1} · newest first" + (f"\n{filters_text}" if filters_text else ""),
+        color=discord.Color.purple()
     )
     
-    if success:
-        updated_balances = splitwise.get_balances(interaction.guild_id)
-        new_from_balance = updated_balances.get(interaction.user.id, 0)
-        new_to_balance = updated_balances.get(to_user.id, 0)
+    for expense in expenses:
+        timestamp = datetime.fromtimestamp(expense.timestamp).strftime("%m/%d/%y %I:%M %p")
+        split_with_text = ", ".join([f"<@{str(user_id)}>" for user_id in expense.split_with])
         
-        embed = discord.Embed(
-            title="✅ Debt Settled",
-            description=message,
-            color=discord.Color.green()
-        )
-        embed.add_field(
-            name="Previous Balances",
-            value=f"<@{str(interaction.user.id)}>: ${from_balance:.2f}\n<@{str(to_user.id)}>: ${to_balance:.2f}",
-            inline=True
-        )
-        embed.add_field(
-            name="New Balances",
-            value=f"<@{str(interaction.user.id)}>: ${new_from_balance:.2f}\n<@{str(to_user.id)}>: ${new_to_balance:.2f}",
-            inline=True
-        )
-        await interaction.response.send_message(embed=embed)
-    else:
-        embed = discord.Embed(
-            title="❌ Settlement Failed",
-            description=message,
-            color=discord.Color.red()
-        )
         embed.add_field(
-            name="Current Balances",
-            value=f"<@{str(interaction.user.id)}>: ${from_balance:.2f}\n<@{str(to_user.id)}>: ${to_balance:.2f}",
+            name=f"#{expense.id} - {expense.description} (${expense.amount:.2f})",
+            value=f"Paid by <@{str(expense.payer_id)}>\nSplit with: {split_with_text}\n{timestamp}",
             inline=False
         )
-        await interaction.response.send_message(embed=embed, ephemeral=True)
+    
+    return embed
+
+def render_history_page(guild_id: int, filters: Dict, filters_text: str, before, page: int):
+    # Returns the page's embed (None when nothing matches) and the cursor
+    # for the page after it
+    def build():
+        with span("compute", "query expenses"):
+            expenses, next_cursor = splitwise.query_expenses(guild_id, before=before, limit=HISTORY_PAGE_SIZE, **filters)
+        return (build_history_embed(expenses, page, filters_text) if expenses else None), next_cursor
+    return cached_render(guild_id, ("history", tuple(filters.items()), before, page), build)
+
+def no_history_message(filtered: bool) -> str:
+    return "📋 No expenses match those filters" if filtered else "📋 No expenses recorded yet!"
+
+class HistoryView(discord.ui.View):
+    def __init__(self, guild_id: int, user_id: int, filters: Dict, filters_text: str, next_cursor):
+        super().__init__(timeout=180)
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.filters = filters
+        self.filters_text = filters_text
+        # cursors[i] is where page i starts; None means the newest expense
+        self.cursors = [None]
+        self.next_cursor = next_cursor
+        self.update_buttons()
+    
+    def update_buttons(self):
+        self.newer.disabled = len(self.cursors) == 1
+        self.older.disabled = self.next_cursor is None
+    
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if interaction.user.id != self.user_id:
+            await reply(interaction, "❌ Run /history yourself to page through expenses", ephemeral=True)
+            return False
+        return True
+    
+    async def show_page(self, interaction: discord.Interaction):
+        embed, self.next_cursor = render_history_page(
+            self.guild_id, self.filters, self.filters_text, self.cursors[-1], len(self.cursors) - 1
+        )
+        if embed is None:
+            # Everything on the page went away while the view was open, e.g.
+            # through /reset or /clear
+            self.stop()
+            await edit_message(interaction, content=no_history_message(bool(self.filters_text)), embed=None, view=None)
+            return
+        self.update_buttons()
+        await edit_message(interaction, embed=embed, view=self)
+    
+    async def on_error(self, interaction: discord.Interaction, error: Exception, item: discord.ui.Item):
+        await super().on_error(interaction, error, item)
+        await report_failure(interaction)
+    
+    @discord.ui.button(label="◀ Newer", style=discord.ButtonStyle.secondary, custom_id="history:newer")
+    async def newer(self, interaction: discord.Interaction, button: discord.ui.Button):
+        async with observed(interaction):
+            self.cursors.pop()
+            await self.show_page(interaction)
+    
+    @discord.ui.button(label="Older ▶", style=discord.ButtonStyle.secondary, custom_id="history:older")
+    async def older(self, interaction: discord.Interaction, button: discord.ui.Button):
+        async with observed(interaction):
+            self.cursors.append(self.next_cursor)
+            await self.show_page(interaction)
+
+def parse_history_date(value: str) -> datetime:
+    return datetime.strptime(value.strip(), "%Y-%m-%d")
 
 @bot.tree.command(name="history", description="View expense history")
-async def view_history(interaction: discord.Interaction):
+@app_commands.describe(
+    payer="Only show expenses paid by this member",
+    start="Only show expenses on or after this date (YYYY-MM-DD)",
+    end="Only show expenses on or before this date (YYYY-MM-DD)",
+    min_amount="Only show expenses of at least this amount",
+    max_amount="Only show expenses of at most this amount"
+)
+async def view_history(
+    interaction: discord.Interaction,
+    payer: Optional[discord.Member] = None,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    min_amount: Optional[float] = None,
+    max_amount: Optional[float] = None
+):
+    await defer_if_slow(interaction)
     if not splitwise.is_group_initialized(interaction.guild_id):
-        await interaction.response.send_message("❌ Group not initialized. Please use /init first to set up the group members.", ephemeral=True)
+        await reply(interaction, "❌ Group not initialized. Please use /init first to set up the group members.", ephemeral=True)
+        return
+    
+    try:
+        start_date = parse_history_date(start) if start else None
+        end_date = parse_history_date(end) if end else None
+    except ValueError:
+        await reply(interaction, "❌ Dates must be in YYYY-MM-DD format", ephemeral=True)
+        return
+    
+    filters = {
+        "payer_id": payer.id if payer else None,
+        "start": int(start_date.timestamp()) if start_date else None,
+        "end": int((end_date + timedelta(days=1)).timestamp()) if end_date else None,
+        "min_amount": min_amount,
+        "max_amount": max_amount
+    }
+    
+    filters_parts = []
+    if payer:
+        filters_parts.append(f"paid by <@{str(payer.id)}>")
+    if start_date or end_date:
+        filters_parts.append(f"from {start_date.date() if start_date else 'the start'} to {end_date.date() if end_date else 'now'}")
+    if min_amount is not None or max_amount is not None:
+        low = f"${min_amount:.2f}" if min_amount is not None else "$0.00"
+        high = f"${max_amount:.2f}" if max_amount is not None else "any amount"
+        filters_parts.append(f"between {low} and {high}")
+    filters_text = "Filtered: " + ", ".join(filters_parts) if filters_parts else ""
+    
+    embed, next_cursor = render_history_page(interaction.guild_id, filters, filters_text, None, 0)
+    
+    if embed is None:
+        await reply(interaction, no_history_message(bool(filters_parts)), ephemeral=True)
+        return
+    
+    if next_cursor is None:
+        await reply(interaction, embed=embed)
         return
     
-    expenses = splitwise.get_expenses(interaction.guild_id)
+    view = HistoryView(interaction.guild_id, interaction.user.id, filters, filters_text, next_cursor)
+    await reply(interaction, embed=embed, view=view)
+
+STATS_TOP_COUNT = 5
+STATS_MONTH_COUNT = 6
+
+@bot.tree.command(name="stats", description="Show spending totals, top payers and monthly trends")
+@app_commands.describe(user="Show totals for this member as well")
+async def view_stats(interaction: discord.Interaction, user: Optional[discord.Member] = None):
+    await defer_if_slow(interaction)
+    if not splitwise.is_group_initialized(interaction.guild_id):
+        await reply(interaction, "❌ Group not initialized. Please use /init first to set up the group members.", ephemeral=True)
+        return
     
-    if not expenses:
-        await interaction.response.send_message("📋 No expenses recorded yet!", ephemeral=True)
+    rollups = splitwise.get_rollups(interaction.guild_id)
+    if not rollups.count:
+        await reply(interaction, "📈 No expenses recorded yet!", ephemeral=True)
         return
     
     embed = discord.Embed(
-        title="📋 Expense History",
-        description=f"Showing last {min(10, len(expenses))} expenses",
-        color=discord.Color.purple()
+        title="📈 Spending Stats",
+        description=f"{rollups.count} expense(s) totalling ${rollups.total_cents / 100:.2f}",
+        color=discord.Color.gold()
     )
     
-    for expense in expenses[-10:]:
-        timestamp = datetime.fromisoformat(expense['timestamp']).strftime("%m/%d %I:%M %p")
-        split_with_text = ", ".join([f"<@{str(user_id)}>" for user_id in expense['split_with']])
-        
+    if user:
+        paid = rollups.paid_cents.get(user.id, 0)
+        share = rollups.share_cents.get(user.id, 0)
+        embed.add_field(
+            name=f"👤 {user.display_name}",
+            value=f"Paid ${paid / 100:.2f}\nShare of expenses ${share / 100:.2f}",
+            inline=False
+        )
+    
+    embed.add_field(
+        name="🏆 Top Payers",
+        value="\n".join([f"<@{str(user_id)}>: ${cents / 100:.2f}" for user_id, cents in rollups.top_payers(STATS_TOP_COUNT)]),
+        inline=True
+    )
+    embed.add_field(
+        name="🗓️ By Month",
+        value="\n".join([f"{month}: ${cents / 100:.2f} ({count})" for month, (count, cents) in rollups.recent_months(STATS_MONTH_COUNT)]),
+        inline=True
+    )
+    
+    top_keywords = rollups.top_keywords(STATS_TOP_COUNT)
+    if top_keywords:
         embed.add_field(
-            name=f"#{expense['id']} - {expense['description']} (${expense['amount']:.2f})",
-            value=f"Paid by <@{str(expense['payer_id'])}>\nSplit with: {split_with_text}\n{timestamp}",
+            name="🏷️ Top Categories",
+            value="\n".join([f"{keyword}: ${cents / 100:.2f} ({count})" for keyword, (count, cents) in top_keywords]),
             inline=False
         )
     
-    await interaction.response.send_message(embed=embed)
+    await reply(interaction, embed=embed)
 
-@bot.tree.command(name="clear", description="Remove an expense by description")
+@bot.tree.command(name="clear", description="Remove an expense by ID or description")
 @app_commands.describe(
-    description="Exact description of the expense to remove"
+    expense="Expense ID (e.g. 12 or #12) or exact description of the expense to remove"
 )
-async def clear_expense(interaction: discord.Interaction, description: str):
-    if not splitwise.is_group_initialized(interaction.guild_id):
-        await interaction.response.send_message("❌ Group not initialized. Please use /init first to set up the group members.", ephemeral=True)
+async def clear_expense(interaction: discord.Interaction, expense: str):
+    async with guild_write(interaction):
+        if not splitwise.is_group_initialized(interaction.guild_id):
+            await reply(interaction, "❌ Group not initialized. Please use /init first to set up the group members.", ephemeral=True)
+            return
+        
+        if not expense.strip():
+            await reply(interaction, "❌ Please provide an expense ID or description to remove", ephemeral=True)
+            return
+        
+        success, message = splitwise.remove_expense(
+            guild_id=interaction.guild_id,
+            expense_ref=expense
+        )
+        
+        if success:
+            embed = discord.Embed(
+                title="🗑️ Expense Removed",
+                description=message,
+                color=discord.Color.red()
+            )
+            await reply(interaction, embed=embed)
+        else:
+            await reply(interaction, f"❌ {message}", ephemeral=True)
+
+# Largest batch of due occurrences added in one write; a long catch-up
+# continues on the scheduler's next pass
+RECURRING_MAX_BATCH = int(os.getenv("RECURRING_MAX_BATCH", "500"))
+
+async def post_recurring(guild_id: str, recurring_ids: List[int]):
+    async with guild_locks.get(guild_id):
+        batches = splitwise.post_recurring(guild_id, recurring_ids, int(time.time()), RECURRING_MAX_BATCH)
+    for recurring, expenses in batches:
+        if recurring.channel_id:
+            asyncio.create_task(announce_recurring(recurring.channel_id, expenses))
+
+async def announce_recurring(channel_id: int, expenses: List[Expense]):
+    # Catch-up runs at startup, before the gateway connects
+    await bot.wait_until_ready()
+    channel = bot.get_channel(channel_id)
+    if channel is None:
+        return
+    try:
+        await channel.send(embed=build_bulk_embed(expenses, "🔁 Recurring Expense Added"))
+    except discord.HTTPException as e:
+        print(f"Error announcing recurring expense in channel {channel_id}: {e}")
+
+recurring_scheduler = RecurringScheduler(splitwise.recurring_due, post_recurring)
+
+def describe_recurring(recurring: RecurringExpense) -> str:
+    next_due = datetime.fromtimestamp(recurring.next_due).strftime("%Y-%m-%d")
+    return f"${recurring.amount_cents / 100:.2f} {recurring.interval}, paid by <@{str(recurring.payer_id)}> · next {next_due}"
+
+recurring_group = app_commands.Group(name="recurring", description="Expenses that are added automatically on a schedule")
+
+@recurring_group.command(name="add", description="Add an expense that repeats, split with the whole group")
+@app_commands.describe(
+    amount="Amount of each expense",
+    description="Description of the expense",
+    interval="How often it repeats",
+    start="First date to add it (YYYY-MM-DD); defaults to now"
+)
+@app_commands.choices(interval=[app_commands.Choice(name=interval.capitalize(), value=interval) for interval in RECURRING_INTERVALS])
+async def add_recurring(interaction: discord.Interaction, amount: float, description: str, interval: app_commands.Choice[str], start: Optional[str] = None):
+    if amount <= 0:
+        await reply(interaction, "❌ Amount must be greater than 0", ephemeral=True)
         return
     
-    if not description.strip():
-        await interaction.response.send_message("❌ Please provide a description to remove", ephemeral=True)
+    try:
+        start_time = int(parse_history_date(start).timestamp()) if start else int(time.time())
+    except ValueError:
+        await reply(interaction, "❌ Dates must be in YYYY-MM-DD format", ephemeral=True)
         return
     
-    success, message = splitwise.remove_expense(
-        guild_id=interaction.guild_id,
-        description=description
-    )
+    async with guild_write(interaction):
+        group_members = splitwise.get_group_members(interaction.guild_id)
+        if not group_members:
+            await reply(interaction, "❌ Group not initialized. Please use /init first to set up the group members.", ephemeral=True)
+            return
+        
+        recurring = splitwise.add_recurring(
+            interaction.guild_id, interaction.user.id, amount, description, group_members,
+            interval.value, start_time, interaction.channel_id
+        )
+        recurring_scheduler.schedule(str(interaction.guild_id), recurring.id)
+        
+        embed = discord.Embed(
+            title="🔁 Recurring Expense Added",
+            description=f"**{description}**",
+            color=discord.Color.green()
+        )
+        embed.add_field(name="Schedule", value=describe_recurring(recurring), inline=False)
+        embed.set_footer(text=f"Recurring ID: {recurring.id} · Missed runs are added when the bot is back")
+        await reply(interaction, embed=embed)
+
+@recurring_group.command(name="list", description="Show this group's recurring expenses")
+async def list_recurring(interaction: discord.Interaction):
+    schedules = splitwise.get_recurring(interaction.guild_id)
+    if not schedules:
+        await reply(interaction, "🔁 No recurring expenses set up", ephemeral=True)
+        return
     
-    if success:
+    embed = discord.Embed(title="🔁 Recurring Expenses", color=discord.Color.blue())
+    for recurring in sorted(schedules, key=lambda recurring: recurring.next_due)[:25]:
+        embed.add_field(name=f"#{recurring.id} - {recurring.description}", value=describe_recurring(recurring), inline=False)
+    await reply(interaction, embed=embed)
+
+@recurring_group.command(name="remove", description="Stop a recurring expense; expenses already added stay")
+@app_commands.describe(recurring_id="Recurring ID from /recurring list")
+async def remove_recurring(interaction: discord.Interaction, recurring_id: int):
+    async with guild_write(interaction):
+        recurring = splitwise.remove_recurring(interaction.guild_id, recurring_id)
+        if recurring is None:
+            await reply(interaction, f"❌ No recurring expense #{recurring_id}", ephemeral=True)
+            return
+        
         embed = discord.Embed(
-            title="🗑️ Expense Removed",
-            description=message,
+            title="🗑️ Recurring Expense Stopped",
+            description=f"#{recurring.id} - {recurring.description} will not be added again",
             color=discord.Color.red()
         )
-        await interaction.response.send_message(embed=embed)
-    else:
-        await interaction.response.send_message(f"❌ {message}", ephemeral=True)
+        await reply(interaction, embed=embed)
+
+bot.tree.add_command(recurring_group)
+
+@bot.tree.command(name="trace", description="Turn tracing of slow commands on or off for this bot")
+@app_commands.describe(action="on, off, or status to see what has been traced")
+@app_commands.choices(action=[app_commands.Choice(name=action.capitalize(), value=action) for action in ("on", "off", "status")])
+@app_commands.default_permissions(administrator=True)
+async def trace_command(interaction: discord.Interaction, action: app_commands.Choice[str]):
+    # Tracing covers every guild this process serves, so only the bot's
+    # owner can switch it
+    if not await bot.is_owner(interaction.user):
+        await reply(interaction, "❌ Only the bot's owner can change tracing", ephemeral=True)
+        return
+    
+    if action.value == "on":
+        tracer.enable()
+    elif action.value == "off":
+        tracer.disable()
+    await reply(interaction, f"🔎 Tracing is {tracer.status()}", ephemeral=True)
+
+@bot.tree.command(name="verify", description="Rebuild balances from the ledger and report any drift")
+@app_commands.default_permissions(manage_guild=True)
+async def verify_ledger(interaction: discord.Interaction):
+    if STORAGE_MODE != "journal":
+        await reply(interaction, "❌ Ledger verification needs STORAGE_MODE=journal", ephemeral=True)
+        return
+    
+    await defer(interaction, ephemeral=True)
+    try:
+        drift = await splitwise.verify_ledger()
+    except RuntimeError as e:
+        await reply(interaction, f"❌ {e}", ephemeral=True)
+        return
+    
+    problems = drift.get(str(interaction.guild_id))
+    if not problems:
+        await reply(interaction, "✅ Balances and expenses match the ledger", ephemeral=True)
+        return
+    
+    embed = discord.Embed(
+        title="⚠️ Ledger Drift",
+        description="\n".join(problems)[:4000],
+        color=discord.Color.red()
+    )
+    await reply(interaction, embed=embed, ephemeral=True)
 
 if __name__ == "__main__":
+    if sys.argv[1:] == ["verify-ledger"]:
+        if STORAGE_MODE != "journal":
+            sys.exit("Ledger verification needs STORAGE_MODE=journal")
+        drift = asyncio.run(splitwise.verify_ledger())
+        for guild_id, problems in drift.items():
+            print(f"Guild {guild_id}:")
+            for problem in problems:
+                print(f"  {problem}")
+        print("Ledger OK" if not drift else f"Drift found in {len(drift)} guild(s)")
+        sys.exit(1 if drift else 0)
+    startup.phase("commands")
+    # Everything loaded so far lives for the whole run; moving it out of the
+    # collector's generations keeps later full collections from walking it
+    gc.freeze()
     bot.run(token)
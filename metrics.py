@@ -0,0 +1,146 @@
+import time
+from typing import List, Optional, Tuple
+
+import discord
+from prometheus_client import Counter, Gauge, Histogram
+
+# Discord drops an interaction that isn't acknowledged within 3 seconds
+INTERACTION_DEADLINE = 3.0
+
+COMMAND_LATENCY = Histogram(
+    "splitwise_command_duration_seconds",
+    "Time spent handling a slash command, button or modal",
+    ["command"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+COMMAND_ERRORS = Counter("splitwise_command_errors_total", "Slash commands, buttons and modals that raised", ["command"])
+INTERACTION_ACK = Histogram(
+    "splitwise_interaction_ack_seconds",
+    "Time from an interaction being created to the bot acknowledging it",
+    ["command"],
+    buckets=(0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 2.5, 3.0, 5.0, 10.0)
+)
+INTERACTION_LATE = Counter(
+    "splitwise_interaction_late_total",
+    "Interactions acknowledged after Discord's 3 second deadline",
+    ["command"]
+)
+
+STORAGE_LOAD = Histogram(
+    "splitwise_storage_load_seconds",
+    "Time to load state at startup or one guild on demand",
+    ["engine", "scope"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+)
+STORAGE_SAVE = Histogram(
+    "splitwise_storage_save_seconds",
+    "Time to prepare a save on the event loop and to write it",
+    ["engine", "phase"],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+)
+STORAGE_BYTES = Counter("splitwise_storage_bytes_written_total", "Bytes written by saves", ["engine"])
+
+OPENAI_LATENCY = Histogram(
+    "splitwise_openai_request_seconds",
+    "Duration of OpenAI chat completion requests",
+    buckets=(0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0)
+)
+OPENAI_TOKENS = Counter("splitwise_openai_tokens_total", "Tokens used by OpenAI requests", ["kind"])
+CHAT_REPLIES = Counter("splitwise_chat_replies_total", "Replies to mentions, from the model or a fallback line", ["source"])
+
+GATEWAY_LATENCY = Gauge("splitwise_gateway_latency_seconds", "Discord gateway heartbeat latency")
+LOADED_GUILDS = Gauge("splitwise_loaded_guilds", "Guilds held in memory")
+LOADED_EXPENSES = Gauge("splitwise_loaded_expenses", "Expenses held in memory")
+STARTUP_PHASE = Gauge("splitwise_startup_phase_seconds", "Time spent in each phase of startup", ["phase"])
+
+class StartupTimer:
+    # Splits the time from the process starting to the first READY into
+    # phases; each phase() call ends the phase named and starts the next
+    def __init__(self, started: float):
+        self.started = started
+        self.last = started
+        self.phases: List[Tuple[str, float]] = []
+        self.finished = False
+    
+    def phase(self, name: str):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        STARTUP_PHASE.labels(name).set(now - self.last)
+        self.last = now
+    
+    def finish(self):
+        self.finished = True
+        print(self.report())
+    
+    def report(self) -> str:
+        phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.phases)
+        return f"Started in {self.last - self.started:.2f}s ({phases})"
+
+def thread_bytes_written() -> Optional[int]:
+    # Bytes the current thread has handed to write(); per thread so saves in
+    # the persister's executor aren't mixed up with logging elsewhere
+    try:
+        with open("/proc/thread-self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def command_name(interaction: discord.Interaction) -> str:
+    if interaction.command:
+        return interaction.command.qualified_name
+    # Buttons and modals are named by their custom_id, e.g. "history:older"
+    return (interaction.data or {}).get("custom_id", "unknown")
+
+def observe_command(interaction: discord.Interaction, failed: bool = False):
+    name = command_name(interaction)
+    started = interaction.extras.get("started")
+    if started is not None:
+        COMMAND_LATENCY.labels(name).observe(time.perf_counter() - started)
+    if failed:
+        COMMAND_ERRORS.labels(name).inc()
+
+def observe_ack(interaction: discord.Interaction):
+    # Called by interactions.py right after the first response reaches
+    # Discord. Measured from Discord's creation timestamp, so it includes
+    # gateway delivery as well as handler time; counted once per interaction
+    if interaction.extras.get("acked"):
+        return
+    interaction.extras["acked"] = True
+    name = command_name(interaction)
+    elapsed = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+    INTERACTION_ACK.labels(name).observe(elapsed)
+    if elapsed > INTERACTION_DEADLINE:
+        INTERACTION_LATE.labels(name).inc()
+
+class MeteredStorage:
+    # Wraps a storage engine to time its loads and saves and count the bytes
+    # it writes; everything else passes straight through
+    def __init__(self, storage, engine: str):
+        self.storage = storage
+        self.engine = engine
+    
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+    
+    def load(self, bot):
+        with STORAGE_LOAD.labels(self.engine, "startup").time():
+            self.storage.load(bot)
+    
+    def load_guild(self, bot, guild_id: str):
+        with STORAGE_LOAD.labels(self.engine, "guild").time():
+            self.storage.load_guild(bot, guild_id)
+    
+    def prepare(self, bot, records):
+        with STORAGE_SAVE.labels(self.engine, "prepare").time():
+            return self.storage.prepare(bot, records)
+    
+    def write(self, payload):
+        before = thread_bytes_written()
+        with STORAGE_SAVE.labels(self.engine, "write").time():
+            self.storage.write(payload)
+        after = thread_bytes_written()
+        if before is not None and after is not None:
+            STORAGE_BYTES.labels(self.engine).inc(after - before)
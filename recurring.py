@@ -0,0 +1,146 @@
+import asyncio
+import calendar
+import heapq
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from expense import format_timestamp, parse_timestamp
+
+INTERVALS = ("daily", "weekly", "monthly", "yearly")
+
+def occurrence(start: int, interval: str, index: int) -> int:
+    # The index-th due time, counted from start in local time. Months are
+    # counted from the start date rather than the previous run, so a
+    # schedule on the 31st comes back to the 31st after a short month
+    when = datetime.fromtimestamp(start)
+    if interval == "daily":
+        return int((when + timedelta(days=index)).timestamp())
+    if interval == "weekly":
+        return int((when + timedelta(weeks=index)).timestamp())
+    
+    months = when.month - 1 + index * (12 if interval == "yearly" else 1)
+    year = when.year + months // 12
+    month = months % 12 + 1
+    day = min(when.day, calendar.monthrange(year, month)[1])
+    return int(when.replace(year=year, month=month, day=day).timestamp())
+
+class RecurringExpense:
+    # runs counts the occurrences already posted, so the next due time is
+    # always derived from start and survives restarts exactly
+    __slots__ = ("id", "payer_id", "amount_cents", "description", "split_with", "interval", "start", "runs", "channel_id")
+    
+    def __init__(
+        self, id: int, payer_id: int, amount_cents: int, description: str, split_with: List[int],
+        interval: str, start: int, runs: int = 0, channel_id: Optional[int] = None
+    ):
+        self.id = id
+        self.payer_id = payer_id
+        self.amount_cents = amount_cents
+        self.description = description
+        self.split_with = split_with
+        self.interval = interval
+        self.start = start
+        self.runs = runs
+        self.channel_id = channel_id
+    
+    @classmethod
+    def from_dict(cls, data: Dict) -> "RecurringExpense":
+        return cls(
+            data['id'],
+            int(data['payer_id']),
+            data['amount_cents'],
+            data['description'],
+            [int(user_id) for user_id in data['split_with']],
+            data['interval'],
+            parse_timestamp(data['start']),
+            data['runs'],
+            int(data['channel_id']) if data.get('channel_id') else None
+        )
+    
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "payer_id": str(self.payer_id),
+            "amount_cents": self.amount_cents,
+            "description": self.description,
+            "split_with": [str(user_id) for user_id in self.split_with],
+            "interval": self.interval,
+            "start": format_timestamp(self.start),
+            "runs": self.runs,
+            "channel_id": str(self.channel_id) if self.channel_id else None
+        }
+    
+    @property
+    def next_due(self) -> int:
+        return occurrence(self.start, self.interval, self.runs)
+
+class RecurringScheduler:
+    # One task for every schedule in every guild: a min-heap of
+    # (due, guild_id, recurring_id) and a sleep until the earliest entry.
+    # Entries are never removed in place; one whose schedule has moved on
+    # or been deleted is dropped when it reaches the top
+    def __init__(self, next_due: Callable, post: Callable, max_sleep: float = 300.0, retry_after: float = 60.0):
+        # next_due(guild_id, recurring_id) -> due time, or None once removed;
+        # post(guild_id, recurring_ids) is awaited to add whatever is due
+        self.next_due = next_due
+        self.post = post
+        # Sleeps are capped so a change to the wall clock is noticed
+        self.max_sleep = max_sleep
+        self.retry_after = retry_after
+        self.heap: List = []
+        self.wakeup = asyncio.Event()
+        self.task = None
+    
+    def schedule(self, guild_id: str, recurring_id: int, due: Optional[int] = None):
+        due = due if due is not None else self.next_due(guild_id, recurring_id)
+        if due is None:
+            return
+        if not self.heap or due < self.heap[0][0]:
+            self.wakeup.set()
+        heapq.heappush(self.heap, (due, guild_id, recurring_id))
+    
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+    
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            await self.post_due(int(time.time()))
+            delay = self.max_sleep
+            if self.heap:
+                delay = min(delay, self.heap[0][0] - time.time())
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+    
+    async def post_due(self, now: int):
+        due: Dict[str, Dict[int, None]] = {}
+        while self.heap and self.heap[0][0] <= now:
+            when, guild_id, recurring_id = heapq.heappop(self.heap)
+            next_due = self.next_due(guild_id, recurring_id)
+            if next_due is None or next_due > when:
+                continue
+            due.setdefault(guild_id, {})[recurring_id] = None
+        
+        for guild_id, recurring_ids in due.items():
+            try:
+                await self.post(guild_id, list(recurring_ids))
+            except Exception as e:
+                print(f"Error adding recurring expenses for guild {guild_id}, will retry: {e}")
+                for recurring_id in recurring_ids:
+                    self.schedule(guild_id, recurring_id, now + self.retry_after)
+                continue
+            for recurring_id in recurring_ids:
+                self.schedule(guild_id, recurring_id)
+    
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
@@ -0,0 +1,87 @@
+import asyncio
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+MENTION_PATTERN = re.compile(r"<@[!&]?\d+>")
+PUNCTUATION_PATTERN = re.compile(r"[^\w\s]")
+
+def normalize_message(message: str) -> str:
+    message = MENTION_PATTERN.sub(" ", message.lower())
+    message = PUNCTUATION_PATTERN.sub(" ", message)
+    return " ".join(message.split())
+
+class ResponseCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+        self.inflight: Dict[Hashable, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.miss_seconds = 0.0
+    
+    def get(self, key: Hashable):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+    
+    def put(self, key: Hashable, value: Any):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+    
+    async def get_or_create(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        
+        task = self.inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._create(key, factory))
+            self.inflight[key] = task
+        
+        # Shield so one cancelled waiter doesn't cancel the shared request
+        return await asyncio.shield(task)
+    
+    async def _create(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        started = time.monotonic()
+        try:
+            value = await factory()
+            self.put(key, value)
+            return value
+        finally:
+            self.miss_seconds += time.monotonic() - started
+            del self.inflight[key]
+    
+    def stats(self) -> Dict:
+        avoided = self.hits + self.coalesced
+        avg_miss = self.miss_seconds / self.misses if self.misses else 0.0
+        lookups = self.hits + self.coalesced + self.misses
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_rate": avoided / lookups if lookups else 0.0,
+            "requests_avoided": avoided,
+            "estimated_seconds_saved": avoided * avg_miss
+        }
@@ -0,0 +1,75 @@
+import heapq
+import re
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from expense import Expense
+
+KEYWORD_PATTERN = re.compile(r"[a-z][a-z0-9']+")
+STOPWORDS = frozenset({"and", "for", "the", "with", "from", "our", "of", "at", "to", "on", "in"})
+
+def month_key(timestamp: int) -> str:
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m")
+
+def keywords(description: str) -> List[str]:
+    words = KEYWORD_PATTERN.findall(description.lower())
+    return list(dict.fromkeys(word for word in words if word not in STOPWORDS))
+
+def bump(totals: Dict, key, delta: int):
+    value = totals.get(key, 0) + delta
+    if value:
+        totals[key] = value
+    else:
+        totals.pop(key, None)
+
+def bump_bucket(buckets: Dict[str, List[int]], key: str, count: int, cents: int):
+    bucket = buckets.setdefault(key, [0, 0])
+    bucket[0] += count
+    bucket[1] += cents
+    if bucket[0] == 0:
+        del buckets[key]
+
+class GuildRollups:
+    # Running totals for /stats, kept in step with every add and remove so
+    # a query never scans the expense history. Counts and amounts are
+    # [count, cents] pairs; empty buckets are dropped
+    def __init__(self):
+        self.count = 0
+        self.total_cents = 0
+        self.paid_cents: Dict[int, int] = {}
+        self.share_cents: Dict[int, int] = {}
+        self.months: Dict[str, List[int]] = {}
+        self.keywords: Dict[str, List[int]] = {}
+    
+    @classmethod
+    def from_expenses(cls, expenses) -> "GuildRollups":
+        rollups = cls()
+        for expense in expenses:
+            rollups.add(expense)
+        return rollups
+    
+    def add(self, expense: Expense, sign: int = 1):
+        amount_cents = sign * expense.amount_cents
+        self.count += sign
+        self.total_cents += amount_cents
+        bump(self.paid_cents, expense.payer_id, amount_cents)
+        
+        # Shares are split exactly as the balances split them
+        for user_id, share in expense.shares:
+            bump(self.share_cents, user_id, sign * share)
+        
+        bump_bucket(self.months, month_key(expense.timestamp), sign, amount_cents)
+        for keyword in keywords(expense.description):
+            bump_bucket(self.keywords, keyword, sign, amount_cents)
+    
+    def remove(self, expense: Expense):
+        self.add(expense, sign=-1)
+    
+    def top_payers(self, limit: int) -> List[Tuple[int, int]]:
+        return heapq.nlargest(limit, self.paid_cents.items(), key=lambda item: item[1])
+    
+    def top_keywords(self, limit: int) -> List[Tuple[str, List[int]]]:
+        return heapq.nlargest(limit, self.keywords.items(), key=lambda item: item[1][1])
+    
+    def recent_months(self, limit: int) -> List[Tuple[str, List[int]]]:
+        return sorted(self.months.items())[-limit:]
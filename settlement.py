@@ -0,0 +1,100 @@
+import heapq
+from typing import Dict, List, Tuple
+
+from balances import to_cents
+
+# Above this many non-zero balances the exact search (O(2^n * n)) is skipped
+EXACT_SETTLEMENT_LIMIT = 12
+
+def balances_to_cents(balances: Dict[int, float]) -> Dict[int, int]:
+    cents = {user_id: to_cents(balance) for user_id, balance in balances.items()}
+    cents = {user_id: amount for user_id, amount in cents.items() if amount != 0}
+    
+    # Float balances can round to a total a cent or two off zero; park the
+    # residue on the largest balance so every plan fully settles
+    residue = sum(cents.values())
+    if residue and cents:
+        largest = max(cents, key=lambda user_id: abs(cents[user_id]))
+        cents[largest] -= residue
+        if cents[largest] == 0:
+            del cents[largest]
+    return cents
+
+def greedy_transfers(cents: Dict[int, int]) -> List[Tuple[int, int, int]]:
+    debtors = [(amount, user_id) for user_id, amount in cents.items() if amount < 0]
+    creditors = [(-amount, user_id) for user_id, amount in cents.items() if amount > 0]
+    heapq.heapify(debtors)
+    heapq.heapify(creditors)
+    
+    transfers = []
+    while debtors and creditors:
+        debt, debtor_id = heapq.heappop(debtors)
+        credit, creditor_id = heapq.heappop(creditors)
+        amount = min(-debt, -credit)
+        transfers.append((debtor_id, creditor_id, amount))
+        
+        if debt + amount < 0:
+            heapq.heappush(debtors, (debt + amount, debtor_id))
+        if credit + amount < 0:
+            heapq.heappush(creditors, (credit + amount, creditor_id))
+    
+    return transfers
+
+def zero_sum_groups(cents: Dict[int, int]) -> List[List[int]]:
+    user_ids = list(cents)
+    count = len(user_ids)
+    full = (1 << count) - 1
+    
+    sums = [0] * (full + 1)
+    for mask in range(1, full + 1):
+        low = mask & -mask
+        sums[mask] = sums[mask ^ low] + cents[user_ids[low.bit_length() - 1]]
+    
+    # best[mask] = most disjoint zero-sum groups the users in mask split into;
+    # each group of k users settles in k - 1 transfers
+    best = [0] * (full + 1)
+    for mask in range(1, full + 1):
+        top = 0
+        bits = mask
+        while bits:
+            low = bits & -bits
+            top = max(top, best[mask ^ low])
+            bits ^= low
+        best[mask] = top + (sums[mask] == 0)
+    
+    order = []
+    mask = full
+    while mask:
+        bits = mask
+        while bits:
+            low = bits & -bits
+            if best[mask ^ low] + (sums[mask] == 0) == best[mask]:
+                break
+            bits ^= low
+        order.append(low)
+        mask ^= low
+    order.reverse()
+    
+    groups = []
+    current = []
+    mask = 0
+    for low in order:
+        mask |= low
+        current.append(user_ids[low.bit_length() - 1])
+        if sums[mask] == 0:
+            groups.append(current)
+            current = []
+    return groups
+
+def plan_settlements(balances: Dict[int, float], exact: bool = True) -> List[Tuple[int, int, float]]:
+    cents = balances_to_cents(balances)
+    
+    if exact and len(cents) <= EXACT_SETTLEMENT_LIMIT:
+        transfers = []
+        for group in zero_sum_groups(cents):
+            transfers += greedy_transfers({user_id: cents[user_id] for user_id in group})
+    else:
+        transfers = greedy_transfers(cents)
+    
+    transfers.sort(key=lambda transfer: -transfer[2])
+    return [(debtor_id, creditor_id, amount / 100) for debtor_id, creditor_id, amount in transfers]
@@ -0,0 +1,32 @@
+import os
+from typing import List, Optional
+
+def shard_for(guild_id, shard_count: int) -> int:
+    # Discord delivers a guild's events on shard (guild_id >> 22) % shard_count
+    return (int(guild_id) >> 22) % shard_count
+
+def parse_shard_ids(text: str, shard_count: int) -> List[int]:
+    # "0-3,8" -> [0, 1, 2, 3, 8]; empty means every shard
+    if not text.strip():
+        return list(range(shard_count))
+    
+    shard_ids = set()
+    for part in text.split(","):
+        first, _, last = part.strip().partition("-")
+        try:
+            shard_ids.update(range(int(first), int(last or first) + 1))
+        except ValueError:
+            raise ValueError(f"SHARD_IDS part {part.strip()!r} is not a shard ID or a range like 0-3")
+    
+    if not shard_ids or min(shard_ids) < 0 or max(shard_ids) >= shard_count:
+        raise ValueError(f"SHARD_IDS {text!r} must be between 0 and {shard_count - 1}")
+    return sorted(shard_ids)
+
+def shard_path(path: str, shard: Optional[int]) -> str:
+    # splitwise.db -> splitwise.shard-3.db, guilds -> guilds/shard-3
+    if shard is None:
+        return path
+    root, ext = os.path.splitext(path)
+    if ext:
+        return f"{root}.shard-{shard}{ext}"
+    return os.path.join(path, f"shard-{shard}")
@@ -0,0 +1,26 @@
+from collections import OrderedDict
+from typing import Any, Hashable
+
+class SnapshotCache:
+    # LRU of values built from a guild's state, each tagged with the guild
+    # version it was built at; a lookup at any other version is a miss
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key: Hashable, version: int):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != version:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+    
+    def put(self, key: Hashable, version: int, value: Any):
+        self.entries[key] = (version, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
@@ -0,0 +1,117 @@
+import re
+from decimal import Decimal, InvalidOperation
+from typing import Dict, List, Optional, Tuple
+
+from balances import split_shares, to_cents, weighted_shares
+
+SPLIT_TYPES = ("equal", "weights", "exact", "percent")
+# A member mention and, optionally, their number: "<@1> 2, <@2>: $1.50, <@3> 25%"
+SPLIT_ENTRY_PATTERN = re.compile(r"<@!?(\d+)>\s*(?::\s*)?(?:(\$)?(\d+(?:\.\d+)?|\.\d+)\s*(%)?)?")
+SPLIT_SEPARATORS = " ,;\n"
+# Weights and percentages are scaled to whole numbers before splitting
+MAX_DECIMAL_PLACES = 4
+
+def parse_split(text: str, member_ids: List[int]) -> Tuple[List[int], List[Optional[Decimal]], Optional[str]]:
+    # "<@1> 2 <@2> 1" -> ([1, 2], [2, 1], None); members listed without a
+    # number get None. "$" marks the numbers as an "exact" split and "%" as
+    # a "percent" one, which is returned as the split type they imply
+    split_with = []
+    values = []
+    markers = set()
+    position = 0
+    for match in SPLIT_ENTRY_PATTERN.finditer(text):
+        skipped = text[position:match.start()].strip(SPLIT_SEPARATORS)
+        if skipped:
+            raise ValueError(f"couldn't read {skipped!r}; list members as @name followed by their number")
+        position = match.end()
+        
+        user_id = int(match.group(1))
+        if user_id not in member_ids:
+            raise ValueError(f"<@{user_id}> is not in the group")
+        if user_id in split_with:
+            raise ValueError(f"<@{user_id}> is listed twice")
+        split_with.append(user_id)
+        values.append(Decimal(match.group(3)) if match.group(3) else None)
+        if match.group(2):
+            markers.add("exact")
+        if match.group(4):
+            markers.add("percent")
+    
+    skipped = text[position:].strip(SPLIT_SEPARATORS)
+    if skipped:
+        raise ValueError(f"couldn't read {skipped!r}; list members as @name followed by their number")
+    if not split_with:
+        raise ValueError("mention at least one member to split with")
+    if len(markers) > 1:
+        raise ValueError("use either $ amounts or % percentages, not both")
+    return split_with, values, markers.pop() if markers else None
+
+def choose_split_type(split_type: Optional[str], marked_type: Optional[str], values: List[Optional[Decimal]]) -> str:
+    # An explicit split type wins, but must agree with any $ or % markers;
+    # without one, markers decide, then bare numbers mean weights
+    if split_type and marked_type and split_type != marked_type:
+        kind = "$ numbers are exact amounts" if marked_type == "exact" else "% numbers are percentages"
+        raise ValueError(f"{kind}, so the split type can't be {split_type}")
+    if split_type:
+        return split_type
+    if marked_type:
+        return marked_type
+    return "weights" if any(value is not None for value in values) else "equal"
+
+def whole_numbers(values: List[Decimal]) -> List[int]:
+    places = max(-min(value.as_tuple().exponent, 0) for value in values)
+    if places > MAX_DECIMAL_PLACES:
+        raise ValueError(f"use at most {MAX_DECIMAL_PLACES} decimal places")
+    return [int(value.scaleb(places)) for value in values]
+
+def share_cents(
+    amount_cents: int, split_type: str, split_with: List[int], split_values: Optional[List] = None, rotation: int = 0
+) -> Optional[Dict[int, int]]:
+    # What each member owes, in whole cents. "weights" splits in proportion
+    # (members without a number count 1), "exact" takes each member's
+    # amount and "percent" each member's percentage. Leftover cents rotate
+    # the same way an equal split's do. Returns None when the result is an
+    # equal split, which Expense works out from its members instead
+    if split_type not in SPLIT_TYPES:
+        raise ValueError(f"split type must be one of {', '.join(SPLIT_TYPES)}")
+    
+    try:
+        values = [Decimal(str(value)) if value is not None else None for value in split_values or [None] * len(split_with)]
+    except InvalidOperation:
+        raise ValueError("split numbers must be plain numbers like 2 or 12.50")
+    if len(values) != len(split_with):
+        raise ValueError("give one number per member")
+    if len(set(split_with)) != len(split_with):
+        raise ValueError("a member is listed twice")
+    if split_type == "equal":
+        if any(value is not None for value in values):
+            raise ValueError("an equal split doesn't take numbers; pick weights, exact or percent")
+        return None
+    if not split_with:
+        raise ValueError("mention at least one member to split with")
+    if split_type == "weights":
+        values = [Decimal(1) if value is None else value for value in values]
+    elif any(value is None for value in values):
+        kind = "an amount" if split_type == "exact" else "a percentage"
+        raise ValueError(f"every member needs {kind} for this split")
+    
+    # In user ID order, so the rotation lands on the same members it would
+    # in an equal split
+    members = sorted(zip(split_with, values))
+    split_with = [user_id for user_id, _ in members]
+    values = [value for _, value in members]
+    
+    if split_type == "exact":
+        shares = [to_cents(value) for value in values]
+        if sum(shares) != amount_cents:
+            raise ValueError(f"the amounts add up to ${sum(shares) / 100:.2f}, not ${amount_cents / 100:.2f}")
+    else:
+        if any(value <= 0 for value in values):
+            raise ValueError(f"every {'weight' if split_type == 'weights' else 'percentage'} must be greater than 0")
+        if split_type == "percent" and sum(values) != 100:
+            raise ValueError(f"the percentages add up to {sum(values)}%, not 100%")
+        shares = weighted_shares(amount_cents, whole_numbers(values), rotation)
+    
+    if shares == split_shares(amount_cents, len(shares), rotation):
+        return None
+    return dict(zip(split_with, shares))
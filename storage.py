@@ -0,0 +1,894 @@
+import asyncio
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import codec
+from balances import GuildBalances
+from expense import Expense
+from recurring import RecurringExpense
+from sharding import shard_for
+
+def fsync_dir(path: str):
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def write_json_atomic(path: str, data, indent: bool = False):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(codec.dumps(data, indent=indent))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+# Every engine exposes the same hooks to SplitwiseBot:
+#   load(bot)                  - called once from SplitwiseBot.__init__
+#   load_guild(bot, guild_id)  - called before a guild is first touched (lazy engines only)
+#   has_group(guild_id)        - whether a guild may have a group, without loading it (lazy engines only)
+#   prepare(bot, records)      - snapshots what a batch of applied mutation records needs
+#                                written; runs on the event loop, so it does no I/O
+#   write(payload)             - does the I/O for a prepared batch; may run in a worker thread
+# The on-demand engines also take an owns(guild_id) filter, so a shard's
+# partition only imports its own guilds from the legacy JSON files
+
+def owns_every_guild(guild_id: str) -> bool:
+    return True
+
+def next_id(counters: Dict[str, int], items: Dict, guild_id: str) -> int:
+    # For imports of the expense and schedule counters: legacy files only
+    # have a counter if they were last saved after it was added
+    return counters.get(guild_id) or max(items.get(guild_id, {}), default=0) + 1
+
+class JsonStorage:
+    lazy = False
+    
+    def __init__(
+        self, expenses_path: str, balances_path: str, group_members_path: str, recurring_path: str, next_expense_ids_path: str,
+        next_recurring_ids_path: str
+    ):
+        self.expenses_path = expenses_path
+        self.balances_path = balances_path
+        self.group_members_path = group_members_path
+        self.recurring_path = recurring_path
+        self.next_expense_ids_path = next_expense_ids_path
+        self.next_recurring_ids_path = next_recurring_ids_path
+    
+    def load(self, bot):
+        # Balances first, so each guild's roster keeps their stored order
+        bot.balances = bot.load_balances()
+        bot.expenses = bot.load_expenses()
+        bot.group_members = bot.load_group_members()
+        bot.recurring = bot.load_recurring()
+        bot.next_expense_ids = bot.load_next_expense_ids()
+        bot.next_recurring_ids = bot.load_next_recurring_ids()
+    
+    def load_guild(self, bot, guild_id: str):
+        pass
+    
+    def prepare(self, bot, records: List[Dict]) -> List[Tuple[str, Dict]]:
+        ops = {record['op'] for record in records}
+        payload = []
+        if ops & {"init_group", "reset_group"}:
+            payload.append((self.group_members_path, bot.serialize_group_members()))
+        if ops & {"add_expense", "add_expenses", "remove_expense", "reset_group"}:
+            payload.append((self.expenses_path, bot.serialize_expenses()))
+            payload.append((self.next_expense_ids_path, bot.serialize_next_expense_ids()))
+        payload.append((self.balances_path, bot.serialize_balances()))
+        if ops & {"add_recurring", "remove_recurring", "reset_group"} or any('recurring_runs' in record for record in records):
+            payload.append((self.recurring_path, bot.serialize_recurring()))
+            payload.append((self.next_recurring_ids_path, bot.serialize_next_recurring_ids()))
+        return payload
+    
+    def write(self, payload: List[Tuple[str, Dict]]):
+        for path, data in payload:
+            write_json_atomic(path, data, indent=True)
+
+class MemoryStorage:
+    lazy = False
+    
+    def load(self, bot):
+        pass
+    
+    def load_guild(self, bot, guild_id: str):
+        pass
+    
+    def prepare(self, bot, records: List[Dict]):
+        return None
+    
+    def write(self, payload):
+        pass
+
+class JournalStorage:
+    # An append-only ledger of every mutation. It is never truncated, so the
+    # full history can be replayed; every checkpoint_every events the state is
+    # checkpointed along with the ledger offset it covers, and startup only
+    # replays the events after the latest checkpoint.
+    lazy = False
+    
+    def __init__(self, journal_path: str, snapshot_path: str, checkpoint_every: int):
+        self.journal_path = journal_path
+        self.snapshot_path = snapshot_path
+        self.checkpoint_every = checkpoint_every
+        self.seq = 0
+        self.pending = 0
+        self.file = None
+        # Where a failed batch started, until it has been cut back off
+        self.torn_offset = None
+    
+    def exists(self) -> bool:
+        return os.path.exists(self.snapshot_path) or os.path.exists(self.journal_path)
+    
+    def load(self, bot):
+        if not self.exists():
+            # First start in journal mode: the JSON files become one import
+            # event per guild, the genesis of the ledger
+            balances = bot.load_balances()
+            expenses = bot.load_expenses()
+            group_members = bot.load_group_members()
+            recurring = bot.load_recurring()
+            next_expense_ids = bot.load_next_expense_ids()
+            next_recurring_ids = bot.load_next_recurring_ids()
+            records = [
+                {
+                    "op": "import_guild",
+                    "guild_id": guild_id,
+                    "group_members": [str(member_id) for member_id in group_members.get(guild_id, [])],
+                    "balances": {str(user_id): balance for user_id, balance in balances.get(guild_id, {}).items()},
+                    "expenses": [expense.to_dict() for expense in expenses.get(guild_id, {}).values()],
+                    "recurring": [schedule.to_dict() for schedule in recurring.get(guild_id, {}).values()],
+                    "next_expense_id": next_id(next_expense_ids, expenses, guild_id),
+                    "next_recurring_id": next_id(next_recurring_ids, recurring, guild_id)
+                }
+                for guild_id in sorted(set(expenses) | set(balances) | set(group_members) | set(recurring))
+            ]
+            for record in records:
+                bot.apply_record(record)
+            self.pending = len(records)
+            self.write(self.prepare(bot, records, force_checkpoint=True))
+            return
+        
+        snapshot, records = self.read()
+        snapshot = snapshot or {"expenses": {}, "balances": {}, "group_members": {}}
+        bot.balances = bot.convert_balances(snapshot['balances'])
+        bot.expenses = bot.convert_expenses(snapshot['expenses'])
+        bot.group_members = bot.convert_group_members(snapshot['group_members'])
+        bot.recurring = bot.convert_recurring(snapshot.get('recurring', {}))
+        bot.next_expense_ids = dict(snapshot.get('next_expense_ids', {}))
+        bot.next_recurring_ids = dict(snapshot.get('next_recurring_ids', {}))
+        
+        for record in records:
+            bot.apply_record(record)
+        
+        if self.pending >= self.checkpoint_every:
+            self.checkpoint(bot.snapshot(), self.seq, self.offset)
+            self.pending = 0
+    
+    def load_guild(self, bot, guild_id: str):
+        pass
+    
+    def prepare(self, bot, records: List[Dict], force_checkpoint: bool = False) -> Tuple[bytes, Optional[Dict], int]:
+        lines = []
+        for record in records:
+            self.seq += 1
+            lines.append(codec.dumps(dict(record, seq=self.seq)) + b"\n")
+        
+        self.pending += len(records)
+        snapshot = None
+        if force_checkpoint or self.pending >= self.checkpoint_every:
+            snapshot = bot.snapshot()
+            self.pending = 0
+        return b"".join(lines), snapshot, self.seq
+    
+    def write(self, payload: Tuple[bytes, Optional[Dict], int]):
+        data, snapshot, seq = payload
+        if self.file is None:
+            if self.torn_offset is not None:
+                os.truncate(self.journal_path, self.torn_offset)
+                self.torn_offset = None
+            self.file = open(self.journal_path, 'ab')
+        start = self.file.tell()
+        try:
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            
+            # The snapshot was taken right after this batch's last event, so the
+            # end of the file is exactly the offset it covers
+            if snapshot is not None:
+                self.checkpoint(snapshot, seq, self.file.tell())
+        except BaseException:
+            # The batch is retried whole, so cut off whatever part of it
+            # landed; otherwise it would be in the ledger twice, or leave a
+            # torn line in front of the events written after it
+            self.discard_from(start)
+            raise
+    
+    def discard_from(self, offset: int):
+        file, self.file = self.file, None
+        self.torn_offset = offset
+        try:
+            # Closing flushes anything still buffered, which is then cut too
+            file.close()
+        except OSError:
+            pass
+        os.truncate(self.journal_path, offset)
+        self.torn_offset = None
+    
+    def checkpoint(self, snapshot: Dict, seq: int, offset: int):
+        write_json_atomic(self.snapshot_path, dict(snapshot, seq=seq, offset=offset))
+        fsync_dir(self.snapshot_path)
+    
+    def read(self) -> Tuple[Optional[Dict], List[Dict]]:
+        snapshot = None
+        try:
+            snapshot = codec.read_json(self.snapshot_path, codec.Snapshot)
+        except FileNotFoundError:
+            pass
+        
+        snapshot_seq = snapshot['seq'] if snapshot else 0
+        # Journals written before checkpoints carried offsets were truncated
+        # at each snapshot, so they replay from the start
+        offset = snapshot.get('offset', 0) if snapshot else 0
+        size = os.path.getsize(self.journal_path) if os.path.exists(self.journal_path) else 0
+        if offset > size:
+            raise RuntimeError(f"{self.snapshot_path} points past the end of {self.journal_path}")
+        
+        self.seq = snapshot_seq
+        records = []
+        good_offset = offset
+        
+        for record, end_offset in self.iter_events(offset):
+            good_offset = end_offset
+            if record['seq'] <= self.seq:
+                continue
+            records.append(record)
+            self.seq = record['seq']
+        
+        if size != good_offset:
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(good_offset)
+                f.flush()
+                os.fsync(f.fileno())
+        
+        self.offset = good_offset
+        self.pending = len(records)
+        return snapshot, records
+    
+    def iter_events(self, offset: int = 0, until_seq: Optional[int] = None):
+        # Streams (event, end offset) pairs, stopping at a torn trailing write.
+        # An event repeated by a retried batch is skipped, so replay applies
+        # each seq once
+        last_seq = 0
+        try:
+            f = open(self.journal_path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = codec.loads(line)
+                except ValueError:
+                    break
+                if until_seq is not None and record['seq'] > until_seq:
+                    break
+                offset += len(line)
+                if record['seq'] <= last_seq:
+                    continue
+                last_seq = record['seq']
+                yield record, offset
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS groups (
+    guild_id TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    next_expense_id INTEGER,
+    next_recurring_id INTEGER
+);
+CREATE TABLE IF NOT EXISTS members (
+    guild_id TEXT NOT NULL,
+    member_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, member_id)
+);
+CREATE TABLE IF NOT EXISTS expenses (
+    guild_id TEXT NOT NULL,
+    expense_id INTEGER NOT NULL,
+    payer_id INTEGER NOT NULL,
+    amount REAL NOT NULL,
+    description TEXT NOT NULL,
+    split_with TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    per_person REAL,
+    shares TEXT,
+    PRIMARY KEY (guild_id, expense_id)
+);
+CREATE INDEX IF NOT EXISTS idx_expenses_description ON expenses (guild_id, description COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS idx_expenses_timestamp ON expenses (guild_id, timestamp);
+CREATE TABLE IF NOT EXISTS balances (
+    guild_id TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    balance REAL NOT NULL,
+    PRIMARY KEY (guild_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS recurring (
+    guild_id TEXT NOT NULL,
+    recurring_id INTEGER NOT NULL,
+    payer_id INTEGER NOT NULL,
+    amount_cents INTEGER NOT NULL,
+    description TEXT NOT NULL,
+    split_with TEXT NOT NULL,
+    interval TEXT NOT NULL,
+    start TEXT NOT NULL,
+    runs INTEGER NOT NULL,
+    channel_id INTEGER,
+    PRIMARY KEY (guild_id, recurring_id)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# per_person used to be NOT NULL and was filled in for uneven splits too;
+# SQLite can't relax a column constraint, so the table is copied over once
+NULLABLE_PER_PERSON_SQL = """
+BEGIN;
+DROP INDEX idx_expenses_description;
+DROP INDEX idx_expenses_timestamp;
+ALTER TABLE expenses RENAME TO expenses_old;
+CREATE TABLE expenses (
+    guild_id TEXT NOT NULL,
+    expense_id INTEGER NOT NULL,
+    payer_id INTEGER NOT NULL,
+    amount REAL NOT NULL,
+    description TEXT NOT NULL,
+    split_with TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    per_person REAL,
+    shares TEXT,
+    PRIMARY KEY (guild_id, expense_id)
+);
+INSERT INTO expenses SELECT
+    guild_id, expense_id, payer_id, amount, description, split_with, timestamp,
+    CASE WHEN shares IS NULL THEN per_person END, shares
+FROM expenses_old;
+DROP TABLE expenses_old;
+CREATE INDEX idx_expenses_description ON expenses (guild_id, description COLLATE NOCASE);
+CREATE INDEX idx_expenses_timestamp ON expenses (guild_id, timestamp);
+COMMIT;
+"""
+
+INSERT_GROUP_SQL = "INSERT OR IGNORE INTO groups (guild_id, created_at) VALUES (?, datetime('now'))"
+INSERT_MEMBER_SQL = "INSERT INTO members (guild_id, member_id, position) VALUES (?, ?, ?)"
+INSERT_EXPENSE_SQL = "INSERT INTO expenses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+INSERT_RECURRING_SQL = "INSERT INTO recurring VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+MARK_MIGRATED_SQL = "INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated', '1')"
+SET_NEXT_EXPENSE_ID_SQL = "UPDATE groups SET next_expense_id = ? WHERE guild_id = ?"
+SET_NEXT_RECURRING_ID_SQL = "UPDATE groups SET next_recurring_id = ? WHERE guild_id = ?"
+UPDATE_RECURRING_RUNS_SQL = "UPDATE recurring SET runs = ? WHERE guild_id = ? AND recurring_id = ?"
+UPSERT_BALANCE_SQL = (
+    "INSERT INTO balances (guild_id, user_id, balance) VALUES (?, ?, ?) "
+    "ON CONFLICT (guild_id, user_id) DO UPDATE SET balance = excluded.balance"
+)
+
+class SQLiteStorage:
+    lazy = True
+    
+    def __init__(self, path: str, owns: Callable[[str], bool] = owns_every_guild):
+        self.path = path
+        self.owns = owns
+        # Writes may come from the persister thread; reads stay on the event loop
+        # through their own connection, which WAL lets run alongside a writer
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SQLITE_SCHEMA)
+        # Databases from before uneven splits lack the shares column
+        if "shares" not in [row[1] for row in self.conn.execute("PRAGMA table_info(expenses)")]:
+            self.conn.execute("ALTER TABLE expenses ADD COLUMN shares TEXT")
+            self.conn.commit()
+        if any(row[1] == "per_person" and row[3] for row in self.conn.execute("PRAGMA table_info(expenses)")):
+            self.conn.executescript(NULLABLE_PER_PERSON_SQL)
+        # and those from before stored counters lack their columns
+        group_columns = [row[1] for row in self.conn.execute("PRAGMA table_info(groups)")]
+        for column in ("next_expense_id", "next_recurring_id"):
+            if column not in group_columns:
+                self.conn.execute(f"ALTER TABLE groups ADD COLUMN {column} INTEGER")
+                self.conn.commit()
+        self.reader = sqlite3.connect(path)
+    
+    def load(self, bot):
+        bot.expenses = {}
+        bot.balances = {}
+        bot.group_members = {}
+        
+        # The legacy JSON files are imported once; after that an empty
+        # database means every group was reset, not that nothing was imported
+        migrated = self.reader.execute("SELECT 1 FROM meta WHERE key = 'migrated'").fetchone() is not None
+        if not migrated:
+            # Databases imported before the marker existed already have groups
+            if self.reader.execute("SELECT 1 FROM groups LIMIT 1").fetchone() is None:
+                self.import_json(bot)
+            else:
+                self.write([(MARK_MIGRATED_SQL, (), False)])
+        
+        # Schedules are few and the scheduler needs all of them, so they
+        # load up front rather than with their guild
+        for row in self.reader.execute(
+            "SELECT guild_id, recurring_id, payer_id, amount_cents, description, split_with, interval, start, runs, channel_id "
+            "FROM recurring ORDER BY guild_id, recurring_id"
+        ):
+            bot.recurring.setdefault(row[0], {})[row[1]] = RecurringExpense.from_dict({
+                "id": row[1],
+                "payer_id": row[2],
+                "amount_cents": row[3],
+                "description": row[4],
+                "split_with": codec.loads(row[5]),
+                "interval": row[6],
+                "start": row[7],
+                "runs": row[8],
+                "channel_id": row[9]
+            })
+    
+    def import_json(self, bot):
+        # One-step migration: the JSON files are read once and never written again
+        balances = bot.load_balances()
+        expenses = bot.load_expenses()
+        group_members = bot.load_group_members()
+        recurring = bot.load_recurring()
+        next_expense_ids = bot.load_next_expense_ids()
+        next_recurring_ids = bot.load_next_recurring_ids()
+        
+        guild_ids = [
+            guild_id for guild_id in set(expenses) | set(balances) | set(group_members) | set(recurring) if self.owns(guild_id)
+        ]
+        # Marked in the same transaction as the import, so it happens exactly once
+        statements = [(MARK_MIGRATED_SQL, (), False)]
+        for guild_id in guild_ids:
+            statements += self.guild_statements(
+                guild_id,
+                group_members.get(guild_id, []),
+                balances.get(guild_id, {}),
+                expenses.get(guild_id, {}),
+                recurring.get(guild_id, {}),
+                next_id(next_expense_ids, expenses, guild_id),
+                next_id(next_recurring_ids, recurring, guild_id)
+            )
+        self.write(statements)
+        # The guilds load on demand like any other, with fresh rosters
+        bot.rosters.clear()
+        if guild_ids:
+            print(f"Imported {len(guild_ids)} guild(s) from JSON into {self.path}")
+    
+    def guild_statements(
+        self, guild_id: str, members: List[int], balances: Dict, expenses: Dict[int, Expense],
+        recurring: Dict[int, RecurringExpense], next_expense_id: int, next_recurring_id: int
+    ) -> List:
+        return self.delete_statements(guild_id) + [
+            (INSERT_GROUP_SQL, (guild_id,), False),
+            (SET_NEXT_EXPENSE_ID_SQL, (next_expense_id, guild_id), False),
+            (SET_NEXT_RECURRING_ID_SQL, (next_recurring_id, guild_id), False),
+            (INSERT_MEMBER_SQL, [(guild_id, member_id, position) for position, member_id in enumerate(members)], True),
+            (UPSERT_BALANCE_SQL, [(guild_id, user_id, balance) for user_id, balance in balances.items()], True),
+            (INSERT_EXPENSE_SQL, [self.expense_row(guild_id, expense.to_dict()) for expense in expenses.values()], True),
+            (INSERT_RECURRING_SQL, [self.recurring_row(guild_id, schedule.to_dict()) for schedule in recurring.values()], True)
+        ]
+    
+    def delete_statements(self, guild_id: str) -> List:
+        return [
+            (f"DELETE FROM {table} WHERE guild_id = ?", (guild_id,), False)
+            for table in ("groups", "members", "expenses", "balances", "recurring")
+        ]
+    
+    def expense_row(self, guild_id: str, expense: Dict) -> Tuple:
+        # Takes the serialized JSON shape, the same one add_expense records carry
+        return (
+            guild_id,
+            expense['id'],
+            int(expense['payer_id']),
+            expense['amount'],
+            expense['description'],
+            codec.dumps([int(user_id) for user_id in expense['split_with']]).decode('utf-8'),
+            expense['timestamp'],
+            expense.get('per_person'),
+            codec.dumps(expense['shares']).decode('utf-8') if expense.get('shares') else None
+        )
+    
+    def recurring_row(self, guild_id: str, recurring: Dict) -> Tuple:
+        return (
+            guild_id,
+            recurring['id'],
+            int(recurring['payer_id']),
+            recurring['amount_cents'],
+            recurring['description'],
+            codec.dumps([int(user_id) for user_id in recurring['split_with']]).decode('utf-8'),
+            recurring['interval'],
+            recurring['start'],
+            recurring['runs'],
+            int(recurring['channel_id']) if recurring['channel_id'] else None
+        )
+    
+    def has_group(self, guild_id: str) -> bool:
+        return self.reader.execute("SELECT 1 FROM members WHERE guild_id = ? LIMIT 1", (guild_id,)).fetchone() is not None
+    
+    def load_guild(self, bot, guild_id: str):
+        members = [row[0] for row in self.reader.execute(
+            "SELECT member_id FROM members WHERE guild_id = ? ORDER BY position", (guild_id,)
+        )]
+        balances = {row[0]: row[1] for row in self.reader.execute(
+            "SELECT user_id, balance FROM balances WHERE guild_id = ? ORDER BY rowid", (guild_id,)
+        )}
+        counters = self.reader.execute(
+            "SELECT next_expense_id, next_recurring_id FROM groups WHERE guild_id = ?", (guild_id,)
+        ).fetchone()
+        roster = bot.roster(guild_id)
+        # Balances first, so the roster keeps their stored order
+        guild_balances = GuildBalances.from_dollars(balances, roster)
+        expenses = {
+            row[0]: Expense.from_dict({
+                "id": row[0],
+                "payer_id": row[1],
+                "amount": row[2],
+                "description": row[3],
+                "split_with": codec.loads(row[4]),
+                "timestamp": row[5],
+                "shares": codec.loads(row[6]) if row[6] else None
+            }, roster)
+            for row in self.reader.execute(
+                "SELECT expense_id, payer_id, amount, description, split_with, timestamp, shares "
+                "FROM expenses WHERE guild_id = ? ORDER BY expense_id", (guild_id,)
+            )
+        }
+        
+        if members:
+            bot.group_members[guild_id] = members
+        if balances:
+            bot.balances[guild_id] = guild_balances
+        if expenses:
+            bot.expenses[guild_id] = expenses
+        if counters and counters[0] is not None:
+            bot.next_expense_ids[guild_id] = counters[0]
+        if counters and counters[1] is not None:
+            bot.next_recurring_ids[guild_id] = counters[1]
+    
+    def prepare(self, bot, records: List[Dict]) -> List:
+        statements = []
+        touched = []
+        
+        for record in records:
+            op = record['op']
+            guild_id = record['guild_id']
+            if guild_id not in touched:
+                touched.append(guild_id)
+            
+            if op == "reset_group":
+                statements += self.delete_statements(guild_id)
+            elif op == "init_group":
+                members = [int(member_id) for member_id in record['member_ids']]
+                statements += [
+                    (INSERT_GROUP_SQL, (guild_id,), False),
+                    ("DELETE FROM members WHERE guild_id = ?", (guild_id,), False),
+                    (INSERT_MEMBER_SQL, [(guild_id, member_id, position) for position, member_id in enumerate(members)], True)
+                ]
+            elif op == "add_expense":
+                statements += [
+                    (INSERT_GROUP_SQL, (guild_id,), False),
+                    (INSERT_EXPENSE_SQL, self.expense_row(guild_id, record['expense']), False)
+                ]
+            elif op == "add_expenses":
+                statements += [
+                    (INSERT_GROUP_SQL, (guild_id,), False),
+                    (INSERT_EXPENSE_SQL, [self.expense_row(guild_id, expense) for expense in record['expenses']], True)
+                ]
+                if 'recurring_runs' in record:
+                    statements.append((UPDATE_RECURRING_RUNS_SQL, [
+                        (runs, guild_id, int(recurring_id)) for recurring_id, runs in record['recurring_runs'].items()
+                    ], True))
+            elif op == "add_recurring":
+                statements += [
+                    (INSERT_GROUP_SQL, (guild_id,), False),
+                    (INSERT_RECURRING_SQL, self.recurring_row(guild_id, record['recurring']), False)
+                ]
+            elif op == "remove_recurring":
+                statements.append(
+                    ("DELETE FROM recurring WHERE guild_id = ? AND recurring_id = ?", (guild_id, record['recurring_id']), False)
+                )
+            elif op == "remove_expense":
+                statements.append(
+                    ("DELETE FROM expenses WHERE guild_id = ? AND expense_id = ?", (guild_id, record['expense_id']), False)
+                )
+        
+        # Balances and expense counters are written once per guild from the
+        # state after the whole batch
+        for guild_id in touched:
+            balances = bot.balances.get(guild_id, {})
+            statements.append(
+                (UPSERT_BALANCE_SQL, [(guild_id, user_id, balance) for user_id, balance in balances.items()], True)
+            )
+            if guild_id in bot.next_expense_ids:
+                statements.append((SET_NEXT_EXPENSE_ID_SQL, (bot.next_expense_ids[guild_id], guild_id), False))
+            if guild_id in bot.next_recurring_ids:
+                statements.append((SET_NEXT_RECURRING_ID_SQL, (bot.next_recurring_ids[guild_id], guild_id), False))
+        return statements
+    
+    def write(self, statements: List):
+        with self.conn:
+            for sql, params, many in statements:
+                if many:
+                    self.conn.executemany(sql, params)
+                else:
+                    self.conn.execute(sql, params)
+
+class GuildFileStorage:
+    lazy = True
+    
+    def __init__(self, directory: str, owns: Callable[[str], bool] = owns_every_guild):
+        self.directory = directory
+        self.owns = owns
+        # Schedules live in their guild's file, so they are saved together
+        # with the expenses they post. This index lists the guilds that have
+        # any, so startup reads those files instead of every one; it is
+        # written ahead of the guild files and may list a guild too many
+        self.index_path = os.path.join(directory, "recurring.index")
+        # Written once the legacy JSON files have been split, so a directory
+        # emptied by /reset isn't mistaken for one that was never filled
+        self.migrated_path = os.path.join(directory, ".migrated")
+        self.recurring_guilds = set()
+        os.makedirs(directory, exist_ok=True)
+    
+    def path(self, guild_id: str) -> str:
+        return os.path.join(self.directory, f"{guild_id}.json")
+    
+    def load(self, bot):
+        bot.expenses = {}
+        bot.balances = {}
+        bot.group_members = {}
+        
+        if not os.path.exists(self.migrated_path):
+            # Directories split before the marker existed already hold guild files
+            if not any(name.endswith(".json") for name in os.listdir(self.directory)):
+                self.import_json(bot)
+            write_json_atomic(self.migrated_path, {"migrated": 1})
+            fsync_dir(self.migrated_path)
+        
+        try:
+            indexed = codec.read_json(self.index_path, codec.GUILD_INDEX)
+        except FileNotFoundError:
+            indexed = []
+        for guild_id in indexed:
+            try:
+                schedules = codec.read_json(self.path(guild_id), codec.GuildData).get('recurring', [])
+            except FileNotFoundError:
+                continue
+            if schedules:
+                bot.recurring[guild_id] = {schedule['id']: RecurringExpense.from_dict(schedule) for schedule in schedules}
+                self.recurring_guilds.add(guild_id)
+        if len(self.recurring_guilds) != len(indexed):
+            write_json_atomic(self.index_path, sorted(self.recurring_guilds))
+    
+    def import_json(self, bot):
+        # One-step migration: split the legacy files into one file per guild
+        balances = bot.load_balances()
+        expenses = bot.load_expenses()
+        group_members = bot.load_group_members()
+        recurring = bot.load_recurring()
+        next_expense_ids = bot.load_next_expense_ids()
+        next_recurring_ids = bot.load_next_recurring_ids()
+        guild_ids = [
+            guild_id for guild_id in set(expenses) | set(balances) | set(group_members) | set(recurring) if self.owns(guild_id)
+        ]
+        
+        indexed = sorted(guild_id for guild_id in guild_ids if recurring.get(guild_id))
+        self.write(([(self.index_path, indexed)] if indexed else []) + [
+            (self.path(guild_id), self.guild_data(
+                group_members.get(guild_id, []),
+                balances.get(guild_id, {}),
+                expenses.get(guild_id, {}),
+                recurring.get(guild_id, {}),
+                next_id(next_expense_ids, expenses, guild_id),
+                next_id(next_recurring_ids, recurring, guild_id)
+            ))
+            for guild_id in guild_ids
+        ])
+        bot.rosters.clear()
+        if guild_ids:
+            print(f"Imported {len(guild_ids)} guild(s) from JSON into {self.directory}/")
+    
+    def guild_data(
+        self, members: List[int], balances: Dict, expenses: Dict[int, Expense], recurring: Dict[int, RecurringExpense],
+        next_expense_id: Optional[int], next_recurring_id: Optional[int]
+    ) -> Dict:
+        data = {
+            "group_members": [str(member_id) for member_id in members],
+            "balances": {str(user_id): balance for user_id, balance in balances.items()},
+            "expenses": [expense.to_dict() for expense in expenses.values()],
+            "recurring": [schedule.to_dict() for schedule in recurring.values()]
+        }
+        if next_expense_id is not None:
+            data["next_expense_id"] = next_expense_id
+        if next_recurring_id is not None:
+            data["next_recurring_id"] = next_recurring_id
+        return data
+    
+    def has_group(self, guild_id: str) -> bool:
+        # A guild's file can also hold only schedules or expenses, so this
+        # may say yes for a guild whose load then finds no group
+        return os.path.exists(self.path(guild_id))
+    
+    def load_guild(self, bot, guild_id: str):
+        try:
+            data = codec.read_json(self.path(guild_id), codec.GuildData)
+        except FileNotFoundError:
+            return
+        
+        if data['group_members']:
+            bot.group_members[guild_id] = [int(member_id) for member_id in data['group_members']]
+        roster = bot.roster(guild_id)
+        if data['balances']:
+            bot.balances[guild_id] = GuildBalances.from_dollars(data['balances'], roster)
+        if data['expenses']:
+            bot.expenses[guild_id] = {expense['id']: Expense.from_dict(expense, roster) for expense in data['expenses']}
+        if data.get('next_expense_id'):
+            bot.next_expense_ids[guild_id] = data['next_expense_id']
+        if data.get('next_recurring_id'):
+            bot.next_recurring_ids[guild_id] = data['next_recurring_id']
+    
+    def prepare(self, bot, records: List[Dict]) -> List[Tuple[str, Optional[Dict]]]:
+        payload = []
+        indexed = len(self.recurring_guilds)
+        for guild_id in dict.fromkeys(record['guild_id'] for record in records):
+            members = bot.group_members.get(guild_id, [])
+            balances = bot.balances.get(guild_id, {})
+            expenses = bot.expenses.get(guild_id, {})
+            recurring = bot.recurring.get(guild_id, {})
+            if recurring:
+                self.recurring_guilds.add(guild_id)
+            if members or balances or expenses or recurring:
+                payload.append((self.path(guild_id), self.guild_data(
+                    members, balances, expenses, recurring, bot.next_expense_ids.get(guild_id),
+                    bot.next_recurring_ids.get(guild_id)
+                )))
+            else:
+                payload.append((self.path(guild_id), None))
+        
+        if len(self.recurring_guilds) != indexed:
+            payload.insert(0, (self.index_path, sorted(self.recurring_guilds)))
+        return payload
+    
+    def write(self, payload: List[Tuple[str, Optional[Dict]]]):
+        for path, data in payload:
+            if data is not None:
+                write_json_atomic(path, data)
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        if payload:
+            fsync_dir(payload[0][0])
+
+class ShardedStorage:
+    # Keeps each shard's guilds in a partition of their own (one engine per
+    # shard, e.g. a database file each) and routes every call by guild, so a
+    # process only opens and writes the shards it runs. Needs on-demand
+    # engines, since nothing is loaded until a guild is asked for
+    lazy = True
+    
+    def __init__(self, partitions: Dict[int, object], shard_count: int):
+        self.partitions = partitions
+        self.shard_count = shard_count
+    
+    def owns(self, guild_id: str) -> bool:
+        return shard_for(guild_id, self.shard_count) in self.partitions
+    
+    def partition(self, guild_id: str):
+        shard = shard_for(guild_id, self.shard_count)
+        if shard not in self.partitions:
+            raise KeyError(f"Guild {guild_id} is on shard {shard}, which this process doesn't run")
+        return self.partitions[shard]
+    
+    def load(self, bot):
+        for storage in self.partitions.values():
+            storage.load(bot)
+    
+    def load_guild(self, bot, guild_id: str):
+        self.partition(guild_id).load_guild(bot, guild_id)
+    
+    def has_group(self, guild_id: str) -> bool:
+        return self.partition(guild_id).has_group(guild_id)
+    
+    def prepare(self, bot, records: List[Dict]) -> List[Tuple[int, object]]:
+        batches = {}
+        for record in records:
+            batches.setdefault(shard_for(record['guild_id'], self.shard_count), []).append(record)
+        return [(shard, self.partitions[shard].prepare(bot, batch)) for shard, batch in batches.items()]
+    
+    def write(self, payload: List[Tuple[int, object]]):
+        for shard, shard_payload in payload:
+            self.partitions[shard].write(shard_payload)
+
+class WriteBehindPersister:
+    def __init__(self, bot, storage, interval: float, max_batch: int, on_flushed: Optional[Callable[[], None]] = None):
+        self.bot = bot
+        self.storage = storage
+        self.interval = interval
+        self.max_batch = max_batch
+        # Called on the loop once everything queued has been written, e.g.
+        # to evict guilds that were kept in memory only while dirty
+        self.on_flushed = on_flushed
+        self.pending: List[Dict] = []
+        # Prepared batches waiting for (or retrying) their write, in order
+        self.unwritten: List[Tuple[object, set]] = []
+        self.wakeup = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="splitwise-persist")
+        self.task = None
+    
+    @property
+    def dirty(self) -> set:
+        guild_ids = {record['guild_id'] for record in self.pending}
+        for _, batch_guild_ids in self.unwritten:
+            guild_ids |= batch_guild_ids
+        return guild_ids
+    
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+    
+    def submit(self, record: Dict):
+        self.pending.append(record)
+        if len(self.pending) >= self.max_batch:
+            self.wakeup.set()
+    
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+    
+    async def flush(self):
+        async with self.flush_lock:
+            if self.pending:
+                batch = self.pending
+                self.pending = []
+                payload = self.storage.prepare(self.bot, batch)
+                self.unwritten.append((payload, {record['guild_id'] for record in batch}))
+            
+            loop = asyncio.get_running_loop()
+            while self.unwritten:
+                payload, _ = self.unwritten[0]
+                try:
+                    await loop.run_in_executor(self.executor, self.storage.write, payload)
+                except Exception as e:
+                    # Keep this batch and every later one so they land in order on retry
+                    print(f"Error persisting state, will retry: {e}")
+                    return
+                self.unwritten.pop(0)
+            
+            if self.on_flushed is not None:
+                self.on_flushed()
+    
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+        self.executor.shutdown(wait=True)
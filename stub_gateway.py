@@ -0,0 +1,231 @@
+import argparse
+import importlib
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from sharding import shard_for, shard_path
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+WORDS = ["pizza", "groceries", "uber", "rent", "coffee", "dinner", "movie", "gas", "hotel", "tickets"]
+# Share of each kind of event after the groups are created
+EVENT_MIX = [("add", 0.6), ("check", 0.2), ("history", 0.1), ("settle", 0.05), ("remove", 0.05)]
+BATCH_SIZE = 100
+
+def split_shards(shard_count: int, processes: int) -> List[List[int]]:
+    # Contiguous shard ranges, as SHARD_IDS=first-last would give each process
+    size, extra = divmod(shard_count, processes)
+    ranges = []
+    first = 0
+    for index in range(processes):
+        last = first + size + (1 if index < extra else 0)
+        ranges.append(list(range(first, last)))
+        first = last
+    return ranges
+
+def gateway_events(args, rng: random.Random):
+    # The synthetic event stream: every group is created, then a mix of
+    # commands against random guilds
+    guilds = {}
+    for _ in range(args.guilds):
+        guild_id = str(rng.randrange(10 ** 17, 10 ** 18))
+        guilds[guild_id] = [str(rng.randrange(10 ** 17, 10 ** 18)) for _ in range(args.members)]
+        yield ("init", guild_id, guilds[guild_id])
+    
+    guild_ids = list(guilds)
+    kinds = [kind for kind, _ in EVENT_MIX]
+    weights = [weight for _, weight in EVENT_MIX]
+    for _ in range(args.events):
+        guild_id = rng.choice(guild_ids)
+        kind = rng.choices(kinds, weights)[0]
+        if kind == "add":
+            members = guilds[guild_id]
+            yield ("add", guild_id, rng.choice(members), rng.randint(100, 50000) / 100, rng.choice(WORDS), members)
+        else:
+            yield (kind, guild_id)
+
+def dispatch(bot_module, bot, event):
+    # What the slash command handlers call for each kind of event
+    kind, guild_id = event[0], event[1]
+    if kind == "init":
+        bot.initialize_group(guild_id, event[2])
+    elif kind == "add":
+        bot.add_expense(guild_id, *event[2:])
+    elif kind == "check":
+        bot_module.build_check_reply(guild_id)
+    elif kind == "history":
+        bot.query_expenses(guild_id, limit=bot_module.HISTORY_PAGE_SIZE)
+    elif kind == "settle":
+        balances = bot.get_balances(guild_id)
+        if balances:
+            debtor = min(balances, key=balances.get)
+            creditor = max(balances, key=balances.get)
+            if balances[debtor] < 0 < balances[creditor]:
+                bot.settle_debt(guild_id, debtor, creditor, 0.01)
+    elif kind == "remove":
+        expenses, _ = bot.query_expenses(guild_id, limit=1)
+        if expenses:
+            bot.remove_expense(guild_id, f"#{expenses[0].id}")
+
+def run_shard_process(workdir: str, mode: str, shard_count: int, shard_ids: List[int], ready, events, results):
+    # One bot process, configured exactly as it would be in production
+    os.environ.update({
+        "STORAGE_MODE": mode,
+        "WRITE_BEHIND": "0",
+        "SHARD_COUNT": str(shard_count),
+        "SHARD_IDS": ",".join(map(str, shard_ids))
+    })
+    sys.path.insert(0, ROOT)
+    os.chdir(workdir)
+    bot_module = importlib.import_module("main")
+    bot = bot_module.splitwise
+    ready.put(shard_ids)
+    
+    handled = 0
+    busy = 0.0
+    misrouted = 0
+    while True:
+        batch = events.get()
+        if batch is None:
+            break
+        started = time.perf_counter()
+        for event in batch:
+            if not bot_module.serves_guild(event[1]):
+                misrouted += 1
+                continue
+            dispatch(bot_module, bot, event)
+            handled += 1
+        busy += time.perf_counter() - started
+    
+    results.put({
+        "shard_ids": shard_ids,
+        "bot_shard_ids": bot_module.bot.shard_ids,
+        "handled": handled,
+        "misrouted": misrouted,
+        "busy_seconds": busy,
+        "loaded_guilds": len(bot.loaded_guilds)
+    })
+
+def partition_guilds(mode: str, workdir: str, shard: int) -> List[str]:
+    if mode == "sqlite":
+        path = os.path.join(workdir, shard_path("splitwise.db", shard))
+        if not os.path.exists(path):
+            return []
+        with sqlite3.connect(path) as conn:
+            return [row[0] for row in conn.execute("SELECT guild_id FROM groups")]
+    directory = os.path.join(workdir, shard_path("guilds", shard))
+    if not os.path.isdir(directory):
+        return []
+    return [name[:-len(".json")] for name in os.listdir(directory) if name.endswith(".json")]
+
+def check_partitions(mode: str, workdir: str, shard_count: int) -> List[str]:
+    # Every guild must have been written to its own shard's partition only
+    problems = []
+    for shard in range(shard_count):
+        for guild_id in partition_guilds(mode, workdir, shard):
+            if shard_for(guild_id, shard_count) != shard:
+                problems.append(f"guild {guild_id} stored in shard {shard}'s partition")
+    return problems
+
+def run_layout(args, processes: int) -> Dict:
+    workdir = tempfile.mkdtemp(prefix="splitwise-shards-")
+    context = multiprocessing.get_context("spawn")
+    ready = context.Queue()
+    results = context.Queue()
+    workers = []
+    queues = {}
+    try:
+        for shard_ids in split_shards(args.shards, processes):
+            events = context.Queue()
+            worker = context.Process(
+                target=run_shard_process, args=(workdir, args.mode, args.shards, shard_ids, ready, events, results)
+            )
+            worker.start()
+            workers.append(worker)
+            for shard in shard_ids:
+                queues[shard] = events
+        
+        # Startup isn't part of the measurement
+        for _ in workers:
+            ready.get()
+        
+        # Acts as Discord's gateway: each event goes only to the process
+        # running the guild's shard, batched to keep queue overhead down
+        started = time.perf_counter()
+        pending = {id(events): [] for events in queues.values()}
+        for event in gateway_events(args, random.Random(args.seed)):
+            events = queues[shard_for(event[1], args.shards)]
+            batch = pending[id(events)]
+            batch.append(event)
+            if len(batch) >= BATCH_SIZE:
+                events.put(batch)
+                pending[id(events)] = []
+        for events in set(queues.values()):
+            if pending[id(events)]:
+                events.put(pending[id(events)])
+            events.put(None)
+        
+        reports = [results.get() for _ in workers]
+        elapsed = time.perf_counter() - started
+        for worker in workers:
+            worker.join()
+        
+        handled = sum(report["handled"] for report in reports)
+        return {
+            "processes": processes,
+            "handled": handled,
+            "seconds": elapsed,
+            "events_per_second": handled / elapsed,
+            "reports": sorted(reports, key=lambda report: report["shard_ids"]),
+            "problems": check_partitions(args.mode, workdir, args.shards)
+        }
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def run(args) -> int:
+    layouts = [int(count) for count in args.processes.split(",")]
+    if any(count < 1 or count > args.shards for count in layouts):
+        sys.exit(f"--processes must each be between 1 and --shards ({args.shards})")
+    
+    failed = False
+    baseline = None
+    print(f"{args.guilds} guilds, {args.events} events, {args.shards} shards, {args.mode} storage")
+    for processes in layouts:
+        layout = run_layout(args, processes)
+        baseline = baseline or layout["events_per_second"]
+        print(
+            f"\n{processes} process(es): {layout['handled']} events in {layout['seconds']:.2f}s, "
+            f"{layout['events_per_second']:.0f}/s ({layout['events_per_second'] / baseline:.2f}x)"
+        )
+        for report in layout["reports"]:
+            print(
+                f"  shards {report['shard_ids'][0]}-{report['shard_ids'][-1]}: {report['handled']} events, "
+                f"busy {report['busy_seconds']:.2f}s, {report['loaded_guilds']} guilds loaded"
+            )
+            if report["misrouted"] or report["bot_shard_ids"] != report["shard_ids"]:
+                print(f"  PROBLEM shards {report['shard_ids']}: {report['misrouted']} misrouted events, bot runs {report['bot_shard_ids']}")
+                failed = True
+        for problem in layout["problems"]:
+            print(f"  PROBLEM {problem}")
+            failed = True
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the bot's shards as separate processes behind a stub gateway, without Discord")
+    parser.add_argument("--shards", type=int, default=4, help="total shard count (SHARD_COUNT)")
+    parser.add_argument("--processes", default="1,2,4", help="comma-separated process counts to compare")
+    parser.add_argument("--mode", choices=["sqlite", "guild_files"], default="sqlite", help="storage mode")
+    parser.add_argument("--guilds", type=int, default=200, help="synthetic guilds")
+    parser.add_argument("--members", type=int, default=6, help="members per guild")
+    parser.add_argument("--events", type=int, default=20000, help="command events after the groups are created")
+    parser.add_argument("--seed", type=int, default=1)
+    sys.exit(run(parser.parse_args()))
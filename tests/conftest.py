@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+@pytest.fixture(scope="session")
+def main(tmp_path_factory):
+    # main.py loads whatever state is in the working directory when it is
+    # imported, so it is imported from an empty one
+    os.environ.pop("STORAGE_MODE", None)
+    os.environ.pop("SHARD_COUNT", None)
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("import"))
+    try:
+        import main
+    finally:
+        os.chdir(cwd)
+    return main
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # Every engine's files are relative paths, so each test gets its own directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
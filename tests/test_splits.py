@@ -0,0 +1,13 @@
+from balances import to_cents
+from splits import share_cents
+
+def test_half_cents_round_up_for_amounts_and_exact_shares():
+    # 10.005 is stored as 10.00499..., which round() would take down
+    assert to_cents(10.005) == 1001
+    assert to_cents(-10.005) == -1001
+    assert to_cents(6.67) == 667
+    
+    amount_cents = to_cents(10.005)
+    shares = share_cents(amount_cents, "exact", [1, 2], [5.0, 5.005])
+    assert shares == {1: 500, 2: 501}
+    assert sum(shares.values()) == amount_cents
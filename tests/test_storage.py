@@ -0,0 +1,175 @@
+import asyncio
+import json
+import os
+from datetime import datetime
+
+import pytest
+
+from storage import JournalStorage, WriteBehindPersister
+
+ENGINES = ["json", "journal", "sqlite", "guild_files"]
+GUILD = "123456789012345678"
+
+def restart(main, mode):
+    return main.SplitwiseBot(storage=main.create_engine(mode))
+
+def state(bot, guild_id=GUILD):
+    return {
+        "members": list(bot.get_group_members(guild_id)),
+        "balances": dict(bot.get_balances(guild_id)),
+        "expenses": {expense.id: (expense.payer_id, expense.amount_cents, expense.shares) for expense in bot.get_expenses(guild_id)},
+        "recurring": {schedule.id: schedule.runs for schedule in bot.get_recurring(guild_id)}
+    }
+
+def write_legacy_json():
+    expenses = [
+        {"id": 1, "payer_id": "1", "amount": 10.0, "description": "Pizza", "split_with": ["1", "2", "3"],
+         "timestamp": "2025-01-01T10:00:00", "per_person": 3.3333333333333335},
+        {"id": 2, "payer_id": "2", "amount": 7.5, "description": "Taxi", "split_with": ["1", "2", "3"],
+         "timestamp": "2025-02-01T10:00:00", "per_person": 2.5}
+    ]
+    with open("expenses.json", "w") as f:
+        json.dump({GUILD: expenses}, f)
+    with open("balances.json", "w") as f:
+        json.dump({GUILD: {"1": 6.67, "2": 1.16, "3": -7.83}}, f)
+    with open("group_members.json", "w") as f:
+        json.dump({GUILD: ["1", "2", "3"]}, f)
+
+@pytest.mark.parametrize("mode", ENGINES)
+def test_round_trip(main, workdir, mode):
+    bot = restart(main, mode)
+    bot.initialize_group(GUILD, ["1", "2", "3"])
+    bot.add_expense(GUILD, 1, 10, "Pizza", [1, 2, 3])
+    bot.add_expense(GUILD, 2, 100, "Rent", [1, 2, 3], "weights", [2, 1, 1])
+    bot.add_expense(GUILD, 3, 5, "Coffee", [1, 3])
+    success, _ = bot.settle_debt(GUILD, 3, 2, 5)
+    assert success
+    success, _ = bot.remove_expense(GUILD, "#3")
+    assert success
+    before = state(bot)
+    
+    after = state(restart(main, mode))
+    assert after == before
+    assert sum(bot.get_balances(GUILD).cents) == 0
+    assert after["expenses"][2][2] == [(1, 5000), (2, 2500), (3, 2500)]
+
+@pytest.mark.parametrize("mode", ENGINES)
+def test_removed_ids_are_not_reused(main, workdir, mode):
+    bot = restart(main, mode)
+    bot.initialize_group(GUILD, ["1", "2"])
+    for description in ("a", "b", "c"):
+        bot.add_expense(GUILD, 1, 10, description, [1, 2])
+    bot.remove_expense(GUILD, "#3")
+    
+    assert restart(main, mode).add_expense(GUILD, 1, 10, "d", [1, 2]).id == 4
+
+@pytest.mark.parametrize("mode", ENGINES)
+def test_removed_recurring_ids_are_not_reused(main, workdir, mode):
+    bot = restart(main, mode)
+    bot.initialize_group(GUILD, ["1", "2"])
+    for description in ("a", "b"):
+        bot.add_recurring(GUILD, 1, 10, description, [1, 2], "weekly", 0)
+    bot.remove_recurring(GUILD, 2)
+    
+    bot = restart(main, mode)
+    assert bot.add_recurring(GUILD, 1, 10, "c", [1, 2], "weekly", 0).id == 3
+    bot.remove_recurring(GUILD, 1)
+    bot.remove_recurring(GUILD, 3)
+    assert restart(main, mode).add_recurring(GUILD, 1, 10, "d", [1, 2], "weekly", 0).id == 4
+
+@pytest.mark.parametrize("mode", ENGINES)
+def test_recurring_catch_up_across_restart(main, workdir, mode):
+    bot = restart(main, mode)
+    bot.initialize_group(GUILD, ["1", "2"])
+    start = int(datetime(2025, 1, 15, 12).timestamp())
+    recurring = bot.add_recurring(GUILD, 1, 30, "Rent", [1, 2], "monthly", start)
+    
+    # Down for three months: every missed run is posted on the next pass,
+    # dated when it fell due, and only once
+    bot = restart(main, mode)
+    now = int(datetime(2025, 4, 20).timestamp())
+    batches = bot.post_recurring(GUILD, [recurring.id], now, 100)
+    assert [len(expenses) for _, expenses in batches] == [4]
+    posted = state(bot)
+    
+    bot = restart(main, mode)
+    assert state(bot) == posted
+    assert posted["recurring"] == {recurring.id: 4}
+    assert bot.post_recurring(GUILD, [recurring.id], now, 100) == []
+    assert bot.get_balances(GUILD) == {1: 60.0, 2: -60.0}
+
+@pytest.mark.parametrize("mode", ["journal", "sqlite", "guild_files"])
+def test_legacy_json_is_imported_once(main, workdir, mode):
+    write_legacy_json()
+    bot = restart(main, mode)
+    assert len(bot.get_expenses(GUILD)) == 2
+    assert bot.get_balances(GUILD) == {1: 6.67, 2: 1.16, 3: -7.83}
+    assert bot.add_expense(GUILD, 1, 3, "Bus", [1, 2, 3]).id == 3
+    
+    success, _ = bot.reset_group(GUILD)
+    assert success
+    bot = restart(main, mode)
+    assert not bot.is_group_initialized(GUILD)
+    assert bot.get_expenses(GUILD) == []
+
+def test_failed_journal_write_is_retried_once(main, workdir, monkeypatch):
+    bot = restart(main, "journal")
+    
+    async def run():
+        bot.persister = WriteBehindPersister(bot, bot.storage, 60, 100)
+        bot.initialize_group(GUILD, ["1", "2"])
+        await bot.persister.flush()
+        bot.add_expense(GUILD, 1, 10, "Pizza", [1, 2])
+        
+        fsync = os.fsync
+        calls = []
+        def failing_fsync(fd):
+            calls.append(fd)
+            if len(calls) == 1:
+                raise OSError("disk full")
+            fsync(fd)
+        monkeypatch.setattr(os, "fsync", failing_fsync)
+        await bot.persister.flush()
+        assert len(bot.persister.unwritten) == 1
+        await bot.persister.flush()
+        assert not bot.persister.unwritten
+        monkeypatch.setattr(os, "fsync", fsync)
+        await bot.persister.close()
+    
+    asyncio.run(run())
+    with open(main.JOURNAL_FILE, "rb") as f:
+        assert len(f.readlines()) == 2
+    restarted = restart(main, "journal")
+    assert restarted.get_balances(GUILD) == {1: 5.0, 2: -5.0}
+
+def test_journal_replay_skips_repeated_events(main, workdir):
+    bot = restart(main, "journal")
+    bot.initialize_group(GUILD, ["1", "2"])
+    bot.add_expense(GUILD, 1, 10, "Pizza", [1, 2])
+    with open(main.JOURNAL_FILE, "rb") as f:
+        lines = f.readlines()
+    # A batch written twice, as a retry without the truncation used to
+    with open(main.JOURNAL_FILE, "ab") as f:
+        f.write(lines[-1])
+    
+    assert restart(main, "journal").get_balances(GUILD) == {1: 5.0, 2: -5.0}
+    journal = JournalStorage(main.JOURNAL_FILE, main.SNAPSHOT_FILE, 500)
+    assert [record["seq"] for record, _ in journal.iter_events()] == [1, 2]
+
+@pytest.mark.parametrize("mode", ["sqlite", "guild_files"])
+def test_flush_evicts_guilds_kept_while_dirty(main, workdir, monkeypatch, mode):
+    monkeypatch.setattr(main, "MAX_LOADED_GUILDS", 2)
+    bot = restart(main, mode)
+    
+    async def run():
+        bot.persister = WriteBehindPersister(bot, bot.storage, 60, 100, on_flushed=bot.evict_cold_guilds)
+        for guild_id in range(1, 7):
+            bot.initialize_group(str(guild_id), ["1", "2"])
+        # Nothing could be evicted while every guild had unwritten changes
+        assert len(bot.loaded_guilds) == 6
+        await bot.persister.flush()
+        assert len(bot.loaded_guilds) == 2
+        await bot.persister.close()
+    
+    asyncio.run(run())
+    assert restart(main, mode).is_group_initialized("1")
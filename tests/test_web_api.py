@@ -0,0 +1,37 @@
+import asyncio
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from web_api import WebAPI
+
+GUILD = "123456789012345678"
+TOKEN = "secret"
+AUTH = {"Authorization": f"Bearer {TOKEN}"}
+
+def get(api, path, headers=None):
+    async def fetch():
+        async with TestClient(TestServer(api.make_app())) as client:
+            response = await client.get(path, headers={**AUTH, **(headers or {})})
+            return response.status, response.headers.get("ETag")
+    return asyncio.run(fetch())
+
+@pytest.mark.parametrize("mode", ["sqlite", "guild_files"])
+def test_matching_etag_does_not_load_guild(main, workdir, mode):
+    bot = main.SplitwiseBot(storage=main.create_engine(mode))
+    bot.initialize_group(GUILD, ["1", "2"])
+    bot.add_expense(GUILD, 1, 10, "Pizza", [1, 2])
+    api = WebAPI(bot, None, lambda guild_id: True, TOKEN, 10, 100, 16)
+    
+    status, etag = get(api, f"/guilds/{GUILD}/balances")
+    assert status == 200
+    del bot.loaded_guilds[GUILD]
+    bot.unload_guild(GUILD)
+    
+    status, _ = get(api, f"/guilds/{GUILD}/balances", {"If-None-Match": etag})
+    assert status == 304
+    status, _ = get(api, f"/guilds/{GUILD}/balances")
+    assert status == 200
+    status, _ = get(api, "/guilds/42/balances")
+    assert status == 404
+    assert list(bot.loaded_guilds) == []
@@ -0,0 +1,251 @@
+import asyncio
+import cProfile
+import io
+import pstats
+import random
+import sys
+import threading
+import time
+import traceback
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+import codec
+
+# Functions listed from a sampled profile, by cumulative time
+PROFILE_LINES = 25
+
+current_trace: ContextVar[Optional["Trace"]] = ContextVar("current_trace", default=None)
+
+class Span:
+    __slots__ = ("trace", "kind", "name", "started")
+    
+    def __init__(self, trace: "Trace", kind: str, name: str):
+        self.trace = trace
+        self.kind = kind
+        self.name = name
+    
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        ended = time.perf_counter()
+        self.trace.spans.append((self.kind, self.name, self.started - self.trace.started, ended - self.started))
+        return False
+
+class NoSpan:
+    # Stands in for a span when nothing is being traced, so an untraced
+    # call costs one context variable lookup
+    __slots__ = ()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        return False
+
+NO_SPAN = NoSpan()
+
+def span(kind: str, name: str):
+    # kind is what the time went to: "storage", "compute", "render" or "network"
+    trace = current_trace.get()
+    if trace is None:
+        return NO_SPAN
+    return Span(trace, kind, name)
+
+class Trace:
+    def __init__(self, name: str, profiler: Optional[cProfile.Profile] = None):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans: List = []
+        self.profiler = profiler
+        self.failed = False
+        self.timed_out = False
+        self.finished = False
+        self.deadline = None
+    
+    def totals(self) -> Dict[str, float]:
+        # Time per kind, counting nested spans of the same kind once
+        totals = {}
+        ends = {}
+        for kind, _, start, duration in sorted(self.spans, key=lambda span: span[2]):
+            end = start + duration
+            covered = ends.get(kind, 0.0)
+            if end > covered:
+                totals[kind] = totals.get(kind, 0.0) + end - max(start, covered)
+                ends[kind] = end
+        return totals
+    
+    def to_dict(self, duration: float) -> Dict:
+        data = {
+            "trace": self.name,
+            "at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "duration_ms": round(duration * 1000, 3),
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+            "totals_ms": {kind: round(seconds * 1000, 3) for kind, seconds in self.totals().items()},
+            "spans": [
+                {"kind": kind, "name": name, "start_ms": round(start * 1000, 3), "duration_ms": round(duration * 1000, 3)}
+                for kind, name, start, duration in self.spans
+            ]
+        }
+        if self.profiler is not None:
+            output = io.StringIO()
+            pstats.Stats(self.profiler, stream=output).sort_stats("cumulative").print_stats(PROFILE_LINES)
+            data["profile"] = output.getvalue()
+        return data
+
+class Tracer:
+    # Opt-in tracing of slash commands and messages. While enabled, a
+    # sample_rate share of them gets a trace of storage, compute, render and
+    # network spans, and a profile_rate share of those also runs under
+    # cProfile. Traces slower than slow_seconds go to path as JSON lines,
+    # along with any stalls the loop watchdog catches. A trace that nothing
+    # finishes within timeout_seconds is finished as timed out, so a
+    # command that ends without its completion or error handler running
+    # can't leave the profiler on
+    def __init__(
+        self, path: str, enabled: bool = False, sample_rate: float = 1.0, profile_rate: float = 0.0,
+        slow_seconds: float = 0.5, block_seconds: float = 0.25, timeout_seconds: float = 60.0
+    ):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.profile_rate = profile_rate
+        self.slow_seconds = slow_seconds
+        self.timeout_seconds = timeout_seconds
+        self.watchdog = LoopWatchdog(self, block_seconds)
+        self.enabled = False
+        self.profiling = False
+        self.traced = 0
+        self.dumped = 0
+        self.lock = threading.Lock()
+        if enabled:
+            self.enable()
+    
+    def enable(self):
+        self.enabled = True
+        self.watchdog.start()
+    
+    def disable(self):
+        self.enabled = False
+        self.watchdog.stop()
+    
+    def start(self, name: str) -> Optional[Trace]:
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        # One profiler at a time: cProfile hooks the whole thread, so a
+        # second would take over the first's hook, and a profile also takes
+        # in whatever else the loop runs before the trace finishes
+        profiler = None
+        if not self.profiling and self.profile_rate and random.random() < self.profile_rate:
+            self.profiling = True
+            profiler = cProfile.Profile()
+            profiler.enable()
+        trace = Trace(name, profiler)
+        trace.deadline = asyncio.get_running_loop().call_later(self.timeout_seconds, self.expire, trace)
+        current_trace.set(trace)
+        self.traced += 1
+        return trace
+    
+    def expire(self, trace: Trace):
+        trace.timed_out = True
+        trace.failed = True
+        self.finish(trace)
+    
+    def finish(self, trace: Optional[Trace]):
+        if trace is None or trace.finished:
+            return
+        trace.finished = True
+        trace.deadline.cancel()
+        current_trace.set(None)
+        duration = time.perf_counter() - trace.started
+        if trace.profiler is not None:
+            trace.profiler.disable()
+            self.profiling = False
+        if duration >= self.slow_seconds:
+            self.dumped += 1
+            entry = trace.to_dict(duration)
+            asyncio.get_running_loop().run_in_executor(None, self.dump, entry)
+    
+    def dump(self, entry: Dict):
+        line = codec.dumps(entry) + b"\n"
+        with self.lock:
+            try:
+                with open(self.path, "ab") as f:
+                    f.write(line)
+            except OSError as e:
+                print(f"Error writing trace to {self.path}: {e}")
+    
+    def status(self) -> str:
+        if not self.enabled:
+            return "off"
+        return (
+            f"on, sampling {self.sample_rate:.0%} (profiling {self.profile_rate:.0%} of those); "
+            f"{self.traced} traced, {self.dumped} slower than {self.slow_seconds * 1000:.0f}ms written to {self.path}"
+        )
+
+class LoopWatchdog:
+    # A task on the loop touches a heartbeat and a thread watches it. When
+    # the heartbeat goes stale for longer than block_seconds, the thread
+    # takes the loop thread's stack, and writes it out with the stall's
+    # full length once the loop is back
+    def __init__(self, tracer: Tracer, block_seconds: float):
+        self.tracer = tracer
+        self.block_seconds = block_seconds
+        self.interval = block_seconds / 4
+        self.heartbeat = time.perf_counter()
+        self.task = None
+        self.thread = None
+        self.stopped = threading.Event()
+    
+    def start(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Enabled from the environment before the loop exists;
+            # setup_hook starts it again once it does
+            return
+        if self.task is not None:
+            return
+        self.heartbeat = time.perf_counter()
+        # A fresh event each time, so a watcher that was just stopped can't
+        # miss it being set
+        self.stopped = threading.Event()
+        self.task = loop.create_task(self.beat())
+        self.thread = threading.Thread(
+            target=self.watch, args=(threading.get_ident(), self.stopped), name="loop-watchdog", daemon=True
+        )
+        self.thread.start()
+    
+    def stop(self):
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.thread = None
+    
+    async def beat(self):
+        while True:
+            self.heartbeat = time.perf_counter()
+            await asyncio.sleep(self.interval)
+    
+    def watch(self, loop_thread_id: int, stopped: threading.Event):
+        stall = None
+        while not stopped.wait(self.interval):
+            heartbeat = self.heartbeat
+            stalled = time.perf_counter() - heartbeat - self.interval
+            if stalled >= self.block_seconds:
+                if stall is None:
+                    frame = sys._current_frames().get(loop_thread_id)
+                    stall = (heartbeat, time.strftime("%Y-%m-%dT%H:%M:%S"), traceback.format_stack(frame) if frame is not None else [])
+                continue
+            if stall is not None:
+                last_beat, at, stack = stall
+                stall = None
+                self.tracer.dump({
+                    "trace": "loop_blocked",
+                    "at": at,
+                    "blocked_ms": round((heartbeat - last_beat - self.interval) * 1000, 3),
+                    "stack": stack
+                })
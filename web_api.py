@@ -0,0 +1,138 @@
+import time
+from typing import Callable, Dict, Tuple
+
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+import codec
+from settlement import plan_settlements
+from snapshot_cache import SnapshotCache
+
+class WebAPI:
+    # The health check, metrics and read-only guild endpoints. main.py only
+    # imports this once the bot starts, so aiohttp's server side isn't paid
+    # for before then
+    def __init__(
+        self, splitwise, response_cache, serves_guild: Callable[[str], bool], api_token: str,
+        page_size: int, max_page_size: int, snapshot_cache_size: int
+    ):
+        self.splitwise = splitwise
+        self.response_cache = response_cache
+        self.serves_guild = serves_guild
+        self.api_token = api_token
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+        # Part of every ETag, so tags handed out before a restart never
+        # match the versions counted after it
+        self.boot_id = format(time.time_ns(), "x")
+        self.snapshot_cache = SnapshotCache(snapshot_cache_size)
+    
+    @web.middleware
+    async def require_api_token(self, request: web.Request, handler):
+        if request.path.startswith("/guilds/") and (
+            not self.api_token or request.headers.get("Authorization") != f"Bearer {self.api_token}"
+        ):
+            raise web.HTTPUnauthorized(text="Missing or wrong API token")
+        return await handler(request)
+    
+    def snapshot_response(self, request: web.Request, guild_id: str, key: Tuple, build) -> web.Response:
+        # The JSON body is built once per guild version and reused until the
+        # next mutation. Versions are kept for unloaded guilds too, so a
+        # client sending back the current ETag gets its 304, and a cached
+        # body is served, without the guild being loaded or moved up the LRU
+        if not self.serves_guild(guild_id):
+            raise web.HTTPNotFound(text="Guild is served by another shard process")
+        version = self.splitwise.guild_version(guild_id)
+        etag = f'"{self.boot_id}-{version}"'
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if_none_match = [tag.strip() for tag in request.headers.get("If-None-Match", "").split(",")]
+        if etag in if_none_match:
+            return web.Response(status=304, headers=headers)
+        
+        body = self.snapshot_cache.get(key, version)
+        if body is None:
+            # has_group answers from storage, so polling a guild with no
+            # group doesn't load it either
+            if not self.splitwise.has_group(guild_id) or not self.splitwise.is_group_initialized(guild_id):
+                raise web.HTTPNotFound(text="Group not initialized")
+            body = codec.dumps(build())
+            self.snapshot_cache.put(key, version, body)
+        
+        if "*" in if_none_match:
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=body, content_type="application/json", headers=headers)
+    
+    async def health_check(self, request: web.Request) -> web.Response:
+        return web.Response(text="Bot is running!")
+    
+    async def cache_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.response_cache.stats())
+    
+    async def prometheus_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+    
+    async def guild_balances(self, request: web.Request) -> web.Response:
+        guild_id = request.match_info['guild_id']
+        
+        def build() -> Dict:
+            balances = self.splitwise.get_balances(guild_id)
+            return {
+                "guild_id": guild_id,
+                "group_members": [str(member_id) for member_id in self.splitwise.get_group_members(guild_id)],
+                "balances": {str(user_id): balance for user_id, balance in balances.items()},
+                "settlements": [
+                    {"from": str(debtor_id), "to": str(creditor_id), "amount": amount}
+                    for debtor_id, creditor_id, amount in plan_settlements(balances)
+                ]
+            }
+        
+        return self.snapshot_response(request, guild_id, (guild_id, "balances"), build)
+    
+    async def guild_expenses(self, request: web.Request) -> web.Response:
+        # Newest first; pass the returned "next" cursor as ?before= for the next page
+        guild_id = request.match_info['guild_id']
+        
+        try:
+            limit = int(request.query.get("limit", self.page_size))
+            before = request.query.get("before")
+            cursor = tuple(int(part) for part in before.split(":")) if before else None
+        except ValueError:
+            raise web.HTTPBadRequest(text="limit must be a number and before a timestamp:id cursor")
+        if not 1 <= limit <= self.max_page_size or (cursor is not None and len(cursor) != 2):
+            raise web.HTTPBadRequest(text=f"limit must be 1-{self.max_page_size} and before a timestamp:id cursor")
+        
+        def build() -> Dict:
+            expenses, next_cursor = self.splitwise.query_expenses(guild_id, before=cursor, limit=limit)
+            return {
+                "guild_id": guild_id,
+                "expenses": [expense.to_dict() for expense in expenses],
+                "next": f"{next_cursor[0]}:{next_cursor[1]}" if next_cursor else None
+            }
+        
+        return self.snapshot_response(request, guild_id, (guild_id, "expenses", cursor, limit), build)
+    
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.require_api_token])
+        app.add_routes([
+            web.get("/", self.health_check),
+            web.get("/cache", self.cache_stats),
+            web.get("/metrics", self.prometheus_metrics)
+        ])
+        # The guild endpoints expose members, balances and expenses, so
+        # they are only served behind a token
+        if self.api_token:
+            app.add_routes([
+                web.get(r"/guilds/{guild_id:\d+}/balances", self.guild_balances),
+                web.get(r"/guilds/{guild_id:\d+}/expenses", self.guild_expenses)
+            ])
+        else:
+            print("API_TOKEN is not set; the /guilds endpoints are disabled")
+        return app
+    
+    async def start(self, port: int) -> web.AppRunner:
+        # Served from the bot's own event loop, so handlers read splitwise
+        # state between mutations rather than racing them from another thread
+        runner = web.AppRunner(self.make_app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "0.0.0.0", port).start()
+        return runner